@@ -0,0 +1,275 @@
+from abc import ABC, abstractmethod
+import json
+from collections import defaultdict
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple, Union
+import numpy as np
+from .neighbors import Neighbors
+
+PathType = Union[Path, str]
+
+
+def value_key(value) -> str:
+    """Attribute values are matched by their JSON encoding
+    (so `true` and `"true"` are different values)
+    """
+    return json.dumps(value, sort_keys=True)
+
+
+def build_attributes(path_jsonl: PathType, path_npz: PathType):
+    """
+    Compiles per-item attributes (a JSON object per line, in the order
+        of `ids.txt`; lists are multi-valued) into a posting per
+        (key, value): the sorted items having it, as a bitmap when that
+        is smaller (values held by more than 1/32 of the items)
+    """
+    postings: Dict[Tuple[str, str], List[int]] = defaultdict(list)
+    n = 0
+    with open(path_jsonl, 'r') as f:
+        for i, line in enumerate(f):
+            n += 1
+            line = line.strip()
+            if not line:
+                continue
+            for key, values in json.loads(line).items():
+                if not isinstance(values, list):
+                    values = [values]
+                for value in values:
+                    postings[(key, value_key(value))].append(i)
+
+    index = []
+    arrays = {}
+    for j, ((key, value), inds) in enumerate(sorted(postings.items())):
+        inds = np.array(inds, dtype=np.int32)
+        if len(inds) * 32 > n:
+            mask = np.zeros(n, dtype=bool)
+            mask[inds] = True
+            arrays[f'p{j}'] = np.packbits(mask)
+            index.append([key, value, 'bits', len(inds)])
+        else:
+            arrays[f'p{j}'] = inds
+            index.append([key, value, 'inds', len(inds)])
+    path_tmp = Path(path_npz).with_name(f'.{Path(path_npz).name}')
+    with open(path_tmp, 'wb') as f:
+        np.savez(f, index=np.array(json.dumps({'n': n, 'postings': index})),
+                 **arrays)
+    path_tmp.rename(path_npz)
+
+
+class Posting(object):
+    """Items having one (key, value)"""
+    __slots__ = ('kind', 'array', 'count', 'n')
+
+    def __init__(self, kind: str, array: np.ndarray, count: int, n: int):
+        self.kind = kind
+        self.array = array
+        self.count = count
+        self.n = n
+
+    def contains(self, inds: np.ndarray) -> np.ndarray:
+        """Mask of the `inds` (-1 for none) that have the value"""
+        inds = np.asarray(inds, dtype=np.int64)
+        valid = (inds >= 0) & (inds < self.n)
+        safe = np.where(valid, inds, 0)
+        if self.kind == 'bits':
+            bits = (self.array[safe >> 3] >> (7 - (safe & 7))) & 1
+            return valid & bits.astype(bool)
+        if not self.count:
+            return np.zeros(len(inds), dtype=bool)
+        pos = np.minimum(np.searchsorted(self.array, safe), self.count - 1)
+        return valid & (self.array[pos] == safe)
+
+    def inds(self) -> np.ndarray:
+        if self.kind == 'bits':
+            return np.flatnonzero(
+                np.unpackbits(self.array)[:self.n]).astype(np.int64)
+        return self.array.astype(np.int64)
+
+
+class Filter(ABC):
+    """
+    Compiled filter expression. `estimate` is an upper bound of the
+        number of matching items (to choose between searching the index
+        and brute force); `candidates` a superset of them, if cheap
+    """
+
+    def __init__(self, n: int):
+        self.n = n
+
+    @abstractmethod
+    def mask(self, inds: np.ndarray) -> np.ndarray:
+        """Mask of the `inds` (-1 for none) that match"""
+
+    def estimate(self) -> int:
+        return self.n
+
+    def candidates(self) -> Optional[np.ndarray]:
+        return None
+
+    def matching(self) -> np.ndarray:
+        """All matching items (sorted)"""
+        inds = self.candidates()
+        if inds is None:
+            inds = np.arange(self.n, dtype=np.int64)
+        return inds[self.mask(inds)]
+
+    def keep(self, neighbors: Neighbors, ids_find=None) -> Neighbors:
+        """Neighbors that match (`ids_find` maps the ids of neighbors
+        that are not index items, ex. from a delta, to index items)
+        """
+        inds = neighbors.inds
+        if inds is None:
+            inds = np.fromiter(
+                (ids_find(id_) if ids_find is not None else -1
+                 for id_ in neighbors.ids),
+                dtype=np.int64, count=len(neighbors))
+        return neighbors.select(self.mask(inds))
+
+
+class Term(Filter):
+
+    def __init__(self, n: int, posting: Optional[Posting]):
+        super().__init__(n)
+        self.posting = posting
+
+    def mask(self, inds):
+        if self.posting is None:
+            return np.zeros(len(inds), dtype=bool)
+        return self.posting.contains(inds)
+
+    def estimate(self):
+        return 0 if self.posting is None else self.posting.count
+
+    def candidates(self):
+        if self.posting is None:
+            return np.zeros(0, dtype=np.int64)
+        return self.posting.inds()
+
+
+class And(Filter):
+
+    def __init__(self, n: int, children: List[Filter]):
+        super().__init__(n)
+        self.children = children
+
+    def mask(self, inds):
+        mask = np.ones(len(inds), dtype=bool)
+        for child in self.children:
+            mask &= child.mask(inds)
+        return mask
+
+    def estimate(self):
+        return min((c.estimate() for c in self.children), default=self.n)
+
+    def candidates(self):
+        # Those of the most selective child that can list them
+        for child in sorted(self.children, key=lambda c: c.estimate()):
+            inds = child.candidates()
+            if inds is not None:
+                return inds
+        return None
+
+
+class Or(Filter):
+
+    def __init__(self, n: int, children: List[Filter]):
+        super().__init__(n)
+        self.children = children
+
+    def mask(self, inds):
+        mask = np.zeros(len(inds), dtype=bool)
+        for child in self.children:
+            mask |= child.mask(inds)
+        return mask
+
+    def estimate(self):
+        return min(sum(c.estimate() for c in self.children), self.n)
+
+    def candidates(self):
+        inds = np.zeros(0, dtype=np.int64)
+        for child in self.children:
+            child_inds = child.candidates()
+            if child_inds is None:
+                return None
+            inds = np.union1d(inds, child_inds)
+        return inds
+
+
+class Not(Filter):
+
+    def __init__(self, n: int, child: Filter):
+        super().__init__(n)
+        self.child = child
+
+    def mask(self, inds):
+        inds = np.asarray(inds, dtype=np.int64)
+        # No item (-1) matches either way
+        return ~self.child.mask(inds) & (inds >= 0) & (inds < self.n)
+
+
+class Attributes(object):
+    """
+    Per-item attributes of an index version (see `build_attributes`),
+        for filtered queries. Filters are JSON expressions:
+            {"brand": "x", "in_stock": true}  (all must hold)
+            {"brand": {"$in": ["x", "y"]}}, {"brand": {"$ne": "x"}}
+            {"$or": [expr, ...]}, {"$and": [...]}, {"$not": expr}
+    """
+
+    def __init__(self, path_npz: PathType):
+        with np.load(str(path_npz), allow_pickle=False) as npz:
+            index = json.loads(str(npz['index']))
+            self.n = index['n']
+            self.postings: Dict[Tuple[str, str], Posting] = {
+                (key, value): Posting(kind, npz[f'p{j}'], count, self.n)
+                for j, (key, value, kind, count)
+                in enumerate(index['postings'])}
+
+    def __len__(self):
+        return len(self.postings)
+
+    def nbytes(self) -> int:
+        return sum(p.array.nbytes for p in self.postings.values())
+
+    def compile(self, expr: Dict[str, Any]) -> Filter:
+        if not isinstance(expr, dict):
+            raise ValueError(f'Invalid filter: {expr}')
+        children = []
+        for key, value in expr.items():
+            if key == '$and':
+                children.append(And(self.n, [self.compile(e) for e in value]))
+            elif key == '$or':
+                children.append(Or(self.n, [self.compile(e) for e in value]))
+            elif key == '$not':
+                children.append(Not(self.n, self.compile(value)))
+            elif key.startswith('$'):
+                raise ValueError(f'Unknown filter operator: {key}')
+            elif isinstance(value, dict):
+                children.append(self._compile_op(key, value))
+            else:
+                children.append(self._term(key, value))
+        return children[0] if len(children) == 1 else And(self.n, children)
+
+    def _compile_op(self, key: str, ops: Dict[str, Any]) -> Filter:
+        children = []
+        for op, value in ops.items():
+            if op == '$in':
+                children.append(Or(self.n, [self._term(key, v)
+                                            for v in value]))
+            elif op == '$ne':
+                children.append(Not(self.n, self._term(key, value)))
+            elif op == '$eq':
+                children.append(self._term(key, value))
+            else:
+                raise ValueError(f'Unknown filter operator: {op}')
+        return children[0] if len(children) == 1 else And(self.n, children)
+
+    def _term(self, key: str, value) -> Term:
+        return Term(self.n, self.postings.get((key, value_key(value))))
+
+    def tojson(self) -> Dict[str, Any]:
+        return {
+            'n_postings': len(self),
+            'mb': self.nbytes() / 1e6,
+            'keys': sorted({key for key, _ in self.postings}),
+        }
@@ -0,0 +1,79 @@
+from collections import OrderedDict
+import threading
+from time import time
+from typing import Any, Dict, Hashable, Optional
+
+
+class ResultCache(object):
+    """
+    Bounded LRU cache (with optional TTL) for query results
+
+    Bounded both by number of entries and by an estimate of the memory
+        held by the cached values (the size is given by the caller)
+    """
+
+    def __init__(self, max_entries: int = 10000,
+                 max_mb: float = None,
+                 ttl_s: float = None,
+                 ):
+        self.max_entries = max_entries
+        self.max_bytes = max_mb * 1e6 if max_mb else None
+        self.ttl_s = ttl_s
+
+        # key -> (value, size in bytes, insert time)
+        self._d: 'OrderedDict[Hashable, tuple]' = OrderedDict()
+        self._lock = threading.Lock()
+        self.n_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._d)
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self._lock:
+            entry = self._d.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            value, size, ts = entry
+            if self.ttl_s is not None and time() - ts > self.ttl_s:
+                self._pop(key)
+                self.evictions += 1
+                self.misses += 1
+                return None
+            self._d.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key: Hashable, value: Any, size: int = 0):
+        with self._lock:
+            if key in self._d:
+                self._pop(key)
+            self._d[key] = (value, size, time())
+            self.n_bytes += size
+            while self._d and (
+                    len(self._d) > self.max_entries
+                    or (self.max_bytes is not None
+                        and self.n_bytes > self.max_bytes)):
+                self._pop(next(iter(self._d)))
+                self.evictions += 1
+
+    def _pop(self, key: Hashable):
+        _, size, _ = self._d.pop(key)
+        self.n_bytes -= size
+
+    def clear(self):
+        with self._lock:
+            self._d.clear()
+            self.n_bytes = 0
+
+    def tojson(self) -> Dict[str, Any]:
+        return {
+            'entries': len(self._d),
+            'mb': self.n_bytes / 1e6,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
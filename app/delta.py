@@ -0,0 +1,160 @@
+from io import BytesIO
+from itertools import chain
+from typing import Any, Callable, Dict, List, Optional, Sequence
+import numpy as np
+from .ids import IdStore
+from .neighbors import Neighbors
+from .vectors import exact_dists, rank_order
+
+DELTA_SUFFIX = '.delta.npz'  # `cat_a.delta.npz` next to `cat_a.tar.gz`
+TAR_SUFFIXES = ('.tar.gz', '.tgz', '.tar')
+
+
+def delta_path(path_tar: str) -> str:
+    """Delta file of an index tarball (only the suffix of its name is
+    replaced: directories may contain `.tar` too)
+    """
+    path_tar = str(path_tar)
+    for suffix in TAR_SUFFIXES:
+        if path_tar.endswith(suffix):
+            return path_tar[:-len(suffix)] + DELTA_SUFFIX
+    return path_tar + DELTA_SUFFIX
+
+
+def as_vectors(vectors, n: int, n_dim: int = None) -> np.ndarray:
+    """`vectors` as an (n, n_dim) array. Without `n_dim`, it is taken
+    from the vectors: a delta that only removes items has none
+    """
+    vectors = np.asarray(vectors, dtype=np.float32)
+    if n_dim is None:
+        n_dim = vectors.shape[-1] if vectors.ndim == 2 else (-1 if n else 0)
+    return vectors.reshape(n, n_dim)
+
+
+class Delta(object):
+    """
+    Changes to a base index since it was built: vectors of the items
+        added or changed, and the ids of the items removed
+
+    Deltas are small (a fraction of the catalog), so they are searched
+        exactly and merged with the base results, in which the removed
+        and changed items (tombstoned) are skipped.
+    Memory scales with the size of the change: tombstones are a sorted
+        array of base indices, not a mask over the whole base
+    """
+
+    def __init__(self, ids: Sequence, vectors: np.ndarray,
+                 tombstones: Sequence, base_ids: IdStore,
+                 name: str = None, n_dim: int = None):
+        """
+
+        Args:
+            ids: ids of the added or changed items
+            vectors: their (n, n_dim) vectors
+            tombstones: ids of the removed items
+            base_ids: ids of the base index the delta applies to
+            name: shown in the healthcheck
+            n_dim: dimension of the base index (needed if no vectors)
+        """
+        self.name = name
+        self.ids: List = [str(id_) for id_ in ids]
+        self.ids_d: Dict[str, int] = {
+            id_: i for i, id_ in enumerate(self.ids)}
+        self.vectors = as_vectors(vectors, len(self.ids), n_dim)
+        self.n_removed = len(tombstones)
+        # Removed and changed items of the base
+        self.superseded = set(chain(map(str, tombstones), self.ids))
+        inds = (base_ids.find(id_) for id_ in self.superseded)
+        self.tombstoned = np.unique(np.fromiter(
+            (i for i in inds if i >= 0), dtype=np.int64))
+
+    @classmethod
+    def from_bytes(cls, data: bytes, base_ids: IdStore,
+                   base_meta_d: Dict[str, Any],
+                   name: str = None) -> Optional['Delta']:
+        """
+        From a `.npz` file of `ids`, `vectors`, `tombstones` and
+            `base_timestamp_utc` (see `save_delta`)
+
+        Returns: None if the delta was made for another base (ex. an
+            older base, before the delta was compacted into this one)
+        """
+        with np.load(BytesIO(data), allow_pickle=False) as npz:
+            base_ts = str(npz['base_timestamp_utc'])
+            if base_ts != base_meta_d.get('timestamp_utc'):
+                return None
+            return cls(npz['ids'].tolist(), npz['vectors'],
+                       npz['tombstones'].tolist(), base_ids, name=name,
+                       n_dim=base_meta_d.get('n_dim'))
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, id_) -> bool:
+        return id_ in self.ids_d
+
+    def get_vector(self, id_) -> Optional[np.ndarray]:
+        i = self.ids_d.get(id_)
+        return None if i is None else self.vectors[i]
+
+    def overfetch(self, k: int) -> int:
+        """Extra base neighbors to fetch, as some may be tombstoned"""
+        return min(len(self.tombstoned), k)
+
+    def search(self, q_emb, k: int, metric: str) -> Neighbors:
+        """Exact (brute force) nearest delta items"""
+        if not len(self):
+            return Neighbors(ids=[], dists=[])
+        dists = exact_dists(
+            np.asarray(q_emb, dtype=np.float32), self.vectors, metric)
+        order = rank_order(dists, metric)[:k]
+        return Neighbors(ids=[self.ids[i] for i in order.tolist()],
+                         dists=dists[order])
+
+    def merge(self, neighbors: Neighbors, q_emb, k: int, metric: str,
+              q_id=None,
+              keep_fn: Callable[[Neighbors], Neighbors] = None
+              ) -> Neighbors:
+        """
+        Best `k` of the base `neighbors` (with distances, tombstoned
+            items left out) and of the delta
+
+        Args:
+            q_id: id of the query item, left out of the delta neighbors
+            keep_fn: filters the delta neighbors (ex. by attributes);
+                then all of the delta is searched, not only the top `k`
+        """
+        if neighbors.inds is not None:
+            neighbors = neighbors.without_inds(self.tombstoned)
+        else:
+            neighbors = neighbors.without_ids(self.superseded)
+        found = self.search(
+            q_emb, k + 1 if keep_fn is None else len(self), metric)
+        if keep_fn is not None:
+            found = keep_fn(found)
+        if q_id is not None:
+            found = found.without_ids([q_id])
+        merged = neighbors.concat(found)
+        return merged.select(rank_order(merged.dists, metric)[:k])
+
+    def tojson(self) -> Dict[str, Any]:
+        return {
+            'name': self.name,
+            'n_ids': len(self),
+            'n_removed': self.n_removed,
+            'n_tombstoned': len(self.tombstoned),
+        }
+
+
+def save_delta(f, ids: Sequence, vectors: np.ndarray,
+               tombstones: Sequence, base_timestamp_utc: str,
+               n_dim: int = None):
+    """Writes a delta file (path or file object) for the base index
+    whose metadata has this `timestamp_utc` (and dimension `n_dim`)
+    """
+    np.savez(f,
+             ids=np.array([str(id_) for id_ in ids], dtype=str),
+             vectors=as_vectors(vectors, len(ids), n_dim),
+             tombstones=np.array([str(id_) for id_ in tombstones],
+                                 dtype=str),
+             base_timestamp_utc=np.array(base_timestamp_utc))
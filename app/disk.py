@@ -0,0 +1,224 @@
+import os
+import shutil
+import threading
+from pathlib import Path
+from time import time
+from typing import Any, Dict, List, Union
+from .io import (
+    current_version, dir_lock, PATH_TMP, CURRENT_KEY)
+import logging
+
+logging.basicConfig(level=logging.INFO)
+
+PathType = Union[Path, str]
+
+
+def dir_size(path: PathType) -> int:
+    """Bytes of the files under `path` (a version directory only holds
+    a handful of files, so this is cheap, unlike walking all of /tmp)
+    """
+    total = 0
+    for entry in os.scandir(str(path)):
+        try:
+            if entry.is_dir(follow_symlinks=False):
+                total += dir_size(entry.path)
+            elif entry.is_file(follow_symlinks=False):
+                total += entry.stat(follow_symlinks=False).st_size
+        except FileNotFoundError:
+            # Removed concurrently
+            pass
+    return total
+
+
+def is_version_dir(path: Path) -> bool:
+    return path.name.startswith('v') and path.is_dir() \
+        and not path.is_symlink()
+
+
+class DiskManager(object):
+    """
+    Accounting of the disk used by extracted index versions
+
+    Versions are measured once, when they are extracted (or found on
+        startup), and forgotten when removed, so usage is reported
+        without walking the disk.
+    Over the disk budget, versions no resource of this worker serves
+        are removed first. Then, over either budget, the least recently
+        queried indexes are evicted (unloaded, see `ANNResource.evict`),
+        except pinned ones. Only the disk budget removes their files:
+        over the memory budget (or when idle), this worker just drops
+        its version, which other workers may still be serving
+    """
+
+    def __init__(self, path_tmp: PathType = PATH_TMP,
+                 budget_mb: float = None,
+                 memory_budget_mb: float = None):
+        """
+
+        Args:
+            path_tmp: directory holding a directory per index
+            budget_mb: if set, disk budget of all extracted versions
+            memory_budget_mb: if set, budget of the versions served
+                (memory-mapped) by this worker
+        """
+        self.path_tmp = Path(path_tmp).resolve()
+        self.budget_mb = budget_mb
+        self.memory_budget_mb = memory_budget_mb
+        self._lock = threading.Lock()
+        self._versions: Dict[Path, int] = {}
+        self.total_bytes = 0
+        self.resources: List = []
+        self.n_removed = 0
+        self.n_evicted = 0
+
+    @property
+    def over_budget(self) -> bool:
+        return self.budget_mb is not None \
+            and self.total_bytes > self.budget_mb * 1e6
+
+    def served(self) -> List[Path]:
+        """Versions currently served by the registered resources"""
+        versions = [r.version for r in self.resources]
+        return [v.path for v in versions if v is not None]
+
+    @property
+    def served_bytes(self) -> int:
+        served = self.served()
+        with self._lock:
+            return sum(self._versions.get(p, 0) for p in served)
+
+    @property
+    def over_memory_budget(self) -> bool:
+        return self.memory_budget_mb is not None \
+            and self.served_bytes > self.memory_budget_mb * 1e6
+
+    def register(self, ann_resource):
+        """Resources whose versions are tracked (and may be evicted)"""
+        self.resources.append(ann_resource)
+
+    def add(self, path_version: PathType) -> int:
+        """Tracks a version directory. Returns: its size in bytes"""
+        path_version = Path(path_version)
+        with self._lock:
+            if path_version in self._versions:
+                return self._versions[path_version]
+        size = dir_size(path_version)
+        with self._lock:
+            if path_version not in self._versions:
+                self._versions[path_version] = size
+                self.total_bytes += size
+        return size
+
+    def discard(self, path_version: PathType):
+        """Stops tracking a version directory (once it is removed)"""
+        with self._lock:
+            size = self._versions.pop(Path(path_version), None)
+            if size is not None:
+                self.total_bytes -= size
+
+    def remove(self, path_version: PathType):
+        """Removes a version that cannot be `current` (or while holding
+        the lock of its index directory)
+        """
+        path_version = Path(path_version)
+        logging.info(f'Removing index version: {path_version}')
+        shutil.rmtree(str(path_version), ignore_errors=True)
+        self.discard(path_version)
+        self.n_removed += 1
+
+    def scan(self):
+        """
+        Run once on startup: tracks the versions already on disk, and
+            removes those left behind by previous runs (partial extracts,
+            versions that are not `current`)
+        Indexes being extracted by another worker are skipped
+        """
+        if not self.path_tmp.exists():
+            return
+        for path_root in self.path_tmp.glob(f'**/{CURRENT_KEY}'):
+            path_root = path_root.parent
+            try:
+                with dir_lock(path_root, timeout=0):
+                    path_current = current_version(path_root)
+                    for path in path_root.iterdir():
+                        if path.name.endswith('.partial') \
+                                and path.is_dir():
+                            self.remove(path)
+                        elif is_version_dir(path):
+                            if path.resolve() == path_current:
+                                self.add(path_current)
+                            else:
+                                self.remove(path)
+            except TimeoutError:
+                logging.info(f'Not scanning {path_root}: locked')
+        logging.info(f'Disk: {self.total_bytes / 1e6:.1f} MB '
+                     f'in {len(self._versions)} index versions')
+
+    def enforce(self, keep=None):
+        """
+        Frees disk and memory until under budget
+
+        Args:
+            keep: resource that may not be evicted (ex. the one that
+                just loaded a version)
+        """
+        if self.over_budget:
+            served = set(self.served())
+            with self._lock:
+                unreferenced = [p for p in self._versions
+                                if p not in served]
+            for path_version in unreferenced:
+                if not self.over_budget:
+                    break
+                # Queries in flight keep their mmaps of removed files
+                self.evict_version(path_version)
+
+        lru = sorted((r for r in self.resources
+                      if r.ready and not r.pinned and r is not keep),
+                     key=lambda r: r.last_query_at)
+        for ann_r in lru:
+            if not (self.over_budget or self.over_memory_budget):
+                return
+            logging.info(f'Over budget: evicting {ann_r.name}')
+            ann_r.evict(free_disk=self.over_budget)
+            self.n_evicted += 1
+        if self.over_budget or self.over_memory_budget:
+            logging.warning(f'Over budget: {self.total_bytes / 1e6:.1f} MB '
+                            f'on disk, {self.served_bytes / 1e6:.1f} MB '
+                            f'served')
+
+    def evict_idle(self, idle_s: float):
+        """Evicts lazy indexes not queried for `idle_s` seconds
+        (they are loaded again on their next query)
+        """
+        for ann_r in self.resources:
+            if ann_r.ready and ann_r.lazy and not ann_r.pinned \
+                    and time() - ann_r.last_query_at > idle_s:
+                logging.info(f'Idle: evicting {ann_r.name}')
+                ann_r.evict(free_disk=False)
+                self.n_evicted += 1
+
+    def evict_version(self, path_version: Path):
+        """Removes a version, even if it is `current` on disk
+        (workers that have not loaded it yet then download it again)
+        """
+        path_root = path_version.parent
+        with dir_lock(path_root):
+            if current_version(path_root) == path_version:
+                (path_root / CURRENT_KEY).unlink()
+            self.remove(path_version)
+
+    def tojson(self) -> Dict[str, Any]:
+        with self._lock:
+            versions = dict(self._versions)
+        return {
+            'total_mb': self.total_bytes / 1e6,
+            'budget_mb': self.budget_mb,
+            'served_mb': self.served_bytes / 1e6,
+            'memory_budget_mb': self.memory_budget_mb,
+            'n_removed': self.n_removed,
+            'n_evicted': self.n_evicted,
+            'versions': {
+                str(p.relative_to(self.path_tmp)): size / 1e6
+                for p, size in versions.items()},
+        }
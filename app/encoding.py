@@ -0,0 +1,87 @@
+import json
+from typing import Any, Dict
+import numpy as np
+try:
+    # Only use ujson with CPython (see requirements)
+    import ujson
+except ImportError:
+    ujson = None
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+JSON_CONTENT_TYPE = 'application/json; charset=UTF-8'
+MSGPACK_CONTENT_TYPE = 'application/msgpack'
+MSGPACK_CONTENT_TYPES = (MSGPACK_CONTENT_TYPE, 'application/x-msgpack')
+BINARY_CONTENT_TYPE = 'application/octet-stream'
+
+# `json`: {recs: [{id, dist, score}, ...]}
+# `columnar`: {ids: [...], dists: [...], scores: [...]}
+# `msgpack`: the columnar layout, msgpack encoded
+FORMATS = ('json', 'columnar', 'msgpack')
+# Vectors: JSON list, raw little-endian float32 bytes, or msgpack list
+VECTOR_FORMATS = ('json', 'f32', 'msgpack')
+
+
+def dumps(obj: Any) -> str:
+    """Fast JSON encoding of plain python objects (no numpy types)"""
+    if ujson is not None:
+        return ujson.dumps(obj)
+    return json.dumps(obj)
+
+
+def negotiate(req, fmt: str = None, formats=FORMATS) -> str:
+    """
+    Response format of a request: an explicit `format` (from the
+        payload, or the `format` query param) wins over the Accept header
+
+    Raises: ValueError if the requested format is unknown/unavailable
+    """
+    fmt = fmt or req.params.get('format')
+    if fmt is not None:
+        if fmt not in formats:
+            raise ValueError(f'Unknown format: {fmt}')
+        if fmt == 'msgpack' and msgpack is None:
+            raise ValueError('msgpack is not installed')
+        return fmt
+    if req.client_accepts_json:
+        return 'json'
+    if msgpack is not None and 'msgpack' in formats and any(
+            req.client_accepts(t) for t in MSGPACK_CONTENT_TYPES):
+        return 'msgpack'
+    if 'f32' in formats and req.client_accepts(BINARY_CONTENT_TYPE):
+        return 'f32'
+    return 'json'
+
+
+def recs_body(neighbors, incl_dist: bool, incl_score: bool,
+              fmt: str = 'json', **extra) -> Dict[str, Any]:
+    """Response body for `Neighbors` in the layout of `fmt`"""
+    if fmt == 'json':
+        return {'recs': neighbors.to_dicts(incl_dist, incl_score), **extra}
+    return {**neighbors.to_columns(incl_dist, incl_score), **extra}
+
+
+def set_body(resp, body: Any, fmt: str = 'json'):
+    """Serializes `body` into the (falcon) response"""
+    if fmt == 'msgpack':
+        resp.content_type = MSGPACK_CONTENT_TYPE
+        resp.data = msgpack.packb(body, use_bin_type=True)
+    else:
+        resp.content_type = JSON_CONTENT_TYPE
+        resp.body = dumps(body)
+
+
+def set_vector_body(resp, emb, fmt: str = 'json'):
+    """Vectors are sent as float32: raw bytes, msgpack or a JSON list"""
+    emb = np.asarray(emb, dtype='<f4')
+    if fmt == 'f32':
+        resp.content_type = BINARY_CONTENT_TYPE
+        resp.data = emb.tobytes()
+    elif fmt == 'msgpack':
+        resp.content_type = MSGPACK_CONTENT_TYPE
+        resp.data = msgpack.packb(emb.tolist(), use_single_float=True)
+    else:
+        resp.content_type = JSON_CONTENT_TYPE
+        resp.body = dumps(emb.tolist())
@@ -0,0 +1,199 @@
+from collections.abc import Mapping, Sequence
+import hashlib
+import mmap
+import os
+from pathlib import Path
+from typing import List, Union, Iterable
+import numpy as np
+
+PathType = Union[Path, str]
+
+OFFSETS_SUFFIX = '.offsets.npy'
+HASHES_SUFFIX = '.hashes.npy'
+ORDER_SUFFIX = '.order.npy'
+NEWLINE = ord('\n')
+BUILD_CHUNK_SZ = 1 << 20
+
+
+def hash_id(id_bytes: bytes) -> int:
+    """Stable 64-bit hash (python's `hash` is salted per process)"""
+    return int.from_bytes(
+        hashlib.blake2b(id_bytes, digest_size=8).digest(), 'little')
+
+
+def _sidecar(path_ids: PathType, suffix: str) -> Path:
+    path_ids = Path(path_ids)
+    return path_ids.with_name(path_ids.name + suffix)
+
+
+def _save_atomic(path: Path, arr: np.ndarray):
+    # Other workers may be mmapping `path`, so never write in place
+    path_tmp = path.with_name(f'.{path.name}.{os.getpid()}')
+    with open(path_tmp, 'wb') as f:
+        np.save(f, arr)
+    os.replace(path_tmp, path)
+
+
+def _mmap_bytes(path: PathType) -> Union[mmap.mmap, bytes]:
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return b''  # empty files can not be mmapped
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def build_id_store(path_ids: PathType):
+    """
+    Builds the lookup tables for a newline-delimited ids file.
+    Done once at extract time, the results live next to the ids file:
+        offsets: (n+1,) int64 byte offsets, id `i` is
+            `data[offsets[i]:offsets[i+1] - 1]`
+        hashes: (n,) uint64 sorted 64-bit hashes of the ids
+        order: (n,) index of the id for each entry in `hashes`
+    """
+    data = _mmap_bytes(path_ids)
+    buf = np.frombuffer(data, dtype=np.uint8)
+    newlines = np.flatnonzero(buf == NEWLINE)
+    if len(buf) and buf[-1] != NEWLINE:
+        # Last line is not newline-terminated
+        newlines = np.append(newlines, len(buf))
+    offsets = np.empty(len(newlines) + 1, dtype=np.int64)
+    offsets[0] = 0
+    offsets[1:] = newlines + 1
+    n = len(newlines)
+
+    def iter_ids():
+        for lo in range(0, n, BUILD_CHUNK_SZ):
+            hi = min(lo + BUILD_CHUNK_SZ, n)
+            starts = offsets[lo:hi].tolist()
+            ends = (offsets[lo + 1:hi + 1] - 1).tolist()
+            for s, e in zip(starts, ends):
+                yield data[s:e].rstrip(b'\r')
+
+    hashes = np.fromiter(map(hash_id, iter_ids()),
+                         dtype=np.uint64, count=n)
+    order = np.argsort(hashes, kind='stable').astype(
+        np.uint32 if n < 2 ** 32 else np.uint64)
+
+    _save_atomic(_sidecar(path_ids, OFFSETS_SUFFIX), offsets)
+    _save_atomic(_sidecar(path_ids, HASHES_SUFFIX), hashes[order])
+    _save_atomic(_sidecar(path_ids, ORDER_SUFFIX), order)
+    del buf
+    if isinstance(data, mmap.mmap):
+        data.close()
+
+
+def id_store_exists(path_ids: PathType) -> bool:
+    return all(_sidecar(path_ids, s).exists()
+               for s in (OFFSETS_SUFFIX, HASHES_SUFFIX, ORDER_SUFFIX))
+
+
+class IdStore(Sequence):
+    """
+    Read-only, memory-mapped sequence of ids (index -> id)
+
+    Nothing is materialized per id: the ids file and its lookup tables
+        are mmapped, so the pages are shared by every worker process
+    """
+
+    def __init__(self, path_ids: PathType):
+        self.path_ids = Path(path_ids)
+        self._data = _mmap_bytes(path_ids)
+        self._offsets = np.load(
+            str(_sidecar(path_ids, OFFSETS_SUFFIX)), mmap_mode='r')
+        self._hashes = np.load(
+            str(_sidecar(path_ids, HASHES_SUFFIX)), mmap_mode='r')
+        self._order = np.load(
+            str(_sidecar(path_ids, ORDER_SUFFIX)), mmap_mode='r')
+        self.lookup = IdLookup(self)
+
+    def __len__(self) -> int:
+        return len(self._offsets) - 1
+
+    def _get_bytes(self, ind: int) -> bytes:
+        start = int(self._offsets[ind])
+        end = int(self._offsets[ind + 1]) - 1
+        return self._data[start:end].rstrip(b'\r')
+
+    def __getitem__(self, ind):
+        if isinstance(ind, slice):
+            return [self[i] for i in range(*ind.indices(len(self)))]
+        if ind < 0:
+            ind += len(self)
+        if not 0 <= ind < len(self):
+            raise IndexError(ind)
+        return self._get_bytes(ind).decode('utf-8')
+
+    def take(self, inds: Iterable[int]) -> List[str]:
+        """Vectorized-ish `[self[i] for i in inds]` for ANN output"""
+        data, offsets = self._data, self._offsets
+        inds = np.asarray(inds, dtype=np.int64)
+        starts = offsets[inds].tolist()
+        ends = (offsets[inds + 1] - 1).tolist()
+        return [data[s:e].rstrip(b'\r').decode('utf-8')
+                for s, e in zip(starts, ends)]
+
+    def find(self, id_) -> int:
+        """Index of `id_`, or -1 if it is not in the store"""
+        if not isinstance(id_, str):
+            return -1
+        id_bytes = id_.encode('utf-8')
+        h = np.uint64(hash_id(id_bytes))
+        j = int(np.searchsorted(self._hashes, h, side='left'))
+        # Walk any (unlikely) hash collisions
+        while j < len(self._hashes) and self._hashes[j] == h:
+            ind = int(self._order[j])
+            if self._get_bytes(ind) == id_bytes:
+                return ind
+            j += 1
+        return -1
+
+    def find_many(self, ids: Iterable) -> np.ndarray:
+        """Batch `find`: one search over the hashes for all `ids`"""
+        ids = list(ids)
+        ids_bytes = [id_.encode('utf-8') if isinstance(id_, str) else None
+                     for id_ in ids]
+        hashes = np.fromiter(
+            (0 if b is None else hash_id(b) for b in ids_bytes),
+            dtype=np.uint64, count=len(ids))
+        inds = np.full(len(ids), -1, dtype=np.int64)
+        if not len(self):
+            return inds
+        js = np.minimum(np.searchsorted(self._hashes, hashes),
+                        len(self) - 1)
+        rows = np.flatnonzero(self._hashes[js] == hashes)
+        cands = self._order[js[rows]].astype(np.int64)
+        starts = self._offsets[cands].tolist()
+        ends = (self._offsets[cands + 1] - 1).tolist()
+        for row, cand, s, e in zip(rows.tolist(), cands.tolist(),
+                                   starts, ends):
+            id_bytes = ids_bytes[row]
+            if id_bytes is None:
+                continue
+            if self._data[s:e].rstrip(b'\r') == id_bytes:
+                inds[row] = cand
+            else:
+                # Hash collision: walk the candidates
+                inds[row] = self.find(ids[row])
+        return inds
+
+
+class IdLookup(Mapping):
+    """Mapping view (id -> index) over an `IdStore`"""
+
+    def __init__(self, store: IdStore):
+        self.store = store
+
+    def __getitem__(self, id_) -> int:
+        ind = self.store.find(id_)
+        if ind < 0:
+            raise KeyError(id_)
+        return ind
+
+    def __contains__(self, id_) -> bool:
+        return self.store.find(id_) >= 0
+
+    def __len__(self) -> int:
+        return len(self.store)
+
+    def __iter__(self):
+        return iter(self.store)
@@ -1,16 +1,25 @@
 from annoy import AnnoyIndex
 import json
 from time import time
-from typing import Dict, List, Tuple, Union, Optional
+from typing import Callable, Dict, Tuple, Union, Optional
 import boto3
+from botocore.config import Config
 from botocore.exceptions import ClientError
 import s3fs
 import datetime
-import tarfile
 import struct
 import os
+import fcntl
+import numpy as np
+import shutil
+from contextlib import contextmanager
+from time import sleep
 from pathlib import Path
 import logging
+from .attributes import build_attributes
+from .ids import IdStore, IdLookup, build_id_store
+from .transfer import extract_tar
+from .vectors import export_vectors
 
 logging.basicConfig(level=logging.INFO)
 
@@ -22,23 +31,52 @@ PATH_TMP.parent.mkdir(parents=True, exist_ok=True)
 ANN_INDEX_KEY = 'index.ann'
 ANN_IDS_KEY = 'ids.txt'
 ANN_META_KEY = 'metadata.json'
+ANN_VECTORS_KEY = 'vectors.npy'  # (n, n_dim) float32 item vectors
+# Metadata flag: export `vectors.npy` at extraction if the tarball has none
+EXPORT_VECTORS_META_KEY = 'export_vectors'
+# Optional per-item attributes (a JSON object per line, as `ids.txt`)
+ANN_ATTRS_KEY = 'attributes.jsonl'
+ANN_ATTRS_COMPILED_KEY = 'attributes.npz'  # compiled at extraction
 TIMESTAMP_LOCAL_KEY = 'timestamp.txt'
+CURRENT_KEY = 'current'  # symlink to the latest extracted version
+LOCK_KEY = '.lock'
 # DYNAMO_ID = 'variant_id'
 DYNAMO_KEY = 'repr'
 DTYPE_FMT = 'f'  # float32 struct
 DTYPE_SZ = 4  # float32 is 4 bytes
 SEED = 322
+# ex) a local DynamoDB stand-in (`http://localhost:8000`) for testing
+DYNAMO_ENDPOINT_URL = os.environ.get('DYNAMO_ENDPOINT_URL') or None
+DYNAMO_MAX_POOL = int(os.environ.get('DYNAMO_MAX_POOL', 50))
 
 PathType = Union[Path, str]
 
 s3 = s3fs.S3FileSystem()
-dynamodb = boto3.resource('dynamodb')
+# One connection pool shared by every out-of-index lookup
+dynamodb = boto3.resource(
+    'dynamodb',
+    endpoint_url=DYNAMO_ENDPOINT_URL,
+    config=Config(max_pool_connections=DYNAMO_MAX_POOL),
+)
 
 
 def is_s3_path(path: PathType):
     return str(path).startswith(S3_URI_PREFIX)
 
 
+def path_exists(path: PathType) -> bool:
+    if is_s3_path(path):
+        s3.invalidate_cache(str(path))
+        return s3.exists(str(path))
+    return os.path.exists(str(path))
+
+
+def read_bytes(path: PathType) -> bytes:
+    open_fn = s3.open if is_s3_path(path) else open
+    with open_fn(str(path), 'rb') as f:
+        return f.read()
+
+
 def load_fallback_map(path_fallback_map: PathType) -> Dict[str, str]:
     if is_s3_path(path_fallback_map):
         open_fn = s3.open
@@ -70,30 +108,123 @@ def needs_reload(path_tar: PathType,
             return mtime > ts_read_utc
 
 
+def read_ts(path_version: PathType) -> Optional[datetime.datetime]:
+    path_local_ts_read = Path(path_version) / TIMESTAMP_LOCAL_KEY
+    if not path_local_ts_read.exists():
+        return None
+    return datetime.datetime.fromtimestamp(
+        int(open(path_local_ts_read, 'r').read().strip()),
+        tz=datetime.timezone.utc)
+
+
+def current_version(path_root: PathType) -> Optional[Path]:
+    """Most recently extracted (complete) version of an index"""
+    path_current = Path(path_root) / CURRENT_KEY
+    if not path_current.exists():
+        return None
+    return path_current.resolve()
+
+
+def set_current_version(path_root: PathType, path_version: PathType):
+    # Atomically repoint the symlink
+    path_tmp = Path(path_root) / f'.{CURRENT_KEY}.{os.getpid()}'
+    if path_tmp.is_symlink():
+        path_tmp.unlink()
+    path_tmp.symlink_to(Path(path_version).name)
+    os.replace(str(path_tmp), str(Path(path_root) / CURRENT_KEY))
+
+
+@contextmanager
+def dir_lock(path_root: PathType, poll_interval: float = 0.1,
+             timeout: float = None):
+    """Exclusive lock on an index directory, across worker processes
+    Polls rather than blocking in `flock` so gevent workers stay responsive
+
+    Raises: TimeoutError if not acquired within `timeout` seconds
+    """
+    Path(path_root).mkdir(parents=True, exist_ok=True)
+    tic = time()
+    with open(Path(path_root) / LOCK_KEY, 'w') as f:
+        while True:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except BlockingIOError:
+                if timeout is not None and time() - tic >= timeout:
+                    raise TimeoutError(f'{path_root} is locked')
+                sleep(poll_interval)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
 def load_via_tar(path_tar: PathType,
-                 path_extract: PathType,
-                 reload: bool = True):
-    path_local_ts_read = path_extract / TIMESTAMP_LOCAL_KEY
-    if reload:
-        # Write to timestamp file
+                 path_root: PathType,
+                 reload: bool = True,
+                 progress: Callable[[int, int], None] = None,
+                 exclude: PathType = None,
+                 ) -> Path:
+    """
+    Extracts the tar into a new versioned directory under `path_root`
+        (never over a directory that may be in use), then points
+        `path_root/current` at it
+
+    If another worker already extracted a version that is fresh,
+        that version is reused instead of downloading again
+
+    Args:
+        path_tar: local or s3 path to the index tarball
+        path_root: directory holding all versions of the index
+        reload: if False, reuse the current version if there is one
+        progress: callback of (bytes read, total bytes)
+        exclude: version that may not be reused (the caller's own,
+            when it is forcing a refresh)
+
+    Returns: path to the version directory
+    """
+    path_root = Path(path_root)
+    with dir_lock(path_root):
+        path_current = current_version(path_root)
+        if path_current is not None and path_current != exclude:
+            if not reload or not needs_reload(path_tar,
+                                              read_ts(path_current)):
+                return path_current
+
         # Note: `fromisoformat` only in Py3.7
         # ts_read = datetime.datetime.utcnow().isoformat()
         ts_read = int(time())
-        if is_s3_path(path_tar):
-            ann_tar = tarfile.open(fileobj=s3.open(path_tar, 'rb'))
-        else:
-            ann_tar = tarfile.open(fileobj=open(path_tar, 'rb'))
-
-        ann_tar.extractall(path_extract)
+        version_name = f'v{ts_read}-{os.getpid()}'
+        n_same = 0
+        while (path_root / version_name).exists():
+            # Reloaded more than once within the same second
+            n_same += 1
+            version_name = f'v{ts_read}-{os.getpid()}-{n_same}'
+        path_partial = path_root / f'.{version_name}.partial'
+        path_version = path_root / version_name
+        shutil.rmtree(path_partial, ignore_errors=True)
 
-        with open(path_local_ts_read, 'w') as f:
+        extract_tar(path_tar, path_partial, progress=progress)
+        build_id_store(path_partial / ANN_IDS_KEY)
+        meta_d = load_ann_meta(path_partial / ANN_META_KEY)
+        if meta_d.get(EXPORT_VECTORS_META_KEY) \
+                and not (path_partial / ANN_VECTORS_KEY).exists():
+            # Tarball without the vector matrix: export it from the index
+            # (one item at a time, so slow for large catalogs: opt-in).
+            # Without it, vectors are read from the index and queries
+            # are not reranked
+            export_vectors(load_index(path_partial / ANN_INDEX_KEY, meta_d),
+                           path_partial / ANN_VECTORS_KEY)
+        if (path_partial / ANN_ATTRS_KEY).exists():
+            build_attributes(path_partial / ANN_ATTRS_KEY,
+                             path_partial / ANN_ATTRS_COMPILED_KEY)
+        with open(path_partial / TIMESTAMP_LOCAL_KEY, 'w') as f:
             f.write(str(ts_read))
 
-    meta_d = load_ann_meta(path_extract / ANN_META_KEY)
-    ann_ids, ann_ids_d = load_ids(path_extract / ANN_IDS_KEY)
-    ann_index_path = path_extract / ANN_INDEX_KEY
+        os.rename(path_partial, path_version)
+        set_current_version(path_root, path_version)
 
-    return ann_index_path, ann_ids, ann_ids_d, path_local_ts_read, meta_d
+    return path_version.resolve()
 
 
 def load_ann_meta(path_meta: PathType) -> Dict:
@@ -104,8 +235,9 @@ def load_ann_meta(path_meta: PathType) -> Dict:
 def load_index(path_index: PathType,
                meta_d: Dict) \
         -> AnnoyIndex:
-    """ We rely on ANNOY's usage of mmap to be fast loading
-    (fast enough that we can load it on every single call)
+    """ We rely on ANNOY's usage of mmap to be fast loading.
+    The returned handle is read-only and can be shared between
+    threads/greenlets, so callers should load once and reuse it
     """
     n_dim = meta_d['n_dim']
     metric = meta_d['metric']
@@ -118,16 +250,19 @@ def load_index(path_index: PathType,
     return u
 
 
-def load_ids(path_ids: PathType) -> Tuple[List[str], Dict[str, int]]:
-    if is_s3_path(path_ids):
-        open_fn = s3.open
-    else:
-        open_fn = open
+def load_ids(path_ids: PathType) -> Tuple[IdStore, IdLookup]:
+    """ Memory-mapped ids (see `build_id_store`), behaving as
+    a list of ids and a dict of {id: index} respectively
+    """
+    ids = IdStore(path_ids)
+    return ids, ids.lookup
 
-    ids = [s.decode('utf-8') for s in
-           open_fn(path_ids, 'rb').read().splitlines()]
-    ids_d = dict(zip(ids, range(len(ids))))
-    return ids, ids_d
+
+def load_vectors(path_vectors: PathType) -> Optional[np.ndarray]:
+    """ Memory-mapped (read-only) item vectors, if there are any """
+    if not Path(path_vectors).exists():
+        return None
+    return np.load(str(path_vectors), mmap_mode='r')
 
 
 def get_dynamo_emb(table,
@@ -140,6 +275,10 @@ def get_dynamo_emb(table,
     except (ClientError, KeyError) as e:
         return None
     else:
-        b_str = item[repr_key].value
-        emb = struct.unpack(DTYPE_FMT * (len(b_str) // DTYPE_SZ), b_str)
+        emb = decode_emb(item[repr_key].value)
     return emb
+
+
+def decode_emb(b_str: bytes) -> Tuple[float, ...]:
+    """Vectors are stored in dynamo as packed float32 bytes"""
+    return struct.unpack(DTYPE_FMT * (len(b_str) // DTYPE_SZ), b_str)
@@ -0,0 +1,108 @@
+from collections import deque
+import threading
+from typing import Optional, Dict
+
+
+class LatencyWindow(object):
+    """Rolling window of the most recent query latencies (in seconds)"""
+
+    def __init__(self, size: int = 1000):
+        self.samples = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.samples)
+
+    def record(self, seconds: float):
+        with self._lock:
+            self.samples.append(seconds)
+
+    def clear(self):
+        with self._lock:
+            self.samples.clear()
+
+    def quantile(self, q: float) -> Optional[float]:
+        with self._lock:
+            samples = sorted(self.samples)
+        if not samples:
+            return None
+        ind = min(int(q * len(samples)), len(samples) - 1)
+        return samples[ind]
+
+
+class SearchKBudget(object):
+    """
+    Caps `search_k` for an index while its p99 latency is over target
+
+    Every `check_every` queries the p99 of the rolling window is compared
+        to the target. If over, the cap is halved (starting from the
+        `search_k` that was last used). If comfortably under, the cap is
+        doubled until it no longer binds, at which point it is lifted.
+        The window is cleared whenever the cap changes so that latencies
+        measured under the previous cap are not held against the new one
+    """
+
+    def __init__(self, target_p99_ms: float,
+                 min_search_k: int = 1,
+                 window: int = 1000,
+                 check_every: int = 100,
+                 ):
+        self.target_p99 = target_p99_ms / 1000.
+        self.min_search_k = min_search_k
+        self.check_every = check_every
+        self.window = LatencyWindow(window)
+
+        self.cap: Optional[int] = None
+        self._last_search_k: int = None
+        self._n_since_check = 0
+        self._lock = threading.Lock()
+
+    def apply(self, search_k: int, k: int, n_trees: int) -> int:
+        # ANNOY's default (-1) inspects `n_trees * k` nodes
+        if search_k is None or search_k <= 0:
+            search_k = n_trees * k
+        self._last_search_k = search_k
+
+        cap = self.cap
+        if cap is None:
+            return search_k
+        else:
+            return min(search_k, max(cap, k))
+
+    def record(self, seconds: float):
+        self.window.record(seconds)
+        with self._lock:
+            self._n_since_check += 1
+            if self._n_since_check >= self.check_every:
+                self._adjust()
+
+    def adjust(self):
+        with self._lock:
+            self._adjust()
+
+    def _adjust(self):
+        # Called holding `self._lock`
+        self._n_since_check = 0
+        if len(self.window) < self.check_every \
+                or self._last_search_k is None:
+            return
+        p99 = self.window.quantile(0.99)
+
+        cap = self.cap
+        if p99 > self.target_p99:
+            cap = max(self.min_search_k,
+                      (cap or self._last_search_k) // 2)
+        elif cap is not None and p99 < self.target_p99 / 2:
+            cap = None if cap * 2 >= self._last_search_k else cap * 2
+
+        if cap != self.cap:
+            self.cap = cap
+            self.window.clear()
+
+    def tojson(self) -> Dict:
+        p99 = self.window.quantile(0.99)
+        return {
+            'target_p99_ms': self.target_p99 * 1000.,
+            'p99_ms': None if p99 is None else p99 * 1000.,
+            'search_k_cap': self.cap,
+        }
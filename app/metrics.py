@@ -0,0 +1,106 @@
+import datetime
+import os
+from typing import Any, Dict, List, Optional
+from prometheus_client import (
+    CollectorRegistry, Counter, Gauge, Histogram, generate_latest,
+    CONTENT_TYPE_LATEST, REGISTRY)
+from prometheus_client import multiprocess
+
+# With several gunicorn workers, each writes its samples to this
+# directory and `/metrics` aggregates them (see run.sh/gunicorn_conf.py)
+MULTIPROC_DIR = os.environ.get('PROMETHEUS_MULTIPROC_DIR') \
+    or os.environ.get('prometheus_multiproc_dir')
+
+LATENCY_BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25,
+                   .5, 1., 2.5, 5.)
+RELOAD_BUCKETS = (1., 5., 10., 30., 60., 120., 300., 600., 1800.)
+STAGES = ('parse', 'vector', 'search', 'serialize')
+
+QUERY_STAGE_SECONDS = Histogram(
+    'ann_query_stage_seconds',
+    'Query latency by stage (parse, vector resolve, ANN search, '
+    'serialization)',
+    ['index', 'stage'], buckets=LATENCY_BUCKETS)
+FALLBACK_DEPTH = Histogram(
+    'ann_fallback_depth',
+    'Number of fallback indexes queried after the first one',
+    ['index'], buckets=(0, 1, 2, 3, 5))
+RESULT_CACHE = Counter(
+    'ann_result_cache_total',
+    'Result cache lookups',
+    ['index', 'result'])  # hit / miss
+FILTERED_QUERIES = Counter(
+    'ann_filtered_queries_total',
+    'Queries with an attribute filter, by how they were searched',
+    ['index', 'path'])  # exact (over the matches) / ann (widened)
+OOI_LOOKUPS = Counter(
+    'ann_ooi_lookups_total',
+    'Out-of-index vector lookups',
+    ['table', 'result'])  # cache_hit / found / not_found / error
+OOI_BATCHES = Counter(
+    'ann_ooi_batches_total',
+    'DynamoDB batch requests for out-of-index vectors',
+    ['table'])
+RELOAD_SECONDS = Histogram(
+    'ann_reload_seconds',
+    'Duration of index (re)loads, including download and warm-up',
+    ['index'], buckets=RELOAD_BUCKETS)
+RELOADS = Counter(
+    'ann_reloads_total',
+    'Index (re)loads',
+    ['index', 'outcome'])  # ok / unchanged / failed
+INDEX_LOADED_TS = Gauge(
+    'ann_index_loaded_timestamp_seconds',
+    'When the served version of an index was downloaded',
+    ['index'], multiprocess_mode='max')
+INDEX_BUILT_TS = Gauge(
+    'ann_index_built_timestamp_seconds',
+    'When the served version of an index was built '
+    '(`timestamp_utc` in its metadata)',
+    ['index'], multiprocess_mode='max')
+
+
+def observe_query(index: str, timings: List[Dict[str, Any]]):
+    """Search/vector stages and fallback depth, from the `timings`
+    collected by `ANNResource.nn_from_payload`
+    """
+    search_s = 0.
+    n_levels = 0
+    for t in timings:
+        if 'vector_ms' in t:
+            QUERY_STAGE_SECONDS.labels(index, 'vector').observe(
+                t['vector_ms'] / 1000.)
+        else:
+            search_s += t['ms'] / 1000.
+            n_levels += 1
+    QUERY_STAGE_SECONDS.labels(index, 'search').observe(search_s)
+    FALLBACK_DEPTH.labels(index).observe(max(n_levels - 1, 0))
+
+
+def parse_timestamp_utc(ts: str) -> Optional[float]:
+    """Epoch seconds of a metadata `timestamp_utc` (isoformat, UTC)"""
+    for fmt in ('%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S'):
+        try:
+            return datetime.datetime.strptime(ts, fmt).replace(
+                tzinfo=datetime.timezone.utc).timestamp()
+        except (TypeError, ValueError):
+            continue
+    return None
+
+
+def latest() -> bytes:
+    """Metrics in the Prometheus text format, aggregated over all
+    workers when running multiprocess
+    """
+    if MULTIPROC_DIR:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry, path=MULTIPROC_DIR)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry)
+
+
+def mark_process_dead(pid: int):
+    """Called by the gunicorn `child_exit` hook"""
+    if MULTIPROC_DIR:
+        multiprocess.mark_process_dead(pid, MULTIPROC_DIR)
@@ -0,0 +1,195 @@
+from typing import Any, Dict, Iterator, List, Optional, Sequence
+import numpy as np
+from .ids import IdStore
+
+
+class Rec(object):
+    __slots__ = ('id_', 'dist')
+
+    def __init__(self, id_, dist=None):
+        self.id_ = id_
+        self.dist = dist
+
+    @property
+    def score(self):
+        """
+        NOTE: This is only for ANNOY's angular distance (which is [0, 2])
+        https://github.com/spotify/annoy/issues/149"""
+
+        if self.dist is None:
+            return None
+        else:
+            return 1. - self.dist / 2.
+
+    def to_dict(self, incl_dist=True, incl_score=True):
+        d = {'id': self.id_}
+        if incl_dist:
+            d['dist'] = self.dist
+        if incl_score:
+            d['score'] = self.score
+        return d
+
+
+class Neighbors(object):
+    """
+    Columnar query result: parallel ids and (optional) distances
+
+    Filtering, dedup, truncation and concatenation work on whole
+        arrays rather than per-neighbor objects. Results straight from
+        an index only hold item indices; ids are decoded from the
+        index's `IdStore` once, when first needed (usually after
+        truncation to `k`).
+    Instances are never modified in place (so they can be cached)
+    """
+    __slots__ = ('_inds', '_store', '_ids', 'dists')
+
+    def __init__(self, ids: List = None,
+                 dists: Optional[np.ndarray] = None,
+                 inds: np.ndarray = None,
+                 store: IdStore = None,
+                 ):
+        self._ids = ids
+        self._inds = inds
+        self._store = store
+        self.dists = None if dists is None \
+            else np.asarray(dists, dtype=np.float64)
+
+    @classmethod
+    def from_ann_out(cls, ann_out, incl_dist: bool, store: IdStore
+                     ) -> 'Neighbors':
+        """From the output of `get_nns_by_item/vector`"""
+        inds, dists = ann_out if incl_dist else (ann_out, None)
+        return cls(inds=np.asarray(inds, dtype=np.int64), dists=dists,
+                   store=store)
+
+    @classmethod
+    def empty(cls) -> 'Neighbors':
+        return cls(ids=[])
+
+    def __len__(self):
+        if self._ids is not None:
+            return len(self._ids)
+        return len(self._inds)
+
+    @property
+    def ids(self) -> List:
+        if self._ids is None:
+            self._ids = self._store.take(self._inds.tolist())
+        return self._ids
+
+    @property
+    def inds(self) -> Optional[np.ndarray]:
+        """Index items, if the neighbors come straight from an index"""
+        return self._inds
+
+    @property
+    def scores(self) -> Optional[np.ndarray]:
+        """NOTE: only meaningful for ANNOY's angular distance (see `Rec`)"""
+        return None if self.dists is None else 1. - self.dists / 2.
+
+    def __iter__(self) -> Iterator[Rec]:
+        dists = [None] * len(self) if self.dists is None \
+            else self.dists.tolist()
+        return (Rec(id_, dist) for id_, dist in zip(self.ids, dists))
+
+    def __getitem__(self, key: slice) -> 'Neighbors':
+        if not isinstance(key, slice):
+            raise TypeError('Neighbors only support slicing')
+        return self.select(key)
+
+    def select(self, sel) -> 'Neighbors':
+        """Subset by a slice, or by a boolean mask / index array"""
+        dists = None if self.dists is None else self.dists[sel]
+        if self._ids is None:
+            return Neighbors(inds=self._inds[sel], dists=dists,
+                             store=self._store)
+        if isinstance(sel, slice):
+            ids = self._ids[sel]
+        else:
+            sel = np.asarray(sel)
+            if sel.dtype == bool:
+                sel = np.flatnonzero(sel)
+            ids = [self._ids[i] for i in sel.tolist()]
+        return Neighbors(ids=ids, dists=dists)
+
+    def without_ind(self, ind: int) -> 'Neighbors':
+        """Drops an index item (ex. the query itself)"""
+        if self._inds is None:
+            return self
+        return self.select(self._inds != ind)
+
+    def without_inds(self, inds: np.ndarray) -> 'Neighbors':
+        """Drops index items (`inds` sorted, ex. tombstones)"""
+        if self._inds is None:
+            raise ValueError('Neighbors without index items')
+        if not len(inds) or not len(self):
+            return self
+        pos = np.minimum(np.searchsorted(inds, self._inds), len(inds) - 1)
+        return self.select(inds[pos] != self._inds)
+
+    def without_ids(self, ids: Sequence) -> 'Neighbors':
+        exclude = set(ids)
+        if not exclude:
+            return self
+        return self.select(np.fromiter(
+            (id_ not in exclude for id_ in self.ids),
+            dtype=bool, count=len(self)))
+
+    def above_score(self, thresh_score: float) -> 'Neighbors':
+        if self.dists is None:
+            raise ValueError('Scores need distances')
+        return self.select(self.scores > thresh_score)
+
+    def dedup(self) -> 'Neighbors':
+        """Keeps the first occurrence of each id"""
+        seen = set()
+        keep = np.zeros(len(self), dtype=bool)
+        for i, id_ in enumerate(self.ids):
+            if id_ not in seen:
+                seen.add(id_)
+                keep[i] = True
+        return self if keep.all() else self.select(keep)
+
+    def concat(self, other: 'Neighbors') -> 'Neighbors':
+        if not len(other):
+            return self
+        if not len(self):
+            return other
+        if self._ids is None and other._ids is None \
+                and self._store is other._store:
+            inds = np.concatenate([self._inds, other._inds])
+            ids = None
+        else:
+            inds = None
+            ids = self.ids + other.ids
+        dists = None if self.dists is None or other.dists is None \
+            else np.concatenate([self.dists, other.dists])
+        return Neighbors(ids=ids, dists=dists, inds=inds,
+                         store=self._store if ids is None else None)
+
+    def to_dicts(self, incl_dist: bool = True, incl_score: bool = True
+                 ) -> List[Dict[str, Any]]:
+        ids = self.ids
+        if not (incl_dist or incl_score):
+            return [{'id': id_} for id_ in ids]
+        if self.dists is None:
+            dists = scores = [None] * len(ids)
+        else:
+            dists, scores = self.dists.tolist(), self.scores.tolist()
+        if not incl_score:
+            return [{'id': id_, 'dist': d} for id_, d in zip(ids, dists)]
+        if not incl_dist:
+            return [{'id': id_, 'score': s} for id_, s in zip(ids, scores)]
+        return [{'id': id_, 'dist': d, 'score': s}
+                for id_, d, s in zip(ids, dists, scores)]
+
+    def to_columns(self, incl_dist: bool = True, incl_score: bool = True
+                   ) -> Dict[str, List]:
+        cols = {'ids': self.ids}
+        if incl_dist:
+            cols['dists'] = None if self.dists is None \
+                else self.dists.tolist()
+        if incl_score:
+            scores = self.scores
+            cols['scores'] = None if scores is None else scores.tolist()
+        return cols
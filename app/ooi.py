@@ -0,0 +1,190 @@
+from concurrent.futures import Future
+import threading
+from time import sleep
+from typing import Dict, Hashable, Iterable, List, Optional, Tuple
+from .cache import ResultCache
+from .io import decode_emb, DYNAMO_KEY
+from . import metrics
+import logging
+
+logging.basicConfig(level=logging.INFO)
+
+MAX_BATCH_GET = 100  # DynamoDB limit of keys per `batch_get_item`
+MAX_UNPROCESSED_RETRIES = 5
+
+Emb = Tuple[float, ...]
+
+
+class DynamoVectorStore(object):
+    """
+    Out-of-index vector lookups from a DynamoDB table
+
+    - Concurrent lookups (from any thread/greenlet) arriving within
+        `coalesce_ms` of each other are sent as one `batch_get_item`
+    - Found vectors are kept in a bounded LRU cache, and ids that are
+        missing from the table are negatively cached for a while
+    - The table's client (and so its connection pool) is shared
+        by every index using the store
+    """
+
+    def __init__(self, table,
+                 repr_key: str = DYNAMO_KEY,
+                 cache_size: int = 100000,
+                 cache_ttl_s: float = None,
+                 negative_cache_size: int = 100000,
+                 negative_ttl_s: float = 300,
+                 coalesce_ms: float = 2,
+                 ):
+        self.table = table
+        # Client of the dynamo resource: (de)serializes attribute values
+        self.client = table.meta.client
+        self.id_key = table.key_schema[0]['AttributeName']
+        self.repr_key = repr_key
+        self.coalesce_s = coalesce_ms / 1000.
+
+        self.cache = ResultCache(cache_size, ttl_s=cache_ttl_s) \
+            if cache_size > 0 else None
+        self.negative_cache = ResultCache(negative_cache_size,
+                                          ttl_s=negative_ttl_s) \
+            if negative_cache_size > 0 else None
+
+        self._pending: Dict[Hashable, Future] = {}
+        self._flush_scheduled = False
+        self._lock = threading.Lock()
+        self.n_batches = 0
+        self.n_keys_fetched = 0
+
+    @property
+    def name(self) -> str:
+        return self.table.name
+
+    def _cached(self, id_) -> Tuple[bool, Optional[Emb]]:
+        """Returns (hit, emb)"""
+        if self.cache is not None:
+            emb = self.cache.get(id_)
+            if emb is not None:
+                return True, emb
+        if self.negative_cache is not None \
+                and self.negative_cache.get(id_) is not None:
+            return True, None
+        return False, None
+
+    def get(self, id_) -> Optional[Emb]:
+        return self.get_many([id_])[id_]
+
+    def get_many(self, ids: Iterable) -> Dict[Hashable, Optional[Emb]]:
+        """Vectors for `ids` (None for ids that are not in the table)"""
+        res = {}
+        futures = {}
+        leader = False
+        with self._lock:
+            for id_ in ids:
+                if id_ in res or id_ in futures:
+                    continue
+                hit, emb = self._cached(id_)
+                if hit:
+                    metrics.OOI_LOOKUPS.labels(self.name, 'cache_hit').inc()
+                    res[id_] = emb
+                    continue
+                fut = self._pending.get(id_)
+                if fut is None:
+                    fut = self._pending[id_] = Future()
+                futures[id_] = fut
+            if futures and not self._flush_scheduled:
+                # First caller in the window flushes for everyone
+                self._flush_scheduled = True
+                leader = True
+
+        if leader:
+            if self.coalesce_s > 0:
+                sleep(self.coalesce_s)
+            self._flush()
+
+        for id_, fut in futures.items():
+            res[id_] = fut.result()
+        return res
+
+    def _flush(self):
+        pending = {}
+        try:
+            with self._lock:
+                pending, self._pending = self._pending, {}
+                self._flush_scheduled = False
+            self._resolve(pending)
+        finally:
+            # Whatever failed, never leave a waiter blocked in `get_many`
+            unresolved = [fut for fut in pending.values() if not fut.done()]
+            if unresolved:
+                error = RuntimeError('OOI batch lookup did not complete')
+                for fut in unresolved:
+                    fut.set_exception(error)
+
+    def _resolve(self, pending: Dict[Hashable, Future]):
+        ids = list(pending)
+        for i in range(0, len(ids), MAX_BATCH_GET):
+            chunk = ids[i:i + MAX_BATCH_GET]
+            try:
+                found = self._batch_get(chunk)
+            except Exception as e:
+                logging.warning(f'OOI batch lookup failed: {e}')
+                metrics.OOI_LOOKUPS.labels(self.name, 'error').inc(len(chunk))
+                # Not cached, so the next lookup tries again
+                for id_ in chunk:
+                    pending[id_].set_result(None)
+                continue
+
+            metrics.OOI_LOOKUPS.labels(self.name, 'found').inc(len(found))
+            metrics.OOI_LOOKUPS.labels(self.name, 'not_found').inc(
+                len(chunk) - len(found))
+            for id_ in chunk:
+                emb = found.get(id_)
+                if emb is not None and self.cache is not None:
+                    self.cache.put(id_, emb)
+                elif emb is None and self.negative_cache is not None:
+                    self.negative_cache.put(id_, True)
+                pending[id_].set_result(emb)
+
+    def _batch_get(self, ids: List) -> Dict[Hashable, Emb]:
+        self.n_batches += 1
+        self.n_keys_fetched += len(ids)
+        metrics.OOI_BATCHES.labels(self.name).inc()
+        request = {self.table.name: {
+            'Keys': [{self.id_key: id_} for id_ in ids],
+            'ProjectionExpression': '#id, #repr',
+            'ExpressionAttributeNames': {
+                '#id': self.id_key, '#repr': self.repr_key},
+        }}
+        found = {}
+        for attempt in range(MAX_UNPROCESSED_RETRIES + 1):
+            response = self.client.batch_get_item(RequestItems=request)
+            for item in response['Responses'].get(self.table.name, []):
+                found[item[self.id_key]] = decode_emb(
+                    item[self.repr_key].value)
+
+            request = response.get('UnprocessedKeys')
+            if not request:
+                break
+            # Throttled: back off before asking for the rest
+            sleep(0.01 * 2 ** attempt)
+        else:
+            logging.warning('OOI lookup gave up on unprocessed keys')
+        return found
+
+    def tojson(self) -> Dict:
+        return {
+            'table': self.name,
+            'n_batches': self.n_batches,
+            'n_keys_fetched': self.n_keys_fetched,
+            'cache': (self.cache.tojson()
+                      if self.cache is not None else None),
+            'negative_cache': (self.negative_cache.tojson()
+                               if self.negative_cache is not None else None),
+        }
+
+
+def as_vector_store(table_or_store) -> Optional[DynamoVectorStore]:
+    """Accept either a dynamo `Table` or an already built store"""
+    if table_or_store is None or \
+            isinstance(table_or_store, DynamoVectorStore):
+        return table_or_store
+    return DynamoVectorStore(table_or_store)
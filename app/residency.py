@@ -0,0 +1,107 @@
+import ctypes
+import ctypes.util
+import mmap
+import os
+import weakref
+from pathlib import Path
+from typing import Dict, Optional, Union
+import numpy as np
+import logging
+
+logging.basicConfig(level=logging.INFO)
+
+PathType = Union[Path, str]
+PAGE_SZ = mmap.PAGESIZE
+MAP_FAILED = ctypes.c_void_p(-1).value
+
+_libc = None
+
+
+def _get_libc():
+    global _libc
+    if _libc is None:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        libc.mmap.restype = ctypes.c_void_p
+        libc.mmap.argtypes = [ctypes.c_void_p, ctypes.c_size_t,
+                              ctypes.c_int, ctypes.c_int,
+                              ctypes.c_int, ctypes.c_long]
+        libc.munmap.argtypes = [ctypes.c_void_p, ctypes.c_size_t]
+        libc.mlock.argtypes = [ctypes.c_void_p, ctypes.c_size_t]
+        _libc = libc
+    return _libc
+
+
+class LockedMapping(object):
+    """
+    Read-only shared mapping of a file whose pages are `mlock`ed.
+    Since the mapping is shared, this pins the page cache pages that
+        every other mapping of the file (ex. ANNOY's) uses too.
+    Unmapped (and so unlocked) once garbage collected
+    """
+
+    def __init__(self, path: PathType):
+        libc = _get_libc()
+        with open(path, 'rb') as f:
+            self.size = os.fstat(f.fileno()).st_size
+            addr = libc.mmap(None, self.size, mmap.PROT_READ,
+                             mmap.MAP_SHARED, f.fileno(), 0)
+        if addr in (None, MAP_FAILED):
+            raise OSError(ctypes.get_errno(), f'mmap failed for {path}')
+        self.addr = addr
+        weakref.finalize(self, libc.munmap, addr, self.size)
+
+        if libc.mlock(addr, self.size) != 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, f'mlock failed for {path}: '
+                                 f'{os.strerror(errno)}')
+
+
+def warm_file(path: PathType, mlock: bool = False
+              ) -> Optional[LockedMapping]:
+    """
+    Pulls a file into the page cache and touches every page,
+        so the first queries after a (re)load do not fault on cold pages
+
+    Args:
+        path: file to warm (ex. `index.ann`)
+        mlock: additionally lock the pages in RAM. Needs CAP_IPC_LOCK
+            or a large enough RLIMIT_MEMLOCK; failures are only logged
+
+    Returns: the locked mapping (keep a reference to it for as long as
+        the pages should stay locked), or None
+    """
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return None
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_WILLNEED)
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    # One byte per page is enough to fault it in
+    buf = np.frombuffer(mm, dtype=np.uint8)
+    int(buf[::PAGE_SZ].sum())
+    del buf
+    mm.close()
+
+    if mlock:
+        try:
+            return LockedMapping(path)
+        except OSError as e:
+            logging.warning(f'Could not lock {path} in memory: {e}')
+    return None
+
+
+def rss_info() -> Dict[str, float]:
+    """Memory of this process in MB (Linux), split into
+    anonymous (private to the worker) and file-backed/shared pages
+    """
+    info = {}
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                key, _, value = line.partition(':')
+                if key in ('VmRSS', 'RssAnon', 'RssFile', 'RssShmem'):
+                    info[key] = int(value.split()[0]) / 1024.  # kB -> MB
+    except FileNotFoundError:
+        pass
+    return info
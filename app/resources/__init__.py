@@ -1,7 +1,9 @@
 from .ann import ANNResource
+from .batch import BatchANNResource
 from .cross import CrossANNResource
+from .fanout import FanoutANNResource
 from .refresh import RefreshResource, MaybeRefreshAllResource
 from .health import (
     ANNHealthcheckResource, HealthcheckResource,
-    TmpSpaceResource, SleepResource)
+    TmpSpaceResource, SleepResource, WorkerResource, MetricsResource)
 from .scoring import ScoringResource
@@ -2,12 +2,28 @@ import falcon
 from annoy import AnnoyIndex
 import json
 from time import time
-from typing import Dict, List, Union, Any, Optional
+from typing import Callable, Dict, List, Tuple, Union, Any, Optional
 import boto3
 import s3fs
 import datetime
+import threading
+import numpy as np
 from pathlib import Path
-from ..io import needs_reload, load_via_tar, load_index, get_dynamo_emb
+from ..io import (
+    needs_reload, load_via_tar, current_version, read_ts, path_exists,
+    read_bytes)
+from ..latency import SearchKBudget, LatencyWindow
+from ..ids import IdStore, IdLookup
+from ..versions import IndexVersion
+from ..cache import ResultCache
+from ..disk import DiskManager
+from ..delta import Delta, delta_path
+from ..neighbors import Neighbors
+from ..ooi import DynamoVectorStore, as_vector_store
+from ..vectors import exact_dists, rank_order, EXACT_METRICS
+from .. import metrics
+from ..encoding import (
+    negotiate, recs_body, set_body, set_vector_body, VECTOR_FORMATS)
 import logging
 
 logging.basicConfig(level=logging.INFO)
@@ -25,6 +41,20 @@ DYNAMO_ID = 'variant_id'
 DYNAMO_KEY = 'repr'
 DTYPE_FMT = 'f'  # float32 struct
 SEED = 322
+POST_SWAP_WINDOW_S = 60  # latency is tracked separately right after a swap
+REC_SZ_EST = 100  # rough bytes held per cached neighbor
+RERANK_OVERSAMPLE = 4  # candidates fetched per neighbor when reranking
+LAZY_RETRY_S = 60  # a lazy index that failed loading is retried after this
+NOT_READY_RETRY_S = 5  # `Retry-After` of queries to an index still loading
+# Filtered queries: exact search over the matching items when at most
+# this many match
+FILTER_BRUTE_FORCE_MAX = 20000
+# Filters and `exclude_ids`: the ANN search is widened (by this factor
+# per round, up to this many candidates and this `search_k`) until `k`
+# of its results are kept
+FETCH_GROWTH = 4
+FETCH_MAX_N = 10000
+FETCH_MAX_SEARCH_K = 1000000
 
 PathType = Union[Path, str]
 
@@ -32,30 +62,30 @@ s3 = s3fs.S3FileSystem()
 dynamodb = boto3.resource('dynamodb')
 
 
-class Rec(object):
-
-    def __init__(self, id_, dist=None):
-        self.id_ = id_
-        self.dist = dist
-
-    @property
-    def score(self):
-        """
-        NOTE: This is only for ANNOY's angular distance (which is [0, 2])
-        https://github.com/spotify/annoy/issues/149"""
-
-        if self.dist is None:
-            return None
-        else:
-            return 1. - self.dist / 2.
+def fetch_until(search_fn: Callable[[int, int], Neighbors],
+                keep_fn: Callable[[Neighbors], Neighbors],
+                k: int, n: int, max_n: int, search_k: int = -1,
+                max_search_k: int = FETCH_MAX_SEARCH_K) -> Neighbors:
+    """
+    Searches for `n` candidates, then more (`FETCH_GROWTH` times as
+        many per round, with `search_k` scaled along, up to
+        `max_search_k`) until `k` of them are kept, the index has no
+        more, or `max_n` were fetched
 
-    def to_dict(self, incl_dist=True, incl_score=True):
-        d = {'id': self.id_}
-        if incl_dist:
-            d['dist'] = self.dist
-        if incl_score:
-            d['score'] = self.score
-        return d
+    Args:
+        search_fn: (n, search_k) -> up to `n` nearest neighbors
+        keep_fn: neighbors -> those that are kept
+    """
+    n = max(min(n, max_n), k)
+    while True:
+        search_k_n = search_k if search_k <= 0 \
+            else min(max(search_k, search_k * n // max(k, 1)),
+                     max(max_search_k, search_k))
+        found = search_fn(n, search_k_n)
+        kept = keep_fn(found)
+        if len(kept) >= k or len(found) < n or n >= max_n:
+            return kept[:k]
+        n = min(n * FETCH_GROWTH, max_n)
 
 
 class ANNResource(object):
@@ -63,190 +93,794 @@ class ANNResource(object):
     def __init__(self, path_tar: PathType,
                  ooi_dynamo_table: dynamodb.Table = None,
                  name: str = None,
+                 latency_target_ms: float = None,
+                 defer_load: bool = False,
+                 warm_pages: bool = True,
+                 mlock: bool = False,
+                 result_cache: ResultCache = None,
+                 disk: DiskManager = None,
+                 lazy: bool = False,
+                 pinned: bool = False,
                  ):
         """
 
         Args:
             path_tar: path to tar file with ann index and metadata
-            ooi_dynamo_table: dynamo table for out of index lookup
+            ooi_dynamo_table: dynamo table (or a `DynamoVectorStore`
+                shared with other resources) for out of index lookup
             name:
+            latency_target_ms: if set, `search_k` is capped while the
+                p99 query latency of this index is over this target
+                (overridden by `latency_target_ms` in the index metadata)
+            defer_load: if True, do not load on construction.
+                Queries get a 503 until `load_initial` has completed
+            warm_pages: touch every page of a newly loaded index before
+                it is swapped in, so first queries do not hit cold pages
+            mlock: lock the pages of the served index in RAM
+            result_cache: optional cache of `nn_from_id` results,
+                cleared whenever a new version is swapped in
+            disk: disk accounting shared by all resources; over its
+                budget, this index may be evicted if it is not queried
+            lazy: load (with `defer_load`) on the first query, and again
+                on the next query after an eviction
+            pinned: never evicted
         """
         self.path_tar = path_tar
-        self.ooi_dynamo_table = ooi_dynamo_table
+        self.ooi_dynamo_table: Optional[DynamoVectorStore] = \
+            as_vector_store(ooi_dynamo_table)
         self.name = name
+        self.latency_target_ms = latency_target_ms
+        self.search_k_budget: SearchKBudget = None
+        self.warm_pages = warm_pages
+        self.mlock = mlock
+        self.result_cache = result_cache
+        self.disk = disk
+        self.lazy = lazy
+        self.pinned = pinned
+        self.last_query_at = 0.
+        if disk is not None:
+            disk.register(self)
+
+        # Loaded once per worker and shared by all greenlets/threads.
+        # `load` swaps in a new version (index handle, ids, metadata)
+        # with a single assignment; queries in flight keep a reference
+        # to the old version (and its mmaps) until they finish
+        self._version: IndexVersion = None
+        self._load_lock = threading.Lock()
+        self.swap_stats: Dict[str, Any] = None
+        self._swapped_at: float = 0.
+        self.post_swap_latency = LatencyWindow(size=10000)
+        # -> loading -> ready (or failed), ready -> evicted
+        self.state = 'pending'
+        self.load_progress: Tuple[int, int] = None  # (bytes read, total)
+        self.load_error: str = None
+        self._failed_at: float = 0.
+        self._delta_ts: datetime.datetime = None
 
-        # not multithread-safe to do this with multiple indexes per server
-        # self.index: AnnoyIndex = None
-
-        self.path_index_local: str = None
-        self.ids: List[Any] = None
-        self.ids_d: Dict[Any, int] = None
-        self.ann_meta_d: Dict[str, Any] = None
         self.fallback_parent: 'ANNResource' = None
         self.ooi_ann: 'ANNResource' = None
 
-        # There is a chance that the ANN is already downloaded in tmp
-        self.load(reload=needs_reload(self.path_tar, self.ts_read_utc))
+        if not defer_load:
+            self.load_initial()
 
     @property
-    def path_extract(self) -> PathType:
+    def path_root(self) -> Path:
+        """Directory holding the extracted versions of this index"""
         ann_name = self.name or Path(self.path_tar).stem.split('.')[0]
         return PATH_TMP / ann_name
 
+    @property
+    def label(self) -> str:
+        """Name of the index in metrics"""
+        return self.path_root.name
+
     @property
     def ts_read_utc(self) -> Optional[datetime.datetime]:
-        path_local_ts_read = self.path_extract / TIMESTAMP_LOCAL_KEY
-        if not Path(path_local_ts_read).exists():
-            local_mtime = None
-        else:
-            local_mtime = datetime.datetime.fromtimestamp(
-                int(open(path_local_ts_read, 'r').read().strip()),
-                tz=datetime.timezone.utc)
-        return local_mtime
+        if self._version is not None:
+            return self._version.ts_read
+        # There is a chance that the ANN is already downloaded in tmp
+        path_current = current_version(self.path_root)
+        return read_ts(path_current) if path_current else None
 
     @property
     def needs_reload(self):
         return needs_reload(self.path_tar, self.ts_read_utc)
 
+    @property
+    def version(self) -> IndexVersion:
+        return self._version
+
     @property
     def ann_index(self) -> AnnoyIndex:
-        return load_index(self.path_index_local, self.ann_meta_d)
+        return self._version.ann_index
+
+    @property
+    def ids(self) -> IdStore:
+        return self._version.ids
+
+    @property
+    def ids_d(self) -> IdLookup:
+        return self._version.ids_d
+
+    @property
+    def ann_meta_d(self) -> Dict[str, Any]:
+        return self._version.ann_meta_d
+
+    @property
+    def path_index_local(self) -> Path:
+        return self._version.path_index
 
-    def load(self, path_tar: str = None, reload: bool = True):
+    @property
+    def ready(self) -> bool:
+        return self._version is not None
+
+    def status(self) -> Dict[str, Any]:
+        """Loading progress (for the service healthcheck)"""
+        progress = None
+        if self.state == 'ready':
+            progress = 1.
+        elif self.load_progress is not None and self.load_progress[1]:
+            progress = self.load_progress[0] / self.load_progress[1]
+        return {
+            'state': self.state,
+            'progress': progress,
+            'error': self.load_error,
+        }
+
+    def load_initial(self):
+        self.load(reload=self.needs_reload)
+
+    def _set_load_progress(self, bytes_read: int, bytes_total: int):
+        self.load_progress = (bytes_read, bytes_total)
+
+    @property
+    def _failed_recently(self) -> bool:
+        return self.state == 'failed' \
+            and time() - self._failed_at < LAZY_RETRY_S
+
+    def ensure_loaded(self) -> bool:
+        """Loads a lazy index that is not loaded yet (concurrent first
+        queries all wait for the same load)
+
+        Returns: whether the index is ready
+        """
+        if self.ready or not self.lazy or self._failed_recently:
+            return self.ready
+        try:
+            self.load(if_needed=True)
+        except Exception as e:
+            logging.error(f'Failed loading [{self.name}] on demand: {e}')
+        return self.ready
+
+    def ensure_loading(self) -> bool:
+        """Like `ensure_loaded`, but loads in the background instead of
+        waiting for it
+
+        Returns: whether the index is ready
+        """
+        if self.ready or not self.lazy or self._failed_recently \
+                or self.state == 'loading':
+            return self.ready
+        threading.Thread(target=self.ensure_loaded, daemon=True).start()
+        return False
+
+    def load(self, path_tar: str = None, reload: bool = True,
+             if_needed: bool = False):
+        """
+        Args:
+            path_tar: tarball to load instead of `self.path_tar`
+            reload: if False, reuse the extracted version if there is one
+            if_needed: only load if not loaded yet (by the time the
+                lock is acquired), reloading only if stale
+        """
         path_tar = path_tar or self.path_tar
+        # Serialize concurrent (re)loads of the same index
+        with self._load_lock:
+            if if_needed:
+                if self.ready or self._failed_recently:
+                    # Loaded (or failed) while waiting for the lock
+                    return
+                reload = self.needs_reload
+            if not self.ready:
+                self.state = 'loading'
+            self.load_progress = None
+            tic = time()
+            try:
+                swapped = self._load(path_tar, reload)
+            except Exception as e:
+                metrics.RELOADS.labels(self.label, 'failed').inc()
+                self.load_error = str(e)
+                self._failed_at = time()
+                if not self.ready:
+                    self.state = 'failed'
+                raise
+            else:
+                if swapped:
+                    metrics.RELOADS.labels(self.label, 'ok').inc()
+                    metrics.RELOAD_SECONDS.labels(self.label).observe(
+                        time() - tic)
+                else:
+                    metrics.RELOADS.labels(self.label, 'unchanged').inc()
+                self.load_error = None
+                self.state = 'ready'
+        if self.disk is not None:
+            # Outside of the load lock: evicting takes other indexes' locks
+            self.disk.enforce(keep=self)
+
+    def evict(self, free_disk: bool = False):
+        """Unloads the index (this worker's version of it)
+        Queries get a 503 until it is loaded again (by a refresh, or by
+            the next query if the index is lazy)
+
+        Args:
+            free_disk: also remove its files, even though other workers
+                may still serve them (they then download it again).
+                Otherwise they are removed once no longer `current`
+        """
+        with self._load_lock:
+            version = self._version
+            if version is None:
+                return
+            self._version = None
+            self.state = 'evicted'
+            self.load_progress = None
+            if self.result_cache is not None:
+                self.result_cache.clear()
+        if free_disk and self.disk is not None:
+            self.disk.evict_version(version.path)
+
+    def _load(self, path_tar: str, reload: bool) -> bool:
+        """Returns: whether a new version was swapped in"""
         tic = time()
         logging.info(f'Loading: {path_tar}')
-        self.path_index_local, self.ids, self.ids_d, \
-            ts_read, self.ann_meta_d = \
-            load_via_tar(path_tar, self.path_extract, reload)
+        version_prev = self._version
+        path_version = load_via_tar(
+            path_tar, self.path_root, reload,
+            progress=self._set_load_progress,
+            # Forced reloads may not settle for the version we already have
+            exclude=version_prev.path if version_prev and reload else None,
+        )
+        if version_prev is not None and path_version == version_prev.path:
+            logging.info(f'...Already up to date [{version_prev.name}]')
+            return False
+
+        version = IndexVersion(path_version, disk=self.disk)
+        if self.disk is not None:
+            self.disk.add(path_version)
+        self._load_delta(version)
+        load_s = time() - tic
+        warmup_s = version.warm_up(
+            touch_pages=self.warm_pages, mlock=self.mlock)
+
+        # Do not `unload` the previous index: it is released (and its
+        # directory removed) once the last in-flight query drops it
+        tic_swap = time()
+        self._version = version
+        swap_s = time() - tic_swap
+        self.post_swap_latency = LatencyWindow(size=10000)
+        self._swapped_at = time()
+        if self.result_cache is not None:
+            # Keys include the version too, this just frees the memory
+            self.result_cache.clear()
+        self.swap_stats = {
+            'version': version.name,
+            'prev_version': version_prev.name if version_prev else None,
+            'load_s': load_s,
+            'warmup_s': warmup_s,
+            'swap_ms': swap_s * 1000.,
+            'swapped_at': datetime.datetime.utcnow().isoformat(),
+        }
+
+        metrics.INDEX_LOADED_TS.labels(self.label).set(
+            version.ts_read.timestamp())
+        ts_built = metrics.parse_timestamp_utc(
+            version.ann_meta_d.get('timestamp_utc'))
+        if ts_built is not None:
+            metrics.INDEX_BUILT_TS.labels(self.label).set(ts_built)
+
+        latency_target_ms = version.ann_meta_d.get(
+            'latency_target_ms', self.latency_target_ms)
+        if latency_target_ms:
+            self.search_k_budget = SearchKBudget(latency_target_ms)
+        else:
+            self.search_k_budget = None
         logging.info(f'...Done Loading! [{time() - tic} s]')
+        return True
+
+    @property
+    def default_search_k(self) -> int:
+        """Per-index default from metadata (-1 is ANNOY's default)"""
+        return int(self.ann_meta_d.get('search_k', -1))
+
+    def search_k_for(self, k: int, version: IndexVersion = None) -> int:
+        """Default `search_k` of a query for `k` neighbors
+
+        A `search_k` tuned at build time (see `build_index.py`) meets the
+            target recall for `tuning.k` neighbors, so it is scaled up
+            for larger `k` (as ANNOY's own default, `n_trees * k`, is)
+        """
+        meta_d = (version or self._version).ann_meta_d
+        search_k = int(meta_d.get('search_k', -1))
+        k_tuned = (meta_d.get('tuning') or {}).get('k')
+        if search_k > 0 and k_tuned and k > k_tuned:
+            search_k = search_k * k // k_tuned
+        return search_k
 
     def maybe_reload(self):
+        if self.state in ('loading', 'evicted') \
+                or (self.lazy and not self.ready):
+            # Initial load still in progress, evicted to free disk,
+            # or lazy and not queried since
+            return
         if self.needs_reload:
             logging.info(f'Reloading [{self.path_tar}] due to staleness')
             self.load(reload=True)
+        elif self.delta_needs_reload:
+            logging.info(f'Reloading delta of [{self.path_tar}]')
+            self.load_delta()
 
-    def recs_via_ann_out(self, ann_out, incl_dist) -> List[Rec]:
-        """Convenience fn for constructing rec objects
+    @property
+    def delta_needs_reload(self) -> bool:
+        version = self._version
+        if version is None:
+            return False
+        path_delta = delta_path(self.path_tar)
+        if not path_exists(path_delta):
+            return version.delta is not None
+        return self._delta_ts is None \
+            or needs_reload(path_delta, self._delta_ts)
+
+    def load_delta(self):
+        """Reloads the delta of the served version (the base index is
+        kept: bandwidth and memory scale with the size of the change)
+        """
+        with self._load_lock:
+            if self._version is not None:
+                self._load_delta(self._version)
+
+    def _load_delta(self, version: IndexVersion):
+        path_delta = delta_path(self.path_tar)
+        ts_read = datetime.datetime.now(datetime.timezone.utc)
+        delta = None
+        if path_exists(path_delta):
+            delta = Delta.from_bytes(
+                read_bytes(path_delta), version.ids, version.ann_meta_d,
+                name=f'{Path(path_delta).name}@{ts_read.isoformat()}')
+            if delta is None:
+                logging.info(f'Ignoring {path_delta}: made for another base')
+        # Queries read `version.delta` once, so this swaps it atomically
+        version.delta = delta
+        self._delta_ts = ts_read
+
+    def recs_via_ann_out(self, ann_out, incl_dist,
+                         version: IndexVersion = None) -> Neighbors:
+        """Convenience fn for constructing the (columnar) result
         from ann output
         """
-        if incl_dist:
-            inds, dists = ann_out
-        else:
-            inds = ann_out
-            dists = [None] * len(inds)
-        ids = [self.ids[ind] for ind in inds]
-        neighbors = [
-            Rec(id_, dist) for id_, dist in zip(ids, dists)
-        ]
+        version = version or self._version
+        return Neighbors.from_ann_out(ann_out, incl_dist, version.ids)
+
+    def nn_from_emb(self, q_emb, k: int, version: IndexVersion = None,
+                    incl_dist=False, search_k: int = -1,
+                    ) -> Neighbors:
+        version = version or self._version
+        ann_out = version.ann_index.get_nns_by_vector(
+            q_emb, k, search_k=search_k, include_distances=incl_dist)
+        neighbors = self.recs_via_ann_out(ann_out, incl_dist, version)
         return neighbors
 
-    def nn_from_emb(self, q_emb, k: int, ann_index=None, incl_dist=False
-                    ) -> List[Rec]:
-        ann_index = ann_index or self.ann_index
-        ann_out = ann_index.get_nns_by_vector(
-            q_emb, k, include_distances=incl_dist)
-        neighbors = self.recs_via_ann_out(ann_out, incl_dist)
+    def nn_from_id(self, q_id: str, k: int, version: IndexVersion = None,
+                   incl_dist=False, search_k: int = -1,
+                   q_emb_fn: Callable[[], Any] = None) -> Neighbors:
+        """
+        Args:
+            q_emb_fn: if the id is out of index, gives its vector
+                (ex. resolved once for a whole fallback chain) instead
+                of this resource's own out-of-index lookup
+        """
+        version = version or self._version
+        cache = self.result_cache
+        if cache is None:
+            return self._nn_from_id(
+                q_id, k, version, incl_dist, search_k, q_emb_fn)
+
+        key = (version.name, q_id, k, search_k, incl_dist)
+        neighbors = cache.get(key)
+        metrics.RESULT_CACHE.labels(
+            self.label, 'miss' if neighbors is None else 'hit').inc()
+        if neighbors is None:
+            neighbors = self._nn_from_id(
+                q_id, k, version, incl_dist, search_k, q_emb_fn)
+            # `Neighbors` are never modified in place, so safe to share
+            cache.put(key, neighbors, size=REC_SZ_EST * len(neighbors))
         return neighbors
 
-    def nn_from_id(self, q_id: str, k: int, ann_index=None, incl_dist=False):
-        ann_index = ann_index or self.ann_index
-        if q_id in self.ids_d:
-            q_ind = self.ids_d[q_id]
+    def _nn_from_id(self, q_id: str, k: int, version: IndexVersion,
+                    incl_dist: bool, search_k: int,
+                    q_emb_fn: Callable[[], Any] = None) -> Neighbors:
+        q_ind = version.ids.find(q_id)
+        if q_ind >= 0:
             # Note: if id in index, query 1 more than you need and discard 1st
 
-            ann_out = ann_index.get_nns_by_item(
-                q_ind, k + 1, include_distances=incl_dist)
-            neighbors = self.recs_via_ann_out(ann_out, incl_dist)
+            ann_out = version.ann_index.get_nns_by_item(
+                q_ind, k + 1, search_k=search_k, include_distances=incl_dist)
+            neighbors = self.recs_via_ann_out(
+                ann_out, incl_dist, version).without_ind(q_ind)
 
+        elif q_emb_fn is not None:
+            q_emb = q_emb_fn()
+            if q_emb is None:
+                raise Exception(f'Q is ooi and was not found: {q_id}')
+            neighbors = self.nn_from_emb(
+                q_emb, k, version=version, incl_dist=incl_dist,
+                search_k=search_k)
         elif self.ooi_dynamo_table is not None:
             # Need to look up the vector and query by vector
-            q_emb = get_dynamo_emb(self.ooi_dynamo_table, q_id)
+            q_emb = self.ooi_dynamo_table.get(q_id)
             if q_emb is None:
                 raise Exception(
                     'Q is ooi and doesnt exist in the ooi dynamo table')
             neighbors = self.nn_from_emb(
-                q_emb, k, ann_index=ann_index, incl_dist=incl_dist)
-        elif self.ooi_ann is not None:
+                q_emb, k, version=version, incl_dist=incl_dist,
+                search_k=search_k)
+        elif self.ooi_ann is not None and self.ooi_ann.ensure_loaded():
             # Need to look up the vector and query by vector
             q_emb = self.ooi_ann.get_vector(q_id)
             if q_emb is None:
                 raise Exception(
                     'Q is ooi and doesnt exist in the ooi ann')
             neighbors = self.nn_from_emb(
-                q_emb, k, ann_index=ann_index, incl_dist=incl_dist)
+                q_emb, k, version=version, incl_dist=incl_dist,
+                search_k=search_k)
         else:
             # TODO: there's a chance Q is in the fallback parent index
             # TODO: depending on how the indexes were created
             raise Exception('Q is ooi and no ooi dynamo table was set')
 
-        neighbors = [n for n in neighbors if n.id_ != q_id]
-
         return neighbors
 
-    def nn_from_payload(self, payload: Dict) -> List[Rec]:
-        # TODO: parse and use `search_k`
+    def can_rerank(self, version: IndexVersion = None) -> bool:
+        version = version or self._version
+        return version.vectors is not None \
+            and version.ann_meta_d['metric'] in EXACT_METRICS
+
+    def nn_reranked(self, q_emb, k: int, version: IndexVersion,
+                    search_k: int = -1,
+                    oversample: int = RERANK_OVERSAMPLE,
+                    q_ind: int = -1) -> Neighbors:
+        """
+        Fetches `k * oversample` candidates from ANNOY, then returns the
+            true top `k` of them by exact distance (computed in one pass
+            over the candidates' memory-mapped vectors)
+
+        Args:
+            q_ind: index of the query item, if it is in the index
+                (excluded from the results)
+        """
+        metric = version.ann_meta_d['metric']
+        q_emb = np.asarray(q_emb, dtype=np.float32)
+
+        n_candidates = k * max(oversample, 1) + (1 if q_ind >= 0 else 0)
+        inds = np.array(version.ann_index.get_nns_by_vector(
+            q_emb, n_candidates, search_k=search_k), dtype=np.int64)
+        if q_ind >= 0:
+            inds = inds[inds != q_ind]
+        dists = exact_dists(q_emb, version.vectors[inds], metric)
+        order = rank_order(dists, metric)[:k]
+
+        return Neighbors(inds=inds[order], dists=dists[order],
+                         store=version.ids)
+
+    def nn_exact(self, q_emb, k: int, version: IndexVersion,
+                 inds: np.ndarray, q_ind: int = -1) -> Neighbors:
+        """
+        Exact nearest `k` among the items `inds` (ex. those matching a
+            filter), from their memory-mapped vectors
+
+        Args:
+            q_ind: index of the query item (excluded from the results)
+        """
+        metric = version.ann_meta_d['metric']
+        if q_ind >= 0:
+            inds = inds[inds != q_ind]
+        dists = exact_dists(np.asarray(q_emb, dtype=np.float32),
+                            version.vectors[inds], metric)
+        order = rank_order(dists, metric)[:k]
+        return Neighbors(inds=inds[order], dists=dists[order],
+                         store=version.ids)
+
+    def fallback_chain(self) -> List['ANNResource']:
+        """This resource followed by its fallback parents
+        (stops at the first repeated resource, should there be a loop)
+        """
+        chain = []
+        ann_r = self
+        while ann_r is not None and ann_r not in chain:
+            chain.append(ann_r)
+            ann_r = ann_r.fallback_parent
+        return chain
+
+    def nn_from_payload(self, payload: Dict,
+                        version: IndexVersion = None,
+                        timings: List[Dict[str, Any]] = None,
+                        q_emb=None,
+                        ) -> Neighbors:
+        """
+        Queries this index, then its fallback parents (in one pass, not
+            recursively) until there are `k` neighbors.
+        The query vector, if an id query needs one at all, is resolved
+            once for the whole chain, and results are deduplicated
+
+        Args:
+            version: version of this index to query (default: current)
+            timings: if given, a dict per queried index is appended
+                (for the `debug` field of responses)
+            q_emb: vector of the `id` of the payload, if the caller has
+                already resolved it
+        """
         k = payload['k']
+        search_k_req = payload.get('search_k')
         incl_dist = payload.get('incl_dist') or False
         incl_score = bool(payload.get('incl_score')) or False
         thresh_score = payload.get('thresh_score')
         thresh_score = float(thresh_score) if thresh_score else False
         include_distances = bool(incl_dist or incl_score or thresh_score)
+        rerank = bool(payload.get('rerank'))
+        oversample = int(payload.get('oversample') or RERANK_OVERSAMPLE)
 
-        if 'id' in payload:
-            q_id = payload['id']
-            neighbors = self.nn_from_id(
-                q_id, k, incl_dist=include_distances)
-        elif 'emb' in payload:
-            q_emb = payload['emb']
-            neighbors = self.nn_from_emb(
-                q_emb, k, incl_dist=include_distances)
-        else:
-            raise Exception('Payload must contain `id` or `emb`')
+        filter_expr = payload.get('filter')
+        # Resolved to the items of each index queried, once per request
+        exclude_ids = set(payload.get('exclude_ids') or ())
 
-        # Fallback lookup if not enough neighbors
-        # TODO: there are some duplicated overheads by calling this
-        if (len(neighbors) < k) and (self.fallback_parent is not None):
-            neighbors_fallback = self.fallback_parent.nn_from_payload(
-                {**payload, **{'k': k - len(neighbors)}}
-            )
-            neighbors += neighbors_fallback
+        q_id = payload.get('id')
+        if q_id is None and 'emb' not in payload:
+            raise Exception('Payload must contain `id` or `emb`')
+        self.last_query_at = time()
+
+        # (chain resource, its version): fallbacks use their current one
+        levels = [(self, version or self._version)] + [
+            (ann_r, ann_r.version) for ann_r in self.fallback_chain()[1:]
+            if ann_r.ensure_loaded()]
+        q_emb_cache = [] if q_emb is None else [q_emb]
+
+        def q_emb_fn():
+            """Query vector, resolved at most once"""
+            if not q_emb_cache:
+                tic = time()
+                q_emb_cache.append(payload['emb'] if q_id is None
+                                   else resolve_vector(q_id, levels))
+                if timings is not None:
+                    timings.append({'vector_ms': (time() - tic) * 1000.})
+            return q_emb_cache[0]
+
+        neighbors = Neighbors.empty()
+        for ann_r, ver in levels:
+            n_needed = k - len(neighbors)
+            if n_needed <= 0:
+                break
+            delta = ver.delta
+            in_delta = delta is not None and q_id is not None \
+                and q_id in delta
+            search_k = int(search_k_req) if search_k_req is not None \
+                else ann_r.search_k_for(k, ver)
+            budget = ann_r.search_k_budget
+            if budget is not None:
+                search_k = budget.apply(
+                    search_k, k, ver.ann_index.get_n_trees())
+            # Leave room for neighbors already found at previous levels
+            k_level = n_needed + len(neighbors)
+            # With a delta: over-fetch from the base, as some of its
+            # neighbors may be tombstoned, and merge by distance
+            k_search = k_level if delta is None \
+                else k_level + delta.overfetch(k_level)
+            incl_dist_level = include_distances or delta is not None
+            flt = None
+            if filter_expr is not None:
+                if ver.attributes is None:
+                    if ann_r is self:
+                        raise ValueError(
+                            f'{self.name} has no attributes to filter on')
+                    # None of its items could match
+                    continue
+                flt = ver.attributes.compile(filter_expr)
+            excluded = None
+            if exclude_ids:
+                excluded = np.unique(ver.ids.find_many(exclude_ids))
+                excluded = excluded[excluded >= 0]
+
+            def q_ind_fn():
+                return -1 if q_id is None or in_delta \
+                    else ver.ids.find(q_id)
+
+            def search_fn(n, search_k_n):
+                if rerank and ann_r.can_rerank(ver):
+                    q_ind = q_ind_fn()
+                    return ann_r.nn_reranked(
+                        ver.vectors[q_ind] if q_ind >= 0 else q_emb_fn(),
+                        n, ver, search_k=search_k_n,
+                        oversample=oversample, q_ind=q_ind)
+                elif q_id is not None and not in_delta:
+                    return ann_r.nn_from_id(
+                        q_id, n, version=ver,
+                        incl_dist=incl_dist_level, search_k=search_k_n,
+                        q_emb_fn=q_emb_fn)
+                return ann_r.nn_from_emb(
+                    q_emb_fn(), n, version=ver,
+                    incl_dist=incl_dist_level, search_k=search_k_n)
+
+            def keep_fn(found, ids_find=None):
+                """Neighbors that match the filter and are not excluded
+                (`ids_find`: for those that are not index items)
+                """
+                if flt is not None:
+                    found = flt.keep(found, ids_find)
+                if exclude_ids:
+                    found = found.without_ids(exclude_ids) \
+                        if found.inds is None \
+                        else found.without_inds(excluded)
+                return found
+
+            tic = time()
+            filter_path = None
+            if flt is not None and flt.estimate() <= FILTER_BRUTE_FORCE_MAX \
+                    and ann_r.can_rerank(ver):
+                # Selective filter: exact search over the few matches
+                filter_path = 'exact'
+                inds = flt.matching()
+                if excluded is not None:
+                    inds = np.setdiff1d(inds, excluded, assume_unique=True)
+                q_ind = q_ind_fn()
+                neighbors_level = ann_r.nn_exact(
+                    ver.vectors[q_ind] if q_ind >= 0 else q_emb_fn(),
+                    k_search, ver, inds, q_ind=q_ind)
+            elif flt is not None or (excluded is not None and len(excluded)):
+                # Over-fetch in proportion to how few items match, and
+                # by as many items as are excluded
+                filter_path = None if flt is None else 'ann'
+                n_start = k_search if flt is None \
+                    else k_search * flt.n // max(flt.estimate(), 1)
+                if excluded is not None:
+                    n_start += len(excluded)
+                neighbors_level = fetch_until(
+                    search_fn, keep_fn, k_search, n_start,
+                    max(FETCH_MAX_N, k_search), search_k)
+            else:
+                neighbors_level = search_fn(k_search, search_k)
+            if filter_path is not None:
+                metrics.FILTERED_QUERIES.labels(
+                    ann_r.label, filter_path).inc()
+            if delta is not None:
+                neighbors_level = delta.merge(
+                    neighbors_level, q_emb_fn(), k_level,
+                    ver.ann_meta_d['metric'], q_id=q_id,
+                    keep_fn=None if flt is None and not exclude_ids
+                    else lambda found: keep_fn(found, ver.ids.find))
+            elapsed = time() - tic
+            if budget is not None:
+                budget.record(elapsed)
+            if tic - ann_r._swapped_at < POST_SWAP_WINDOW_S:
+                ann_r.post_swap_latency.record(elapsed)
+            if timings is not None:
+                timings.append({
+                    'index': ann_r.name,
+                    'version': ver.name,
+                    'n': len(neighbors_level),
+                    'ms': elapsed * 1000.,
+                })
+                if filter_path is not None:
+                    timings[-1]['filter'] = filter_path
+
+            if not len(neighbors):
+                neighbors = neighbors_level
+            else:
+                neighbors = neighbors.concat(neighbors_level).dedup()
 
         if thresh_score:
-            neighbors = [n for n in neighbors if n.score > thresh_score]
+            neighbors = neighbors.above_score(thresh_score)
 
         return neighbors[:k]
 
-    def get_vector(self, q_id):
-        if q_id in self.ids_d:
-            q_ind = self.ids_d[q_id]
-            ann_index = self.ann_index
-            q_emb = ann_index.get_item_vector(q_ind)
+    def get_vector(self, q_id, version: IndexVersion = None):
+        """Vector of `q_id`: a zero-copy view into the memory-mapped
+        vectors when the id is in the index (and the version has them)
+        """
+        version = version or self._version
+        delta = version.delta
+        if delta is not None and q_id in delta:
+            # Changed (or added) since the base was built
+            return delta.get_vector(q_id)
+        q_ind = version.ids.find(q_id)
+        if q_ind >= 0 and version.vectors is not None:
+            q_emb = version.vectors[q_ind]
+        elif q_ind >= 0:
+            q_emb = version.ann_index.get_item_vector(q_ind)
         elif self.ooi_dynamo_table is not None:
-            q_emb = get_dynamo_emb(self.ooi_dynamo_table, q_id)
-        elif self.ooi_ann is not None:
+            q_emb = self.ooi_dynamo_table.get(q_id)
+        elif self.ooi_ann is not None and self.ooi_ann.ensure_loaded():
             q_emb = self.ooi_ann.get_vector(q_id)
         else:
             return None
 
         return q_emb
 
+    def get_vectors(self, q_ids: List, version: IndexVersion = None
+                    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Batch version of `get_vector`
+
+        Gathers straight into one preallocated float32 array (from the
+            memory-mapped vectors if the version has them); ids that
+            are out of index are looked up together (one dynamo batch)
+
+        Returns: ((len(q_ids), n_dim) vectors, mask of the ids found)
+        """
+        version = version or self._version
+        n_dim = version.ann_meta_d['n_dim']
+        embs = np.zeros((len(q_ids), n_dim), dtype=np.float32)
+        found = np.zeros(len(q_ids), dtype=bool)
+
+        inds = version.ids.find_many(q_ids)
+        found[:] = inds >= 0
+        if version.vectors is not None:
+            # One gather from the memory-mapped matrix
+            embs[found] = version.vectors[inds[found]]
+        else:
+            get_item_vector = version.ann_index.get_item_vector
+            for row in np.flatnonzero(found).tolist():
+                embs[row] = get_item_vector(int(inds[row]))
+        delta = version.delta
+        if delta is not None and len(delta):
+            for row, q_id in enumerate(q_ids):
+                emb = delta.get_vector(q_id)
+                if emb is not None:
+                    embs[row] = emb
+                    found[row] = True
+        ooi_rows = np.flatnonzero(~found).tolist()
+
+        if ooi_rows and self.ooi_dynamo_table is not None:
+            ooi_embs = self.ooi_dynamo_table.get_many(
+                q_ids[row] for row in ooi_rows)
+            for row in ooi_rows:
+                emb = ooi_embs.get(q_ids[row])
+                if emb is not None:
+                    embs[row] = emb
+                    found[row] = True
+        elif ooi_rows and self.ooi_ann is not None \
+                and self.ooi_ann.ensure_loaded():
+            ooi_embs, ooi_found = self.ooi_ann.get_vectors(
+                [q_ids[row] for row in ooi_rows])
+            embs[ooi_rows] = ooi_embs
+            found[ooi_rows] = ooi_found
+
+        return embs, found
+
     def on_post(self, req, resp):
+        if not self.ensure_loaded():
+            respond_not_ready(resp, self)
+            return
         try:
+            tic = time()
             payload_json_buf = req.bounded_stream
             payload_json = json.load(payload_json_buf)
 
-            neighbors = self.nn_from_payload(payload_json)
+            fmt = negotiate(req, payload_json.get('format'))
+            metrics.QUERY_STAGE_SECONDS.labels(self.label, 'parse').observe(
+                time() - tic)
+            timings = []
+            neighbors = self.nn_from_payload(payload_json, timings=timings)
+            metrics.observe_query(self.label, timings)
+
+            tic = time()
             incl_dist = bool(payload_json.get('incl_dist')) or False
             incl_score = bool(payload_json.get('incl_score')) or False
-            recs = [n.to_dict(incl_dist, incl_score) for n in neighbors]
 
-            res = {
-                'recs': recs,
-                'id_type': '-',
-            }
+            res = recs_body(neighbors, incl_dist, incl_score, fmt,
+                            id_type='-')
+            if payload_json.get('debug'):
+                res['debug'] = {'timings': timings}
 
-            resp.body = json.dumps(res)
+            set_body(resp, res, fmt)
+            metrics.QUERY_STAGE_SECONDS.labels(
+                self.label, 'serialize').observe(time() - tic)
             resp.status = falcon.HTTP_200
         except Exception as e:
             # resp.body = json.dumps(
@@ -263,31 +897,103 @@ class ANNResource(object):
         If not (item is not active or something), try grabbing from dynamo.
         TODO:
         Finally, if desired, calculate the cold embedding somehow
+
+        Returned as a JSON list, as raw little-endian float32 bytes
+            (`format=f32` or `Accept: application/octet-stream`)
+            or as msgpack (`format=msgpack` or `Accept: application/msgpack`)
         """
 
+        if not self.ensure_loaded():
+            respond_not_ready(resp, self)
+            return
         q_id = req.params['id']
 
+        try:
+            fmt = negotiate(req, formats=VECTOR_FORMATS)
+        except ValueError:
+            resp.status = falcon.HTTP_200
+            resp.body = json.dumps([])
+            return
+
         q_emb = self.get_vector(q_id)
 
         if q_emb is None:
             resp.status = falcon.HTTP_200
         else:
             resp.status = falcon.HTTP_200
-            resp.body = json.dumps(q_emb)
+            set_vector_body(resp, q_emb, fmt)
+
+    def post_swap_latency_json(self) -> Dict[str, Any]:
+        """Query latency in the first `POST_SWAP_WINDOW_S` after a swap"""
+        window = self.post_swap_latency
+        p50, p99 = window.quantile(0.5), window.quantile(0.99)
+        return {
+            'window_s': POST_SWAP_WINDOW_S,
+            'n': len(window),
+            'p50_ms': None if p50 is None else p50 * 1000.,
+            'p99_ms': None if p99 is None else p99 * 1000.,
+        }
 
     def set_fallback(self, fallback_parent: 'ANNResource'):
         self.fallback_parent = fallback_parent
 
     def tojson(self):
+        version = self._version
+        if version is None:
+            return {
+                'path_tar': self.path_tar,
+                **self.status(),
+            }
         return {
             'path_tar': self.path_tar,
-            'ann_meta': self.ann_meta_d,
-            'ts_read': self.ts_read_utc.isoformat(),
-            'n_ids': len(self.ids),
-            'head5_ids': self.ids[:5],
+            'ann_meta': version.ann_meta_d,
+            'search_k': self.default_search_k,
+            'search_k_budget': (self.search_k_budget.tojson()
+                                if self.search_k_budget else None),
+            'ts_read': version.ts_read.isoformat(),
+            'version': version.name,
+            'swap': self.swap_stats,
+            'post_swap_latency': self.post_swap_latency_json(),
+            'result_cache': (self.result_cache.tojson()
+                             if self.result_cache is not None else None),
+            'ooi_store': (self.ooi_dynamo_table.tojson()
+                          if self.ooi_dynamo_table is not None else None),
+            'delta': (version.delta.tojson()
+                      if version.delta is not None else None),
+            'attributes': (version.attributes.tojson()
+                           if version.attributes is not None else None),
+            'n_ids': len(version.ids),
+            'head5_ids': version.ids[:5],
+            **self.status(),
         }
 
 
+def resolve_vector(q_id, levels: List[Tuple[ANNResource, IndexVersion]]):
+    """Vector of `q_id` for a fallback chain: from the first index that
+    has the id, else from the first out-of-index source that has it
+    """
+    for ann_r, version in levels:
+        q_ind = version.ids.find(q_id)
+        if q_ind >= 0 or (version.delta is not None and q_id in version.delta):
+            return ann_r.get_vector(q_id, version)
+    for ann_r, version in levels:
+        if ann_r.ooi_dynamo_table is not None or ann_r.ooi_ann is not None:
+            q_emb = ann_r.get_vector(q_id, version)
+            if q_emb is not None:
+                return q_emb
+    return None
+
+
+def respond_not_ready(resp, ann_resource: ANNResource):
+    """503 for queries against an index that has not finished loading"""
+    resp.status = falcon.HTTP_503
+    resp.set_header('Retry-After', str(NOT_READY_RETRY_S))
+    resp.body = json.dumps({
+        'Error': f'ANN {ann_resource.name} is not ready',
+        **ann_resource.status(),
+    })
+
+
 def dist_to_score(l, score_thresh=float('-inf')):
     """
         Adds a key 'score' to a list of dictionaries with distance
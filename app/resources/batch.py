@@ -0,0 +1,94 @@
+import falcon
+from .ann import ANNResource, respond_not_ready
+from ..versions import IndexVersion
+from ..encoding import negotiate, recs_body, set_body
+from .. import metrics
+import json
+from concurrent.futures import Executor
+from typing import Dict, List
+
+
+class BatchANNResource(object):
+    """
+    Many ANN queries against a single index in one request
+
+    Every query is run against the same loaded index version.
+    Results are returned in request order, with errors reported inline
+        so that one bad query does not blank the whole response
+    """
+
+    def __init__(self, ann_resource: ANNResource,
+                 executor: Executor = None,
+                 ):
+        """
+
+        Args:
+            ann_resource: resource to run the queries against
+            executor: optional pool to spread queries over
+                (ANNOY releases the GIL while searching).
+                Queries are run sequentially if not set
+        """
+        self.ann_resource = ann_resource
+        self.executor = executor
+
+    def query_one(self, payload: Dict, version: IndexVersion,
+                  fmt: str = 'json') -> Dict:
+        try:
+            timings = []
+            neighbors = self.ann_resource.nn_from_payload(
+                payload, version=version, timings=timings)
+            metrics.observe_query(self.ann_resource.label, timings)
+            incl_dist = bool(payload.get('incl_dist')) or False
+            incl_score = bool(payload.get('incl_score')) or False
+            res = recs_body(neighbors, incl_dist, incl_score, fmt)
+            if payload.get('debug'):
+                res['debug'] = {'timings': timings}
+            return res
+        except Exception as e:
+            return {'error': str(e) or type(e).__name__}
+
+    def query_many(self, payloads: List[Dict],
+                   fmt: str = 'json') -> List[Dict]:
+        version = self.ann_resource.version
+
+        def query_fn(payload):
+            return self.query_one(payload, version, fmt)
+
+        if self.executor is None or len(payloads) <= 1:
+            return [query_fn(p) for p in payloads]
+        else:
+            # `map` preserves request order
+            return list(self.executor.map(query_fn, payloads))
+
+    def on_post(self, req, resp):
+        """
+        Payload is of the form:
+            {"queries": [{"id": "123", "k": 5}, {"emb": [...], "k": 10}],
+             ...}
+        Any other top-level keys (ex. `k`, `incl_dist`) are used as
+            defaults for every query
+        """
+        if not self.ann_resource.ensure_loaded():
+            respond_not_ready(resp, self.ann_resource)
+            return
+        try:
+            payload_json_buf = req.bounded_stream
+            payload_json = json.load(payload_json_buf)
+            fmt = negotiate(req, payload_json.get('format'))
+
+            defaults = {k: v for k, v in payload_json.items()
+                        if k != 'queries'}
+            payloads = [{**defaults, **q} for q in payload_json['queries']]
+
+            res = {
+                'results': self.query_many(payloads, fmt),
+                'id_type': '-',
+            }
+
+            set_body(resp, res, fmt)
+            resp.status = falcon.HTTP_200
+        except Exception as e:
+            print(e)
+            # Return empty response with 200
+            resp.body = json.dumps([])
+            resp.status = falcon.HTTP_200
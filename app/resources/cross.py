@@ -1,6 +1,8 @@
 import falcon
-from .ann import ANNResource, dist_to_score
-from ..io import needs_reload, load_via_tar, load_index, get_dynamo_emb
+from .ann import ANNResource, dist_to_score, respond_not_ready
+from ..io import needs_reload, load_via_tar, load_index
+from ..ooi import as_vector_store
+from ..encoding import negotiate, recs_body, set_body
 import json
 from typing import List, Dict
 from distutils.util import strtobool
@@ -17,46 +19,56 @@ class CrossANNResource(object):
         self.ann_resources_d: Dict[str, ANNResource] = {
             a.name: a for a in ann_resources}
 
-        self.fallback_dynamo_table = fallback_dynamo_table
+        self.fallback_dynamo_table = as_vector_store(fallback_dynamo_table)
 
     def on_get(self, req, resp):
         q_name = req.params['q_name']
         q_id = req.params['q_id']
         c_name = req.params['catalog_name']
         k = int(req.params['k'])
+        search_k = req.params.get('search_k')
         incl_dist = strtobool(req.params.get('incl_dist', '0')) or False
         incl_score = strtobool(req.params.get('incl_score', '0')) or False
         thresh_score = req.params.get('thresh_score')
-        thresh_score = float(thresh_score) if thresh_score else False
-        include_distances = bool(incl_dist or incl_score or thresh_score)
+
+        for name in (q_name, c_name):
+            ann_r = self.ann_resources_d.get(name)
+            if ann_r is not None and not ann_r.ensure_loaded():
+                respond_not_ready(resp, ann_r)
+                return
 
         neighbors = []
         try:
+            fmt = negotiate(req)
             if q_name in self.ann_resources_d:
                 q_emb = self.ann_resources_d[q_name].get_vector(q_id)
             elif self.fallback_dynamo_table is not None:
                 # Need to look up the vector and query by vector
-                q_emb = get_dynamo_emb(self.fallback_dynamo_table, q_id)
+                q_emb = self.fallback_dynamo_table.get(q_id)
+                if q_emb is None:
+                    raise ValueError(f'{q_id} not found in '
+                                     f'{self.fallback_dynamo_table.name}')
             else:
                 raise ValueError(f'ANN: {q_name} not found '
                                  f'and dynamo fallback failed')
 
-            neighbors = self.ann_resources_d[c_name].nn_from_emb(
-                q_emb, k,
-                incl_dist=include_distances
-            )
-
-            if thresh_score:
-                neighbors = [n for n in neighbors if n.score > thresh_score]
+            if q_emb is None:
+                raise ValueError(f'{q_id} not found in {q_name}')
 
-            recs = [n.to_dict(incl_dist, incl_score) for n in neighbors]
+            # Same path as queries by vector: the catalog's default
+            # `search_k` and latency budget, and its delta if any
+            payload = {'emb': q_emb, 'k': k, 'incl_dist': incl_dist,
+                       'incl_score': incl_score,
+                       'thresh_score': thresh_score}
+            if search_k is not None:
+                payload['search_k'] = int(search_k)
+            neighbors = self.ann_resources_d[c_name].nn_from_payload(
+                payload, q_emb=q_emb)
 
-            res = {
-                'recs': recs,
-                'id_type': '-',
-            }
+            res = recs_body(neighbors, incl_dist, incl_score, fmt,
+                            id_type='-')
 
-            resp.body = json.dumps(res)
+            set_body(resp, res, fmt)
             resp.status = falcon.HTTP_200
 
         except ValueError:
@@ -0,0 +1,203 @@
+import falcon
+from .ann import ANNResource, resolve_vector
+from ..neighbors import Neighbors
+from ..ooi import as_vector_store
+from ..vectors import rank_order
+from ..encoding import negotiate, recs_body, set_body
+from .. import metrics
+import json
+from concurrent.futures import Executor, wait
+from time import time
+from typing import Dict, List, Tuple
+import numpy as np
+
+MERGE_MODES = ('distance', 'quota')
+
+
+class FanoutANNResource(object):
+    """
+    One query against many indexes (ex. all categories of a catalog)
+
+    The query vector is resolved once, the indexes are searched in
+        parallel, and their results merged into a single ranking,
+        either purely by distance or with a quota per index.
+    With a deadline, whatever has finished by then is returned
+        (flagged `partial`, with the indexes that are missing)
+    """
+
+    def __init__(self, ann_resources: List[ANNResource],
+                 executor: Executor = None,
+                 fallback_dynamo_table=None):
+        """
+
+        Args:
+            ann_resources: indexes that can be fanned out to
+            executor: pool of native threads to search the indexes on
+                (ANNOY releases the GIL while searching), see
+                `native_executor`. Searched sequentially if not set (the
+                deadline is then only checked between indexes)
+            fallback_dynamo_table: vectors of ids that are in none of
+                the indexes
+        """
+        self.ann_resources_d: Dict[str, ANNResource] = {
+            a.name: a for a in ann_resources}
+        self.executor = executor
+        self.fallback_dynamo_table = as_vector_store(fallback_dynamo_table)
+
+    def query_vector(self, q_id, names: List[str]):
+        """Vector of `q_id`, if any of the indexes do not hold it
+        (those that do are queried by item instead)
+        """
+        levels = [(self.ann_resources_d[n], self.ann_resources_d[n].version)
+                  for n in names if self.ann_resources_d[n].ready]
+        if all(version.ids.find(q_id) >= 0 for _, version in levels):
+            return None
+        q_emb = resolve_vector(q_id, levels)
+        if q_emb is None and self.fallback_dynamo_table is not None:
+            q_emb = self.fallback_dynamo_table.get(q_id)
+        if q_emb is None:
+            raise ValueError(f'{q_id} not found')
+        return q_emb
+
+    def query(self, payload: Dict) -> Tuple[Neighbors, List[str], Dict]:
+        """
+        Returns: merged neighbors, the index of each neighbor, and a
+            dict of the indexes without results (name -> reason)
+        """
+        tic = time()
+        k = int(payload['k'])
+        names = payload['indexes']
+        merge = payload.get('merge') or 'distance'
+        quotas = payload.get('quotas') or {}
+        deadline_ms = payload.get('deadline_ms')
+        if merge not in MERGE_MODES:
+            raise ValueError(f'Unknown merge: {merge}')
+        for name in names:
+            if name not in self.ann_resources_d:
+                raise ValueError(f'ANN: {name} not found')
+
+        # Lazy indexes not loaded yet are loaded in the background (the
+        # deadline would not hold otherwise), and missing until then
+        missing = {}
+        for name in names:
+            ann_r = self.ann_resources_d[name]
+            if not ann_r.ensure_loading():
+                missing[name] = 'failed' if ann_r.state == 'failed' \
+                    else 'loading'
+        names = [n for n in names if n not in missing]
+
+        q_emb = None
+        if 'id' in payload:
+            # `q_name`: optional index to take the vector from
+            q_name = payload.get('q_name')
+            q_emb = self.query_vector(payload['id'], names + (
+                [q_name] if q_name in self.ann_resources_d else []))
+
+        def k_of(name):
+            if merge == 'quota':
+                return int(quotas.get(name, -(-k // len(names))))
+            return k
+
+        def search(name):
+            ann_r = self.ann_resources_d[name]
+            timings = []
+            # Distances are always needed to merge
+            neighbors = ann_r.nn_from_payload(
+                {**payload, 'k': k_of(name), 'incl_dist': True},
+                timings=timings, q_emb=q_emb)
+            metrics.observe_query(ann_r.label, timings)
+            return neighbors
+
+        results: Dict[str, Neighbors] = {}
+        if self.executor is None:
+            for name in names:
+                if deadline_ms is not None \
+                        and (time() - tic) * 1000. > deadline_ms:
+                    missing[name] = 'deadline'
+                    continue
+                try:
+                    results[name] = search(name)
+                except Exception as e:
+                    missing[name] = str(e) or type(e).__name__
+        else:
+            futures = {self.executor.submit(search, name): name
+                       for name in names}
+            timeout = None if deadline_ms is None else max(
+                deadline_ms / 1000. - (time() - tic), 0.)
+            done, not_done = wait(futures, timeout=timeout)
+            for fut in not_done:
+                # Searches already running finish in the background
+                fut.cancel()
+                missing[futures[fut]] = 'deadline'
+            for fut in done:
+                try:
+                    results[futures[fut]] = fut.result()
+                except Exception as e:
+                    missing[futures[fut]] = str(e) or type(e).__name__
+
+        neighbors, catalogs = self.merge(
+            [(n, results[n]) for n in names if n in results], k)
+        return neighbors, catalogs, missing
+
+    def merge(self, results: List[Tuple[str, Neighbors]], k: int
+              ) -> Tuple[Neighbors, List[str]]:
+        """Best `k` of all results by distance (keeping the first, i.e.
+        nearest, occurrence of ids found in more than one index)
+        """
+        neighbors = Neighbors.empty()
+        catalogs = []
+        for name, neighbors_index in results:
+            neighbors = neighbors.concat(neighbors_index)
+            catalogs += [name] * len(neighbors_index)
+        if not len(neighbors):
+            return neighbors, []
+
+        metric = self.ann_resources_d[results[0][0]].ann_meta_d['metric']
+        order = rank_order(neighbors.dists, metric)
+        ids = neighbors.ids
+        seen = set()
+        keep = []
+        for i in order.tolist():
+            if ids[i] not in seen:
+                seen.add(ids[i])
+                keep.append(i)
+                if len(keep) == k:
+                    break
+        keep = np.array(keep, dtype=np.int64)
+        return neighbors.select(keep), [catalogs[i] for i in keep.tolist()]
+
+    def on_post(self, req, resp):
+        """
+        Payload is of the form:
+            {"indexes": ["cat_a", "cat_b"], "id": "123" (or "emb": [...]),
+             "k": 20, "merge": "distance" or "quota",
+             "quotas": {"cat_a": 15}, "deadline_ms": 50, ...}
+        Other query parameters (ex. `search_k`, `thresh_score`, `rerank`)
+            are applied to every index
+        """
+        try:
+            payload_json_buf = req.bounded_stream
+            payload_json = json.load(payload_json_buf)
+            fmt = negotiate(req, payload_json.get('format'))
+            incl_dist = bool(payload_json.get('incl_dist')) or False
+            incl_score = bool(payload_json.get('incl_score')) or False
+
+            neighbors, catalogs, missing = self.query(payload_json)
+
+            res = recs_body(neighbors, incl_dist, incl_score, fmt,
+                            id_type='-',
+                            partial=bool(missing),
+                            missing=missing)
+            if fmt == 'json':
+                for rec, name in zip(res['recs'], catalogs):
+                    rec['index'] = name
+            else:
+                res['indexes'] = catalogs
+
+            set_body(resp, res, fmt)
+            resp.status = falcon.HTTP_200
+        except Exception as e:
+            print(e)
+            # Return empty response with 200
+            resp.body = json.dumps([])
+            resp.status = falcon.HTTP_200
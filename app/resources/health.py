@@ -1,8 +1,12 @@
 import falcon
 from .ann import ANNResource
+from ..residency import rss_info
+from ..disk import DiskManager
+from .. import metrics
 import json
 import os
-from time import sleep
+from time import sleep, time
+from typing import Dict
 
 
 class ANNHealthcheckResource(object):
@@ -17,37 +21,66 @@ class ANNHealthcheckResource(object):
 
 class HealthcheckResource(object):
 
-    def __init__(self, names):
-        self.names = names
+    def __init__(self, ann_resources_d: Dict[str, ANNResource]):
+        self.ann_resources_d = ann_resources_d
 
     def on_get(self, req, resp):
-        resp.body = json.dumps(self.names)
+        """
+        Returns: {index name: loading status} for every index
+        """
+        resp.body = json.dumps({
+            name: ann_r.status()
+            for name, ann_r in self.ann_resources_d.items()})
         resp.status = falcon.HTTP_200
 
 
 class TmpSpaceResource(object):
 
+    def __init__(self, disk: DiskManager):
+        self.disk = disk
+
     def on_get(self, req, resp):
         """
-        Returns: Size of /tmp in mb
+        Returns: Size of the extracted indexes in mb (tracked as they
+            are extracted and removed, not walked),
+            or the size of each version with param `detail`
+        """
+        if req.get_param_as_bool('detail'):
+            resp.body = json.dumps(self.disk.tojson())
+        else:
+            resp.body = json.dumps(int(self.disk.total_bytes / 1e6))
+        resp.status = falcon.HTTP_200
+
+
+class WorkerResource(object):
+
+    def __init__(self):
+        self.started_at = time()
 
+    def on_get(self, req, resp):
+        """
+        Returns: memory (MB) of the worker that served this request
+            (`RssAnon` is private to the worker, `RssFile` is shared
+            page cache such as the mmapped indexes and ids),
+            and seconds since the app was built
         """
-        def get_size(start_path='/tmp'):
-            total_size = 0
-            for dirpath, dirnames, filenames in os.walk(start_path):
-                for f in filenames:
-                    try:
-                        fp = os.path.join(dirpath, f)
-                        total_size += os.path.getsize(fp)
-                    except FileNotFoundError:
-                        pass
-                    except:
-                        pass
-            return total_size
+        resp.body = json.dumps({
+            'pid': os.getpid(),
+            'uptime_s': time() - self.started_at,
+            **rss_info(),
+        })
+        resp.status = falcon.HTTP_200
+
 
-        size_mb = int(get_size('/tmp') / 1e6)
+class MetricsResource(object):
 
-        resp.body = json.dumps(size_mb)
+    def on_get(self, req, resp):
+        """
+        Returns: metrics in the Prometheus text format (summed over all
+            workers when `PROMETHEUS_MULTIPROC_DIR` is set)
+        """
+        resp.content_type = metrics.CONTENT_TYPE_LATEST
+        resp.data = metrics.latest()
         resp.status = falcon.HTTP_200
 
 
@@ -1,5 +1,6 @@
 import falcon
-from .ann import ANNResource
+from .ann import ANNResource, respond_not_ready
+from ..vectors import score_chunks, top_k, passes
 import json
 from typing import List, Dict
 import numpy as np
@@ -20,35 +21,62 @@ class ScoringResource(object):
             a.name: a for a in ann_resources}
 
     def on_post(self, req, resp):
-        neighbors = []
         try:
-            # TODO: more efficient to batch-get
             # TODO: limited by ids in same category
-            # TODO: maybe have a verbose option and a succinct option
 
             payload_json_buf = req.bounded_stream
             payload_json = json.load(payload_json_buf)
-            print(payload_json)
 
             ids_1 = payload_json.get('ids_1')
             catalog_1 = payload_json.get('catalog_1')
             ids_2 = payload_json.get('ids_2')
             catalog_2 = payload_json.get('catalog_2')
             dist = payload_json.get('dist') or 'cosine'
+            k = payload_json.get('top_k')
+            threshold = payload_json.get('threshold')
 
-            embs_1 = np.array([self.ann_resources_d[catalog_1].get_vector(i)
-                               for i in ids_1])
-            embs_2 = np.array([self.ann_resources_d[catalog_2].get_vector(i)
-                               for i in ids_2])
+            for name in (catalog_1, catalog_2):
+                if name not in self.ann_resources_d:
+                    raise ValueError(f'ANN: {name} not found')
+                if not self.ann_resources_d[name].ensure_loaded():
+                    respond_not_ready(resp, self.ann_resources_d[name])
+                    return
 
-            norms_1 = np.linalg.norm(embs_1, axis=1)
-            norms_2 = np.linalg.norm(embs_2, axis=1)
+            embs_1, found_1 = self.ann_resources_d[catalog_1].get_vectors(
+                ids_1)
+            embs_2, found_2 = self.ann_resources_d[catalog_2].get_vectors(
+                ids_2)
+            # Ids without a vector are left out of the response
+            ids_1 = [i for i, f in zip(ids_1, found_1) if f]
+            ids_2 = [i for i, f in zip(ids_2, found_2) if f]
+            embs_1, embs_2 = embs_1[found_1], embs_2[found_2]
 
-            dot_arr = embs_1.dot(embs_2.T)
-            cos_arr = dot_arr / norms_1[:, None] / norms_2[None, :]
-
-            dists_struct = dict(zip(
-                ids_1, map(lambda x: dict(zip(ids_2, x)), cos_arr)))
+            dists_struct = {}
+            for offset, scores in score_chunks(embs_1, embs_2, dist):
+                row_ids = ids_1[offset:offset + len(scores)]
+                if k is not None:
+                    # Only the best `top_k` of each row, best first
+                    inds, scores = top_k(scores, int(k), dist)
+                    keep = (passes(scores, float(threshold), dist)
+                            if threshold is not None
+                            else np.ones(scores.shape, dtype=bool))
+                    for r, id_1 in enumerate(row_ids):
+                        dists_struct[id_1] = [
+                            {'id': ids_2[j], 'score': s}
+                            for j, s in zip(inds[r][keep[r]].tolist(),
+                                            scores[r][keep[r]].tolist())]
+                elif threshold is not None:
+                    # Only the pairs that pass the threshold
+                    rows, cols = np.nonzero(
+                        passes(scores, float(threshold), dist))
+                    for id_1 in row_ids:
+                        dists_struct[id_1] = {}
+                    for r, j in zip(rows.tolist(), cols.tolist()):
+                        dists_struct[row_ids[r]][ids_2[j]] = \
+                            float(scores[r, j])
+                else:
+                    for id_1, row in zip(row_ids, scores.tolist()):
+                        dists_struct[id_1] = dict(zip(ids_2, row))
 
             resp.body = json.dumps(dists_struct)
             resp.status = falcon.HTTP_200
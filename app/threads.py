@@ -0,0 +1,22 @@
+from concurrent.futures import Executor, ThreadPoolExecutor
+
+
+def native_executor(max_workers: int) -> Executor:
+    """
+    Pool of native threads, even in gevent workers
+
+    Once `threading` is monkey-patched, a `ThreadPoolExecutor` only runs
+        greenlets: blocking ANNOY searches would neither run in parallel
+        nor let the hub run meanwhile (ex. to time out a deadline).
+        gevent's executor runs them on real threads, and its futures
+        can be waited on cooperatively
+    """
+    try:
+        from gevent import monkey
+    except ImportError:
+        # Only needed for gevent workers
+        return ThreadPoolExecutor(max_workers=max_workers)
+    if not monkey.is_module_patched('threading'):
+        return ThreadPoolExecutor(max_workers=max_workers)
+    from gevent.threadpool import ThreadPoolExecutor as GeventExecutor
+    return GeventExecutor(max_workers=max_workers)
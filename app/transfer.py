@@ -0,0 +1,208 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import os
+import tarfile
+from pathlib import Path
+from typing import Callable, Union
+import boto3
+import logging
+
+logging.basicConfig(level=logging.INFO)
+
+S3_URI_PREFIX = 's3://'
+RANGE_CHUNK_SZ = 16 * 2 ** 20  # 16 MiB per ranged GET
+N_RANGE_THREADS = 8
+CHECKSUM_META_KEY = 'sha256'  # S3 user metadata (`x-amz-meta-sha256`)
+
+PathType = Union[Path, str]
+FetchFn = Callable[[int, int], bytes]  # (start, length) -> bytes
+
+s3_client = boto3.client('s3')
+
+
+class ChecksumError(IOError):
+    pass
+
+
+def split_s3_path(path: str):
+    bucket, _, key = str(path)[len(S3_URI_PREFIX):].partition('/')
+    return bucket, key
+
+
+class RangedReader(object):
+    """
+    Sequential, read-only file-like object over a remote blob
+        that is fetched as byte ranges by a pool of threads
+
+    Up to `max_ahead` chunks are in flight ahead of the consumer,
+        so downloading overlaps with decompression/extraction.
+        The sha256 of the stream is computed as it is consumed
+    """
+
+    def __init__(self, fetch: FetchFn, size: int,
+                 chunk_sz: int = RANGE_CHUNK_SZ,
+                 n_threads: int = N_RANGE_THREADS,
+                 max_ahead: int = None,
+                 progress: Callable[[int, int], None] = None,
+                 ):
+        self.fetch = fetch
+        self.size = size
+        self.chunk_sz = chunk_sz
+        self.max_ahead = max_ahead or 2 * n_threads
+        self.progress = progress
+        self.sha256 = hashlib.sha256()
+        self.bytes_read = 0
+
+        self._executor = ThreadPoolExecutor(max_workers=n_threads)
+        self._starts = iter(range(0, size, chunk_sz))
+        self._pending = deque()
+        self._buf = memoryview(b'')
+        for _ in range(self.max_ahead):
+            self._schedule()
+
+    def _schedule(self):
+        start = next(self._starts, None)
+        if start is not None:
+            length = min(self.chunk_sz, self.size - start)
+            self._pending.append(
+                (length, self._executor.submit(self.fetch, start, length)))
+
+    def _next_chunk(self) -> bool:
+        if not self._pending:
+            return False
+        length, fut = self._pending.popleft()
+        self._schedule()
+        data = fut.result()
+        if len(data) != length:
+            raise IOError(f'Expected {length} bytes, got {len(data)}')
+        self.sha256.update(data)
+        self.bytes_read += len(data)
+        if self.progress is not None:
+            self.progress(self.bytes_read, self.size)
+        self._buf = memoryview(data)
+        return True
+
+    def readable(self):
+        return True
+
+    def read(self, n: int = -1) -> bytes:
+        parts = []
+        while n < 0 or n > 0:
+            if not self._buf and not self._next_chunk():
+                break
+            take = len(self._buf) if n < 0 else min(n, len(self._buf))
+            parts.append(self._buf[:take])
+            self._buf = self._buf[take:]
+            if n > 0:
+                n -= take
+        return b''.join(parts)
+
+    def drain(self):
+        while self._buf or self._next_chunk():
+            self._buf = memoryview(b'')
+
+    def close(self):
+        for _, fut in self._pending:
+            fut.cancel()
+        self._executor.shutdown(wait=False)
+
+    def verify(self, sha256_hex: str = None):
+        if self.bytes_read != self.size:
+            raise ChecksumError(
+                f'Size mismatch: read {self.bytes_read} of {self.size} bytes')
+        if sha256_hex and self.sha256.hexdigest() != sha256_hex.lower():
+            raise ChecksumError(
+                f'sha256 mismatch: {self.sha256.hexdigest()} != {sha256_hex}')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def s3_fetcher(path: str):
+    """Returns (fetch fn, size in bytes, expected sha256 or None)"""
+    bucket, key = split_s3_path(path)
+    head = s3_client.head_object(Bucket=bucket, Key=key)
+
+    def fetch(start: int, length: int) -> bytes:
+        resp = s3_client.get_object(
+            Bucket=bucket, Key=key,
+            Range=f'bytes={start}-{start + length - 1}',
+            IfMatch=head['ETag'],  # fail if replaced mid-download
+        )
+        return resp['Body'].read()
+
+    return (fetch, head['ContentLength'],
+            head.get('Metadata', {}).get(CHECKSUM_META_KEY))
+
+
+def local_fetcher(path: PathType):
+    path = str(path)
+    size = os.stat(path).st_size
+
+    def fetch(start: int, length: int) -> bytes:
+        with open(path, 'rb') as f:
+            f.seek(start)
+            return f.read(length)
+
+    return fetch, size, None
+
+
+def open_tar_stream(fileobj, path_tar: PathType) -> tarfile.TarFile:
+    """Streaming (non-seekable) tar, decompressing on the fly
+    Supports uncompressed, gz/bz2/xz (via `tarfile`) and zstd tars
+    """
+    name = str(path_tar)
+    if name.endswith(('.zst', '.zstd')):
+        try:
+            import zstandard
+        except ImportError:
+            raise ImportError(
+                f'`zstandard` must be installed to extract {name}')
+        fileobj = zstandard.ZstdDecompressor().stream_reader(fileobj)
+        return tarfile.open(fileobj=fileobj, mode='r|')
+    else:
+        return tarfile.open(fileobj=fileobj, mode='r|*')
+
+
+def _check_member(member: tarfile.TarInfo):
+    if os.path.isabs(member.name) or '..' in Path(member.name).parts:
+        raise tarfile.ExtractError(f'Unsafe path in tar: {member.name}')
+    if not (member.isfile() or member.isdir()):
+        raise tarfile.ExtractError(f'Unsupported tar member: {member.name}')
+
+
+def extract_tar(path_tar: PathType,
+                path_extract: PathType,
+                n_threads: int = N_RANGE_THREADS,
+                chunk_sz: int = RANGE_CHUNK_SZ,
+                progress: Callable[[int, int], None] = None,
+                ) -> int:
+    """
+    Downloads (in parallel byte ranges) and extracts a tar in one pass,
+        without buffering the whole archive in memory or on disk.
+    The total size, and the sha256 when the S3 object has it in its
+        metadata, are checked once the stream is consumed
+
+    Returns: number of bytes downloaded
+    """
+    if str(path_tar).startswith(S3_URI_PREFIX):
+        fetch, size, sha256_hex = s3_fetcher(path_tar)
+    else:
+        fetch, size, sha256_hex = local_fetcher(path_tar)
+
+    Path(path_extract).mkdir(parents=True, exist_ok=True)
+    with RangedReader(fetch, size, chunk_sz=chunk_sz, n_threads=n_threads,
+                      progress=progress) as reader:
+        with open_tar_stream(reader, path_tar) as tar:
+            for member in tar:
+                _check_member(member)
+                tar.extract(member, path_extract)
+        # Trailing padding after the end-of-archive marker
+        reader.drain()
+        reader.verify(sha256_hex)
+
+    return size
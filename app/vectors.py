@@ -0,0 +1,156 @@
+from typing import Iterator, Tuple
+import numpy as np
+
+METRICS = ('cosine', 'dot', 'euclidean')
+# ANNOY metrics that `exact_dists` can reproduce
+EXACT_METRICS = ('angular', 'euclidean', 'manhattan', 'dot')
+SCORE_CHUNK_ROWS = 1024  # rows of the left matrix scored at once
+KNN_CHUNK_ROWS = 1 << 16  # item rows scored at once for exact neighbors
+# Metric of `score_chunks` ranking like an ANNOY metric
+ANN_SCORE_METRICS = {'angular': 'cosine', 'euclidean': 'euclidean',
+                     'dot': 'dot'}
+
+
+def normalize(embs: np.ndarray) -> np.ndarray:
+    """Unit-normalized rows (zero rows stay zero)"""
+    norms = np.linalg.norm(embs, axis=1, keepdims=True)
+    norms[norms == 0] = 1.
+    return embs / norms
+
+
+def lower_is_better(metric: str) -> bool:
+    """Euclidean scores are distances, the others are similarities"""
+    return metric == 'euclidean'
+
+
+def score_chunks(embs_1: np.ndarray, embs_2: np.ndarray,
+                 metric: str = 'cosine',
+                 chunk_rows: int = SCORE_CHUNK_ROWS,
+                 ) -> Iterator[Tuple[int, np.ndarray]]:
+    """
+    Pairwise scores between the rows of two float32 matrices, computed
+        `chunk_rows` rows of `embs_1` at a time so that the full
+        matrix never has to be held in memory
+
+    Args:
+        embs_1: (n_1, f) vectors
+        embs_2: (n_2, f) vectors
+        metric: one of `METRICS`
+
+    Returns: iterator of (row offset, (chunk_rows, n_2) scores)
+    """
+    if metric not in METRICS:
+        raise ValueError(f'Unknown metric: {metric}')
+
+    if metric == 'cosine':
+        embs_1, embs_2 = normalize(embs_1), normalize(embs_2)
+    elif metric == 'euclidean':
+        sq_norms_2 = np.einsum('ij,ij->i', embs_2, embs_2)
+    embs_2_t = np.ascontiguousarray(embs_2.T)
+
+    for i in range(0, len(embs_1), chunk_rows):
+        chunk = embs_1[i:i + chunk_rows]
+        scores = chunk.dot(embs_2_t)
+        if metric == 'euclidean':
+            # ||a - b||^2 = ||a||^2 + ||b||^2 - 2 a.b
+            scores *= -2
+            scores += np.einsum('ij,ij->i', chunk, chunk)[:, None]
+            scores += sq_norms_2[None, :]
+            np.maximum(scores, 0, out=scores)
+            np.sqrt(scores, out=scores)
+        yield i, scores
+
+
+def top_k(scores: np.ndarray, k: int, metric: str = 'cosine'
+          ) -> Tuple[np.ndarray, np.ndarray]:
+    """Best `k` columns of each row of a score chunk, best first
+
+    Returns: (indices, scores), both (n_rows, min(k, n_cols))
+    """
+    k = min(k, scores.shape[1])
+    keyed = scores if lower_is_better(metric) else -scores
+    if k < scores.shape[1]:
+        inds = np.argpartition(keyed, k - 1, axis=1)[:, :k]
+    else:
+        inds = np.tile(np.arange(scores.shape[1]), (len(scores), 1))
+    part = np.take_along_axis(keyed, inds, axis=1)
+    order = np.argsort(part, axis=1, kind='stable')
+    inds = np.take_along_axis(inds, order, axis=1)
+    return inds, np.take_along_axis(scores, inds, axis=1)
+
+
+def exact_knn(queries: np.ndarray, embs: np.ndarray, k: int,
+              metric: str = 'cosine',
+              chunk_rows: int = KNN_CHUNK_ROWS) -> np.ndarray:
+    """
+    Exact `k` nearest rows of `embs` for every query (brute force),
+        reading `embs` (ex. memory-mapped) `chunk_rows` rows at a time
+        and merging the best of each chunk
+
+    Returns: (n_queries, min(k, n)) indices into `embs`, best first
+    """
+    best_inds = best_scores = None
+    for lo in range(0, len(embs), chunk_rows):
+        chunk = np.asarray(embs[lo:lo + chunk_rows], dtype=np.float32)
+        _, scores = next(score_chunks(
+            queries, chunk, metric, chunk_rows=len(queries)))
+        inds, scores = top_k(scores, k, metric)
+        inds += lo
+        if best_inds is not None:
+            inds = np.concatenate([best_inds, inds], axis=1)
+            scores = np.concatenate([best_scores, scores], axis=1)
+            sel, scores = top_k(scores, k, metric)
+            inds = np.take_along_axis(inds, sel, axis=1)
+        best_inds, best_scores = inds, scores
+    return best_inds
+
+
+def passes(scores: np.ndarray, threshold: float, metric: str = 'cosine'
+           ) -> np.ndarray:
+    """Mask of scores at least as good as `threshold`"""
+    if lower_is_better(metric):
+        return scores <= threshold
+    return scores >= threshold
+
+
+def exact_dists(q_emb: np.ndarray, embs: np.ndarray, metric: str
+                ) -> np.ndarray:
+    """
+    Exact distances from `q_emb` to the rows of `embs`, following
+        ANNOY's conventions for `metric` so they can replace the
+        approximate distances it returns
+        (angular is `sqrt(2 - 2 cos)`, dot is the dot product itself)
+    """
+    if metric == 'angular':
+        cos = normalize(embs).dot(normalize(q_emb[None, :])[0])
+        return np.sqrt(np.maximum(2. - 2. * cos, 0.))
+    elif metric == 'euclidean':
+        return np.linalg.norm(embs - q_emb, axis=1)
+    elif metric == 'manhattan':
+        return np.abs(embs - q_emb).sum(axis=1)
+    elif metric == 'dot':
+        return embs.dot(q_emb)
+    raise ValueError(f'Exact distances not supported for {metric}')
+
+
+def rank_order(dists: np.ndarray, metric: str) -> np.ndarray:
+    """Indices that sort `dists` nearest first"""
+    return np.argsort(-dists if metric == 'dot' else dists, kind='stable')
+
+
+def export_vectors(ann_index, path_vectors, chunk_sz: int = 1 << 16):
+    """
+    Writes every item vector of an ANNOY index to a (n, n_dim) float32
+        `.npy` matrix, so vectors can be memory-mapped instead of being
+        fetched with `get_item_vector` one (python list) at a time
+    """
+    n = ann_index.get_n_items()
+    n_dim = ann_index.f
+    out = np.lib.format.open_memmap(
+        str(path_vectors), mode='w+', dtype=np.float32, shape=(n, n_dim))
+    get_item_vector = ann_index.get_item_vector
+    for lo in range(0, n, chunk_sz):
+        hi = min(lo + chunk_sz, n)
+        out[lo:hi] = [get_item_vector(i) for i in range(lo, hi)]
+    out.flush()
+    del out
@@ -0,0 +1,111 @@
+from annoy import AnnoyIndex
+import datetime
+import shutil
+import threading
+import weakref
+from pathlib import Path
+from time import time
+from typing import Dict, Any, List, Optional, Union
+import numpy as np
+from .io import (
+    load_ann_meta, load_ids, load_index, load_vectors, read_ts,
+    current_version, ANN_INDEX_KEY, ANN_IDS_KEY, ANN_META_KEY,
+    ANN_VECTORS_KEY, ANN_ATTRS_COMPILED_KEY)
+from .attributes import Attributes
+from .ids import IdStore, IdLookup
+from .residency import warm_file, LockedMapping
+from .disk import DiskManager
+from .delta import Delta
+import logging
+
+logging.basicConfig(level=logging.INFO)
+
+PathType = Union[Path, str]
+
+
+def _remove_if_stale(path_version: Path, disk: DiskManager = None):
+    """Deletes a version directory unless it is the `current` one
+    Other workers may still have its files mmapped, which is fine:
+        unlinked files live on until they are unmapped
+    """
+    if current_version(path_version.parent) == path_version:
+        return
+    logging.info(f'Removing stale index version: {path_version}')
+    # Off the request path: this runs when the last reference is dropped
+    threading.Thread(target=shutil.rmtree, args=(str(path_version),),
+                     kwargs={'ignore_errors': True}, daemon=True).start()
+    if disk is not None:
+        disk.discard(path_version)
+
+
+class IndexVersion(object):
+    """
+    Everything that is read from one extracted index directory
+
+    A resource swaps versions with a single reference assignment,
+        and requests take a reference to one version for their whole
+        duration, so ids and index can never be mismatched mid-request.
+    Once the last reference is dropped, the directory is removed
+        (unless it is still the `current` version on disk)
+    """
+
+    def __init__(self, path_version: PathType, disk: DiskManager = None):
+        """
+
+        Args:
+            path_version: extracted version directory
+            disk: accounting of the directory, updated once it is removed
+        """
+        self.path = Path(path_version)
+        self.name = self.path.name
+        self.ts_read: datetime.datetime = read_ts(self.path)
+        self.ann_meta_d: Dict[str, Any] = load_ann_meta(
+            self.path / ANN_META_KEY)
+        ids, ids_d = load_ids(self.path / ANN_IDS_KEY)
+        self.ids: IdStore = ids
+        self.ids_d: IdLookup = ids_d
+        self.path_index = self.path / ANN_INDEX_KEY
+        self.ann_index: AnnoyIndex = load_index(
+            self.path_index, self.ann_meta_d)
+        # Zero-copy item vectors (None for versions extracted without)
+        self.vectors: Optional[np.ndarray] = load_vectors(
+            self.path / ANN_VECTORS_KEY)
+        # Per-item attribute bitmaps, for filtered queries (None if the
+        # tarball has no attributes)
+        path_attrs = self.path / ANN_ATTRS_COMPILED_KEY
+        self.attributes: Optional[Attributes] = (
+            Attributes(path_attrs) if path_attrs.exists() else None)
+
+        # Changes since the base was built (see `ANNResource.load_delta`)
+        self.delta: Optional[Delta] = None
+
+        self._locked: List[LockedMapping] = []
+
+        weakref.finalize(self, _remove_if_stale, self.path, disk)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def warm_up(self, touch_pages: bool = True, mlock: bool = False) -> float:
+        """Exercise the index before it takes traffic
+
+        Args:
+            touch_pages: fault every page of the index, ids and vectors
+                files into the page cache
+            mlock: also lock those pages in RAM for the lifetime
+                of this version
+
+        Returns: seconds spent warming up
+        """
+        tic = time()
+        if touch_pages or mlock:
+            for path in sorted(self.path.iterdir()):
+                if path.name.startswith(
+                        (ANN_INDEX_KEY, ANN_IDS_KEY, ANN_VECTORS_KEY)):
+                    locked = warm_file(path, mlock=mlock)
+                    if locked is not None:
+                        self._locked.append(locked)
+        if len(self):
+            self.ann_index.get_nns_by_item(0, 10)
+            self.ids_d.get(self.ids[len(self) - 1])
+        return time() - tic
@@ -1,27 +1,46 @@
 import falcon
-from typing import Dict, Union
-import boto3
+from typing import Dict, List, Union
 import s3fs
 import os
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from apscheduler.schedulers.background import BackgroundScheduler
 import logging
 try:
     from .app.resources import *
-    from .app.io import load_fallback_map
+    from .app.io import load_fallback_map, dynamodb
+    from .app.cache import ResultCache
+    from .app.ooi import DynamoVectorStore
+    from .app.disk import DiskManager
+    from .app.threads import native_executor
 except ImportError:
     from app.resources import *
-    from app.io import load_fallback_map
+    from app.io import load_fallback_map, dynamodb
+    from app.cache import ResultCache
+    from app.ooi import DynamoVectorStore
+    from app.disk import DiskManager
+    from app.threads import native_executor
 
 logging.basicConfig(level=logging.INFO)
 
 S3_URI_PREFIX = 's3://'
+# Fan-out pool size when there is no batch pool to share
+FANOUT_THREADS = 8
 
 
 PathType = Union[Path, str]
 
 s3 = s3fs.S3FileSystem()
-dynamodb = boto3.resource('dynamodb')
+
+# Started after fork when the app is preloaded in the gunicorn master
+# (scheduler threads do not survive a fork)
+_deferred_schedulers: List[BackgroundScheduler] = []
+
+
+def post_fork():
+    """Called in each worker by the gunicorn `post_fork` hook"""
+    while _deferred_schedulers:
+        _deferred_schedulers.pop().start()
 
 
 def build_single_app(path_tar: PathType):
@@ -29,7 +48,7 @@ def build_single_app(path_tar: PathType):
 
     ann_r = ANNResource(path_tar)
     refresh_r = RefreshResource(ann_r)
-    healthcheck_r = HealthcheckResource(ann_r)
+    healthcheck_r = ANNHealthcheckResource(ann_r)
 
     # handle all requests to the '/ann' URL path
     app.req_options.auto_parse_form_urlencoded = True
@@ -40,10 +59,75 @@ def build_single_app(path_tar: PathType):
     return app
 
 
+def check_fallback_map(fallback_map: Dict[str, str]):
+    """Raises a ValueError if following fallbacks can loop"""
+    for start in fallback_map:
+        chain = [start]
+        while chain[-1] in fallback_map:
+            parent = fallback_map[chain[-1]]
+            if parent in chain:
+                raise ValueError('Loop in fallback map: '
+                                 + ' -> '.join(chain + [parent]))
+            chain.append(parent)
+
+
+def load_all(ann_resources: List[ANNResource],
+             parallelism: int = 8,
+             wait: bool = True,
+             ):
+    """
+    Loads indexes concurrently on a bounded pool
+
+    Args:
+        ann_resources: resources constructed with `defer_load=True`
+        parallelism: max number of indexes downloading/extracting at once
+        wait: if True, block until all indexes are loaded (raising the
+            first failure). Otherwise return immediately; resources
+            answer with a 503 until they are ready
+    """
+    executor = ThreadPoolExecutor(max_workers=max(parallelism, 1))
+    futures = {executor.submit(ann_r.load_initial): ann_r
+               for ann_r in ann_resources}
+
+    def log_failure(fut):
+        if fut.exception() is not None:
+            logging.error(f'Failed loading [{futures[fut].name}]: '
+                          f'{fut.exception()}')
+
+    for fut in futures:
+        fut.add_done_callback(log_failure)
+
+    if wait:
+        for fut in as_completed(futures):
+            fut.result()
+        executor.shutdown()
+        logging.info('***Done loading all indexes***')
+    else:
+        # Pool threads exit once the queued loads have run
+        executor.shutdown(wait=False)
+
+
 def build_many_app(path_ann_dir: PathType,
                    ooi_table_name: str = None,
                    path_fallback_map: PathType = None,
                    check_reload_interval: int = 3600,
+                   batch_threads: int = 0,
+                   latency_target_ms: float = None,
+                   load_parallelism: int = 8,
+                   serve_before_ready: bool = False,
+                   preload: bool = False,
+                   warm_pages: bool = True,
+                   mlock: bool = False,
+                   result_cache_size: int = 0,
+                   result_cache_mb: float = None,
+                   result_cache_ttl_s: float = None,
+                   ooi_cache_size: int = 100000,
+                   ooi_coalesce_ms: float = 2,
+                   disk_budget_mb: float = None,
+                   lazy: bool = False,
+                   pinned: Union[str, List[str]] = None,
+                   memory_budget_mb: float = None,
+                   idle_evict_s: float = None,
                    ):
     """
 
@@ -56,6 +140,41 @@ def build_many_app(path_ann_dir: PathType,
             to name of fallback ANN
         check_reload_interval: if >0, indicates the number of seconds
             between checking for stale indexes and reloading
+        batch_threads: if >0, size of the thread pool shared by the
+            batch query and fan-out endpoints (otherwise batch queries
+            run sequentially, and fan-outs on `FANOUT_THREADS` threads)
+        latency_target_ms: if set, p99 latency target per index;
+            `search_k` is capped for an index while it is over target
+        load_parallelism: max number of indexes loaded concurrently
+        serve_before_ready: if True, start serving immediately while the
+            indexes load in the background (queries to an index that is
+            not loaded yet get a 503, `/` reports loading progress)
+        preload: set if the app is built in the gunicorn master before
+            forking (`gunicorn --preload`), so that indexes, ids and
+            metadata are shared copy-on-write by all workers.
+            All indexes are loaded before returning and the reload
+            scheduler is only started in the workers (see `post_fork`)
+        warm_pages: touch every page of an index before serving it
+        mlock: lock the pages of served indexes in RAM
+        result_cache_size: if >0, max number of `id` query results
+            cached per index (LRU, invalidated on reload)
+        result_cache_mb: optional memory cap of each index's cache
+        result_cache_ttl_s: optional expiry of cached results
+        ooi_cache_size: max number of out-of-index vectors cached
+            (shared by all indexes)
+        ooi_coalesce_ms: concurrent out-of-index lookups within this
+            window are fetched with a single dynamo batch request
+        disk_budget_mb: if set, disk budget of the extracted indexes.
+            Over it, old versions are removed, then the least recently
+            queried indexes are evicted (503 until refreshed)
+        lazy: if True, indexes are only registered from the listing,
+            and downloaded on their first query (except pinned ones)
+        pinned: names (or comma-separated names) of indexes that are
+            loaded on startup and never evicted
+        memory_budget_mb: if set, budget of the indexes served by each
+            worker. Over it, the least recently queried are evicted
+        idle_evict_s: if set, lazy indexes not queried for this long
+            are evicted
 
     Returns: ANN api app
 
@@ -78,12 +197,30 @@ def build_many_app(path_ann_dir: PathType,
         dynamo_tables = {t.name for t in dynamodb.tables.all()}
         if ooi_table_name in dynamo_tables:
             logging.info(f'Using {ooi_table_name} dynamo table for OOI lookup')
-            ooi_dynamo_table = dynamodb.Table(ooi_table_name)
+            # One store (batching, cache) shared by every resource
+            ooi_dynamo_table = DynamoVectorStore(
+                dynamodb.Table(ooi_table_name),
+                cache_size=ooi_cache_size,
+                coalesce_ms=ooi_coalesce_ms)
         else:
             logging.info(f'Using {ooi_table_name} ANN (if exists) '
                          f'for OOI lookup ')
             ooi_ann_name = ooi_table_name
 
+    # Tracks what previous runs left on disk, removing stale versions
+    disk = DiskManager(budget_mb=disk_budget_mb,
+                       memory_budget_mb=memory_budget_mb)
+    disk.scan()
+    if isinstance(pinned, str):
+        pinned = [name for name in pinned.split(',') if name]
+    pinned = set(pinned or [])
+
+    batch_executor = None
+    if batch_threads > 0:
+        # Native threads: under gevent, a plain pool would run the
+        # (blocking) searches one at a time on the hub
+        batch_executor = native_executor(batch_threads)
+
     app.req_options.auto_parse_form_urlencoded = True
     ann_d: Dict[str, ANNResource] = {}
     for path_tar in ann_keys:
@@ -95,12 +232,26 @@ def build_many_app(path_ann_dir: PathType,
 
         ann_r = ANNResource(path_tar,
                             ooi_dynamo_table=ooi_dynamo_table,
-                            name=ann_name)
+                            name=ann_name,
+                            latency_target_ms=latency_target_ms,
+                            defer_load=True,
+                            warm_pages=warm_pages,
+                            mlock=mlock,
+                            result_cache=(
+                                ResultCache(result_cache_size,
+                                            max_mb=result_cache_mb,
+                                            ttl_s=result_cache_ttl_s)
+                                if result_cache_size > 0 else None),
+                            disk=disk,
+                            lazy=lazy,
+                            pinned=ann_name in pinned)
+        batch_r = BatchANNResource(ann_r, executor=batch_executor)
         refresh_r = RefreshResource(ann_r)
         ann_health_r = ANNHealthcheckResource(ann_r)
 
         # automatically handles url encoding
         app.add_route(f"/ann/{ann_name}/query", ann_r)
+        app.add_route(f"/ann/{ann_name}/query/batch", batch_r)
         app.add_route(f"/ann/{ann_name}/refresh", refresh_r)
         app.add_route(f"/ann/{ann_name}/", ann_health_r)
 
@@ -111,10 +262,6 @@ def build_many_app(path_ann_dir: PathType,
                 trigger='interval',
                 seconds=check_reload_interval)
 
-    ann_name_l = [falcon.uri.encode(n) for n in ann_d.keys()]
-
-    logging.info('***Done loading all indexes***')
-
     if ooi_ann_name:
         # Linking OOI ann
         # (if the query is OOI for an ann, look at this other ann for the emb)
@@ -127,8 +274,8 @@ def build_many_app(path_ann_dir: PathType,
     if path_fallback_map:
         # Linking fallbacks
         logging.info('Linking fallback resources...')
-        # TODO: should check that there are no loops in fallback map
         fallback_map = load_fallback_map(path_fallback_map)
+        check_fallback_map(fallback_map)
         for child, parent in fallback_map.items():
             if child in ann_d:
                 ann_d[child].set_fallback(ann_d[parent])
@@ -138,22 +285,56 @@ def build_many_app(path_ann_dir: PathType,
                                fallback_dynamo_table=ooi_dynamo_table)
     app.add_route('/crossq', cross_r)
 
+    # Searched in parallel even without a batch pool, so that a slow
+    # index is cut off by the deadline
+    fanout_r = FanoutANNResource(list(ann_d.values()),
+                                 executor=(batch_executor or
+                                           native_executor(FANOUT_THREADS)),
+                                 fallback_dynamo_table=ooi_dynamo_table)
+    app.add_route('/fanout', fanout_r)
+
     scoring_r = ScoringResource(list(ann_d.values()))
     app.add_route('/score', scoring_r)
 
-    healthcheck_r = HealthcheckResource(ann_name_l)
+    healthcheck_r = HealthcheckResource(
+        {falcon.uri.encode(n): r for n, r in ann_d.items()})
     app.add_route('/', healthcheck_r)
 
     maybe_refresh_all_r = MaybeRefreshAllResource(list(ann_d.values()))
     app.add_route('/refresh-all', maybe_refresh_all_r)
 
-    tmpspace_r = TmpSpaceResource()
+    tmpspace_r = TmpSpaceResource(disk)
     app.add_route('/tmp', tmpspace_r)
 
     sleep_r = SleepResource()
     app.add_route('/sleep', sleep_r)
 
-    if check_reload_interval > 0:
-        scheduler.start()
+    worker_r = WorkerResource()
+    app.add_route('/worker', worker_r)
+
+    metrics_r = MetricsResource()
+    app.add_route('/metrics', metrics_r)
+
+    if preload and serve_before_ready:
+        logging.warning('`serve_before_ready` is ignored when preloading: '
+                        'loading threads would not survive the fork')
+    # Lazy indexes are loaded by their first query
+    load_all([ann_r for ann_r in ann_d.values()
+              if not lazy or ann_r.pinned],
+             parallelism=load_parallelism,
+             wait=preload or not serve_before_ready)
+
+    if idle_evict_s:
+        scheduler.add_job(
+            func=disk.evict_idle,
+            args=[idle_evict_s],
+            trigger='interval',
+            seconds=max(idle_evict_s / 4., 1.))
+
+    if scheduler.get_jobs():
+        if preload:
+            _deferred_schedulers.append(scheduler)
+        else:
+            scheduler.start()
 
     return app
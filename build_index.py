@@ -0,0 +1,602 @@
+# Builds an index tarball from many parts of vectors (Avro, Parquet or NPY)
+# python build_index.py s3://my-bucket/vecs/cat_a/ s3://my-bucket/ann/cat_a.tar.gz
+#   --n-trees 10 --n-jobs -1
+#
+# Unlike the lambda (one Avro part, built in memory), parts are read in
+# batches, trees are built in parallel and the tarball is streamed to its
+# destination, so catalogs can be larger than memory
+#
+# Attributes of the rows of a part (for filtered queries) are read from
+# `<part>.attributes.jsonl`, a JSON object per row, if there is one
+#
+# Compacting a delta (see `app/delta.py`) into a new base index:
+# python build_index.py --base s3://my-bucket/ann/cat_a.tar.gz
+#   --delta s3://my-bucket/ann/cat_a.delta.npz s3://my-bucket/ann/cat_a.tar.gz
+import argparse
+import json
+import os
+import tarfile
+import tempfile
+from datetime import datetime
+from pathlib import Path
+from io import BytesIO
+from time import time
+from typing import Dict, Iterator, List, Tuple, Union
+import numpy as np
+import s3fs
+from annoy import AnnoyIndex
+from app.vectors import exact_knn, export_vectors, ANN_SCORE_METRICS
+from app.delta import as_vectors
+import logging
+
+logging.basicConfig(level=logging.INFO)
+
+S3_URI_PREFIX = 's3://'
+METRIC = 'angular'
+FACTORS_KEY = 'factors'
+ID_KEY = 'id'
+N_TREES = 10
+BATCH_SIZE = 10000
+IDS_NAME = 'ids.txt'
+INDEX_NAME = 'index.ann'
+META_NAME = 'metadata.json'
+VECTORS_NAME = 'vectors.npy'
+ATTRS_NAME = 'attributes.jsonl'  # per-item attributes, as ids.txt
+PART_SUFFIXES = ('.avro', '.parquet', '.npy')
+NPY_IDS_SUFFIX = '.ids.txt'  # ids of `part.npy` are in `part.ids.txt`
+# Attributes of the rows of any part (a JSON object per line), if any
+ATTRS_SUFFIX = '.attributes.jsonl'
+NPY_HEADER_LEN = 128  # room for any 2-d shape, rewritten once it is known
+# Tuning: recall@k over held out items, with these grids by default
+TUNE_K = 10
+TUNE_N_QUERIES = 1000
+TUNE_N_TREES = [5, 10, 20, 50, 100]
+TUNE_SEARCH_K_MULTS = [1, 2, 4, 8, 16, 32]  # x ANNOY's default n_trees * k
+
+PathType = Union[Path, str]
+Batch = Tuple[List, np.ndarray]  # (ids, float32 vectors)
+
+s3 = s3fs.S3FileSystem()
+
+
+def is_s3_path(path: PathType) -> bool:
+    return str(path).startswith(S3_URI_PREFIX)
+
+
+def open_fn(path: PathType, mode: str = 'rb'):
+    return s3.open(str(path), mode) if is_s3_path(path) \
+        else open(str(path), mode)
+
+
+def list_parts(paths: List[str]) -> List[str]:
+    """Part files of the given files and directories (or s3 prefixes)"""
+    parts = []
+    for path in paths:
+        if path.endswith(PART_SUFFIXES):
+            parts.append(path)
+        elif is_s3_path(path):
+            parts += sorted(
+                S3_URI_PREFIX + p for p in s3.find(path)
+                if p.endswith(PART_SUFFIXES))
+        else:
+            parts += sorted(str(p) for p in Path(path).rglob('*')
+                            if p.name.endswith(PART_SUFFIXES))
+    return parts
+
+
+def read_avro(path: str, batch_size: int) -> Iterator[Batch]:
+    import fastavro  # only needed for Avro parts
+
+    ids, vecs = [], []
+    with open_fn(path) as f:
+        for record in fastavro.reader(f):
+            ids.append(record[ID_KEY])
+            vecs.append(record[FACTORS_KEY])
+            if len(ids) == batch_size:
+                yield ids, np.asarray(vecs, dtype=np.float32)
+                ids, vecs = [], []
+    if ids:
+        yield ids, np.asarray(vecs, dtype=np.float32)
+
+
+def read_parquet(path: str, batch_size: int) -> Iterator[Batch]:
+    import pyarrow.parquet as pq  # only needed for Parquet parts
+
+    with open_fn(path) as f:
+        pf = pq.ParquetFile(f)
+        for i in range(pf.num_row_groups):
+            table = pf.read_row_group(i, columns=[ID_KEY, FACTORS_KEY])
+            ids = table.column(ID_KEY).to_pylist()
+            # List column -> one flat array, without a python list per row
+            flat = np.concatenate([
+                np.asarray(chunk.flatten(), dtype=np.float32)
+                for chunk in table.column(FACTORS_KEY).chunks])
+            vecs = flat.reshape(len(ids), -1)
+            for start in range(0, len(ids), batch_size):
+                yield (ids[start:start + batch_size],
+                       vecs[start:start + batch_size])
+
+
+def read_npy(path: str, batch_size: int, id_offset: int) -> Iterator[Batch]:
+    """Ids come from `<part>.ids.txt` (one per line) if there is one,
+    otherwise they are the row numbers over all parts
+    """
+    if is_s3_path(path):
+        with open_fn(path) as f:
+            vecs = np.load(f)
+    else:
+        vecs = np.load(path, mmap_mode='r')
+    path_ids = path[:-len('.npy')] + NPY_IDS_SUFFIX
+    if path_exists(path_ids):
+        with open_fn(path_ids) as f:
+            ids = f.read().decode('utf-8').splitlines()
+        if len(ids) != len(vecs):
+            raise ValueError(f'{path_ids}: {len(ids)} ids '
+                             f'for {len(vecs)} vectors')
+    else:
+        ids = [str(id_offset + i) for i in range(len(vecs))]
+    for start in range(0, len(vecs), batch_size):
+        yield (ids[start:start + batch_size],
+               np.asarray(vecs[start:start + batch_size], dtype=np.float32))
+
+
+def attributes_path(path: str) -> str:
+    return path.rsplit('.', 1)[0] + ATTRS_SUFFIX
+
+
+def path_exists(path: str) -> bool:
+    return s3.exists(path) if is_s3_path(path) else os.path.exists(path)
+
+
+def iter_batches(path: str, batch_size: int,
+                 id_offset: int = 0) -> Iterator[Batch]:
+    if path.endswith('.avro'):
+        return read_avro(path, batch_size)
+    elif path.endswith('.parquet'):
+        return read_parquet(path, batch_size)
+    elif path.endswith('.npy'):
+        return read_npy(path, batch_size, id_offset)
+    raise ValueError(f'Unknown part format: {path}')
+
+
+class NpyWriter(object):
+    """
+    Appends float32 rows to a `.npy` file whose number of rows is only
+        known at the end (the header is written with the final shape,
+        padded to the same length, on `close`)
+    """
+
+    def __init__(self, path: PathType, n_dim: int):
+        self.path = Path(path)
+        self.n_dim = n_dim
+        self.n_rows = 0
+        self.f = open(self.path, 'wb')
+        self.f.write(self._header())
+
+    def _header(self) -> bytes:
+        header = (f"{{'descr': '<f4', 'fortran_order': False, "
+                  f"'shape': ({self.n_rows}, {self.n_dim}), }}")
+        # Magic + version + header length, data aligned
+        n_pad = NPY_HEADER_LEN - (10 + len(header) + 1)
+        header = (header + ' ' * n_pad + '\n').encode('latin1')
+        return (b'\x93NUMPY\x01\x00' + len(header).to_bytes(2, 'little')
+                + header)
+
+    def write(self, vecs: np.ndarray):
+        self.f.write(np.ascontiguousarray(vecs, dtype='<f4').tobytes())
+        self.n_rows += len(vecs)
+
+    def close(self):
+        self.f.seek(0)
+        self.f.write(self._header())
+        self.f.close()
+
+
+def compact_parts(path_base: str, path_delta: str, path_work: PathType,
+                  batch_size: int = BATCH_SIZE) -> Tuple[List[str], Dict]:
+    """
+    Parts of a new base index: the items of the base tarball that the
+        delta neither removes nor changes, then the items of the delta
+
+    Returns: the NPY parts (with their ids) and the base metadata
+    """
+    path_work = Path(path_work)
+    path_base_dir = path_work / 'base'
+    with open_fn(path_base) as f, \
+            tarfile.open(fileobj=f, mode='r|*') as tar:
+        tar.extractall(str(path_base_dir))
+    with open(path_base_dir / META_NAME) as f:
+        base_meta_d = json.load(f)
+    with open_fn(path_delta) as f, \
+            np.load(BytesIO(f.read()), allow_pickle=False) as npz:
+        if str(npz['base_timestamp_utc']) != base_meta_d['timestamp_utc']:
+            raise ValueError(f'{path_delta} was not made for {path_base}')
+        delta_ids = npz['ids'].tolist()
+        delta_vectors = as_vectors(npz['vectors'], len(delta_ids),
+                                   base_meta_d['n_dim'])
+        superseded = set(delta_ids).union(npz['tombstones'].tolist())
+
+    if not (path_base_dir / VECTORS_NAME).exists():
+        ann = AnnoyIndex(base_meta_d['n_dim'], base_meta_d['metric'])
+        ann.load(str(path_base_dir / INDEX_NAME))
+        export_vectors(ann, path_base_dir / VECTORS_NAME)
+        ann.unload()
+    vectors = np.load(str(path_base_dir / VECTORS_NAME), mmap_mode='r')
+    with open(path_base_dir / IDS_NAME) as f:
+        ids = f.read().splitlines()
+    attrs = None
+    if (path_base_dir / ATTRS_NAME).exists():
+        with open(path_base_dir / ATTRS_NAME) as f:
+            attrs = f.read().splitlines()
+
+    path_parts = path_work / 'parts'
+    path_parts.mkdir()
+    writer = NpyWriter(path_parts / 'base.npy', vectors.shape[1])
+    with open(path_parts / f'base{NPY_IDS_SUFFIX}', 'w') as f_ids:
+        for lo in range(0, len(ids), batch_size):
+            keep = np.array([id_ not in superseded
+                             for id_ in ids[lo:lo + batch_size]], dtype=bool)
+            writer.write(vectors[lo:lo + batch_size][keep])
+            f_ids.write(''.join(
+                f'{id_}\n' for id_, k in zip(ids[lo:lo + batch_size], keep)
+                if k))
+    writer.close()
+    np.save(path_parts / 'delta.npy', delta_vectors)
+    with open(path_parts / f'delta{NPY_IDS_SUFFIX}', 'w') as f_ids:
+        f_ids.write('\n'.join(delta_ids))
+    if attrs is not None:
+        # Changed items keep their attributes, added ones have none
+        inds = {id_: i for i, id_ in enumerate(ids) if id_ in superseded}
+        with open(path_parts / f'base{ATTRS_SUFFIX}', 'w') as f:
+            f.write(''.join(f'{a}\n' for id_, a in zip(ids, attrs)
+                            if id_ not in superseded))
+        with open(path_parts / f'delta{ATTRS_SUFFIX}', 'w') as f:
+            f.write(''.join(
+                f'{attrs[inds[id_]] if id_ in inds else "{}"}\n'
+                for id_ in delta_ids))
+    logging.info(f'Compacting: {writer.n_rows} base items kept, '
+                 f'{len(delta_ids)} from the delta')
+    return [str(path_parts / 'base.npy'), str(path_parts / 'delta.npy')], \
+        base_meta_d
+
+
+def tar_mode(path_out: str) -> str:
+    """Streaming (`|`) tar modes: nothing is seeked, nor kept in memory"""
+    if path_out.endswith(('.tar.gz', '.tgz')):
+        return 'w|gz'
+    elif path_out.endswith('.tar'):
+        return 'w|'
+    raise ValueError(f'Unsupported tarball extension: {path_out}')
+
+
+def build_annoy(vectors: np.ndarray, path_index: PathType, metric: str,
+                n_trees: int, n_jobs: int = -1,
+                batch_size: int = BATCH_SIZE) -> float:
+    """Builds (on disk) an index of the rows of `vectors`
+
+    Returns: seconds spent building the trees
+    """
+    ann = AnnoyIndex(vectors.shape[1], metric)
+    ann.on_disk_build(str(path_index))
+    for lo in range(0, len(vectors), batch_size):
+        batch = np.asarray(vectors[lo:lo + batch_size]).tolist()
+        for i, v in enumerate(batch, start=lo):
+            ann.add_item(i, v)
+    tic = time()
+    logging.info(f'Building {n_trees} trees over {len(vectors)} items')
+    try:
+        ann.build(n_trees, n_jobs=n_jobs)
+    except TypeError:
+        # ANNOY < 1.17: no `n_jobs`
+        ann.build(n_trees)
+    build_s = time() - tic
+    ann.unload()
+    return build_s
+
+
+def measure(ann: AnnoyIndex, queries: np.ndarray, q_inds: np.ndarray,
+            truth: np.ndarray, k: int, search_k: int) -> Dict:
+    """Recall@k (the query item itself left out) and latency"""
+    n_hits = 0
+    latencies = []
+    for q, q_ind, truth_q in zip(queries.tolist(), q_inds.tolist(), truth):
+        tic = time()
+        inds = ann.get_nns_by_vector(q, k + 1, search_k=search_k)
+        latencies.append(time() - tic)
+        inds = [i for i in inds if i != q_ind][:k]
+        n_hits += len(set(inds).intersection(truth_q.tolist()))
+    latencies_ms = np.array(latencies) * 1000.
+    return {
+        'search_k': search_k,
+        'recall': n_hits / (k * len(queries)),
+        'p50_ms': float(np.percentile(latencies_ms, 50)),
+        'p99_ms': float(np.percentile(latencies_ms, 99)),
+    }
+
+
+def tune(vectors: np.ndarray, path_work: PathType, metric: str,
+         target_recall: float,
+         k: int = TUNE_K,
+         n_queries: int = TUNE_N_QUERIES,
+         n_trees_grid: List[int] = TUNE_N_TREES,
+         search_k_mults: List[int] = TUNE_SEARCH_K_MULTS,
+         max_latency_ms: float = None,
+         n_jobs: int = -1,
+         batch_size: int = BATCH_SIZE,
+         seed: int = 0,
+         ) -> Dict:
+    """
+    Finds the cheapest (fewest trees, then smallest `search_k`)
+        configuration whose recall@k over a sample of held out items
+        meets `target_recall`, with a p99 latency under `max_latency_ms`
+
+    An index is built per `n_trees` (in increasing order, stopping at
+        the first that meets the targets); `search_k` is swept over
+        multiples of ANNOY's default (`n_trees * k`)
+
+    Returns: the chosen `n_trees`, `search_k` (the best recall if
+        nothing meets the targets), its index path and build time, and
+        the stats with the whole curve
+    """
+    if metric not in ANN_SCORE_METRICS:
+        raise ValueError(f'Cannot tune metric {metric}')
+    path_work = Path(path_work)
+    rng = np.random.RandomState(seed)
+    q_inds = np.sort(rng.choice(
+        len(vectors), min(n_queries, len(vectors)), replace=False))
+    queries = np.asarray(vectors[q_inds], dtype=np.float32)
+
+    tic = time()
+    truth = exact_knn(queries, vectors, k + 1, ANN_SCORE_METRICS[metric])
+    # Leave the query item itself out
+    truth = np.array([[i for i in row if i != q_ind][:k]
+                      for row, q_ind in zip(truth.tolist(), q_inds.tolist())])
+    truth_s = time() - tic
+
+    curve = []
+    chosen = best = None
+    for n_trees in sorted(n_trees_grid):
+        path_index = path_work / f'index-{n_trees}.ann'
+        build_s = build_annoy(vectors, path_index, metric, n_trees,
+                              n_jobs=n_jobs, batch_size=batch_size)
+        ann = AnnoyIndex(vectors.shape[1], metric)
+        ann.load(str(path_index))
+        for mult in sorted(search_k_mults):
+            point = {'n_trees': n_trees, 'build_s': build_s, **measure(
+                ann, queries, q_inds, truth, k, mult * n_trees * k)}
+            logging.info(f'Tuning: {point}')
+            curve.append(point)
+            if best is None or point['recall'] > best['recall']:
+                best = point
+            if point['recall'] >= target_recall and (
+                    max_latency_ms is None
+                    or point['p99_ms'] <= max_latency_ms):
+                chosen = point
+                break
+        ann.unload()
+        if chosen is not None:
+            break
+    met = chosen is not None
+    if not met:
+        logging.warning(f'No configuration meets recall {target_recall}'
+                        f', using the best: {best}')
+        chosen = best
+    for n_trees in n_trees_grid:
+        path_index = path_work / f'index-{n_trees}.ann'
+        if n_trees != chosen['n_trees'] and path_index.exists():
+            path_index.unlink()
+
+    return {
+        'n_trees': chosen['n_trees'],
+        'search_k': chosen['search_k'],
+        'build_s': chosen['build_s'],
+        'path_index': path_work / f'index-{chosen["n_trees"]}.ann',
+        'stats': {
+            'k': k,
+            'target_recall': target_recall,
+            'max_latency_ms': max_latency_ms,
+            'n_queries': len(queries),
+            'truth_s': truth_s,
+            'recall': chosen['recall'],
+            'p99_ms': chosen['p99_ms'],
+            'met': met,
+            'curve': curve,
+        },
+    }
+
+
+def build(parts: List[str],
+          path_out: str,
+          path_work: PathType,
+          metric: str = METRIC,
+          n_trees: int = N_TREES,
+          n_jobs: int = -1,
+          batch_size: int = BATCH_SIZE,
+          vec_src: str = None,
+          tune_kwargs: Dict = None,
+          ) -> Dict:
+    """
+    Args:
+        parts: Avro, Parquet or NPY files of (id, vector), each
+            with optional attributes of its rows in
+            `<part>.attributes.jsonl` (for filtered queries)
+        path_out: local or s3 path of the tarball (`.tar.gz` or `.tar`)
+        path_work: local directory for the index, ids and vectors
+            (ANNOY builds on disk, and vectors are memory-mapped, so
+            memory does not grow with the catalog)
+        metric: ANNOY metric
+        n_trees: number of trees (unless tuned)
+        n_jobs: threads building the trees (-1: all cores).
+            Needs ANNOY >= 1.17, built on a single thread otherwise
+        batch_size: vectors read at a time
+        vec_src: where the vectors come from (in the metadata)
+        tune_kwargs: if set, `n_trees` and the serving default
+            `search_k` are tuned (see `tune`) with these arguments,
+            which must include `target_recall`
+
+    Returns: the metadata written to the tarball
+    """
+    path_work = Path(path_work)
+    ts_read = datetime.utcnow().isoformat()
+
+    tic = time()
+    writer = None
+    n_attrs_parts = 0
+    with open(path_work / IDS_NAME, 'w') as f_ids, \
+            open(path_work / ATTRS_NAME, 'w') as f_attrs:
+        for part in parts:
+            logging.info(f'Reading {part}')
+            n = 0 if writer is None else writer.n_rows
+            f_part_attrs = None
+            if path_exists(attributes_path(part)):
+                f_part_attrs = open_fn(attributes_path(part), 'r')
+                n_attrs_parts += 1
+            for ids, vecs in iter_batches(part, batch_size, id_offset=n):
+                if writer is None:
+                    writer = NpyWriter(path_work / VECTORS_NAME,
+                                       vecs.shape[1])
+                elif vecs.shape[1] != writer.n_dim:
+                    raise ValueError(f'{part}: dimension {vecs.shape[1]} '
+                                     f'instead of {writer.n_dim}')
+                f_ids.write(''.join(f'{id_}\n' for id_ in ids))
+                writer.write(vecs)
+                f_attrs.write(''.join(
+                    f'{f_part_attrs.readline().strip() or "{}"}\n'
+                    if f_part_attrs is not None else '{}\n'
+                    for _ in ids))
+            if f_part_attrs is not None:
+                f_part_attrs.close()
+    if writer is None:
+        raise ValueError('No vectors to build an index from')
+    writer.close()
+    if not n_attrs_parts:
+        os.remove(path_work / ATTRS_NAME)
+    read_s = time() - tic
+    vectors = np.load(str(path_work / VECTORS_NAME), mmap_mode='r')
+
+    tuned = None
+    if tune_kwargs:
+        tuned = tune(vectors, path_work, metric, n_jobs=n_jobs,
+                     batch_size=batch_size, **tune_kwargs)
+        n_trees = tuned['n_trees']
+        os.replace(str(tuned['path_index']), str(path_work / INDEX_NAME))
+        build_s = tuned['build_s']
+    else:
+        build_s = build_annoy(vectors, path_work / INDEX_NAME, metric,
+                              n_trees, n_jobs=n_jobs, batch_size=batch_size)
+
+    meta_d = {
+        'vec_src': vec_src or ','.join(parts),
+        'metric': metric,
+        'n_dim': writer.n_dim,
+        'timestamp_utc': ts_read,
+        'build': {
+            'n_items': writer.n_rows,
+            'n_trees': n_trees,
+            'n_jobs': n_jobs,
+            'n_parts': len(parts),
+            'n_attributes_parts': n_attrs_parts,
+            'read_s': read_s,
+            'build_s': build_s,
+            'index_bytes': os.path.getsize(path_work / INDEX_NAME),
+            'vectors_bytes': os.path.getsize(path_work / VECTORS_NAME),
+        },
+    }
+    if tuned is not None:
+        # Serving default (see `ANNResource.search_k_for`)
+        meta_d['search_k'] = tuned['search_k']
+        meta_d['tuning'] = tuned['stats']
+    with open(path_work / META_NAME, 'w') as f:
+        json.dump(meta_d, f)
+    del vectors
+
+    tic = time()
+    logging.info(f'Writing {path_out}')
+    # The vectors are always shipped: the service mmaps them (for exact
+    # reranking and filtered search) rather than exporting them on load
+    names = [INDEX_NAME, IDS_NAME, META_NAME, VECTORS_NAME] + (
+        [ATTRS_NAME] if n_attrs_parts else [])
+    with open_fn(path_out, 'wb') as fo, \
+            tarfile.open(fileobj=fo, mode=tar_mode(path_out)) as tar:
+        for name in names:
+            tar.add(str(path_work / name), arcname=name)
+    logging.info(f'...Done [{time() - tic:.1f} s]')
+    return meta_d
+
+
+def int_list(s: str) -> List[int]:
+    return [int(x) for x in s.split(',')]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Builds an ANN index tarball from parts of vectors')
+    parser.add_argument('inputs', nargs='*',
+                        help='part files, directories or s3 prefixes')
+    parser.add_argument('output', help='local or s3 path of the tarball')
+    parser.add_argument('--metric', default=None,
+                        help=f'default: {METRIC}, or the metric of --base')
+    parser.add_argument('--base', default=None,
+                        help='index tarball to compact --delta into')
+    parser.add_argument('--delta', default=None,
+                        help='delta file (`.delta.npz`) of --base')
+    parser.add_argument('--n-trees', type=int, default=N_TREES)
+    parser.add_argument('--n-jobs', type=int, default=-1)
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+    parser.add_argument('--work-dir', default=None,
+                        help='local scratch directory (default: a temp dir)')
+    tuning = parser.add_argument_group(
+        'tuning', 'pick n_trees and search_k for a target recall@k')
+    tuning.add_argument('--target-recall', type=float, default=None,
+                        help='tune if set (ex. 0.9)')
+    tuning.add_argument('--recall-k', type=int, default=TUNE_K)
+    tuning.add_argument('--max-latency-ms', type=float, default=None,
+                        help='p99 latency target of a single query')
+    tuning.add_argument('--n-queries', type=int, default=TUNE_N_QUERIES)
+    tuning.add_argument('--n-trees-grid', type=int_list,
+                        default=TUNE_N_TREES)
+    tuning.add_argument('--search-k-mults', type=int_list,
+                        default=TUNE_SEARCH_K_MULTS,
+                        help='multiples of n_trees * k')
+    args = parser.parse_args()
+
+    tune_kwargs = None
+    if args.target_recall is not None:
+        tune_kwargs = {
+            'target_recall': args.target_recall,
+            'k': args.recall_k,
+            'n_queries': args.n_queries,
+            'n_trees_grid': args.n_trees_grid,
+            'search_k_mults': args.search_k_mults,
+            'max_latency_ms': args.max_latency_ms,
+        }
+
+    if bool(args.base) == bool(args.inputs) or \
+            bool(args.base) != bool(args.delta):
+        parser.error('either inputs, or --base and --delta')
+
+    with tempfile.TemporaryDirectory(dir=args.work_dir) as path_work:
+        metric = args.metric or METRIC
+        if args.base:
+            parts, base_meta_d = compact_parts(
+                args.base, args.delta, path_work,
+                batch_size=args.batch_size)
+            metric = args.metric or base_meta_d['metric']
+            vec_src = f'{args.base}+{args.delta}'
+        else:
+            parts = list_parts(args.inputs)
+            vec_src = ','.join(args.inputs)
+        logging.info(f'{len(parts)} parts')
+        meta_d = build(parts, args.output, path_work,
+                       metric=metric,
+                       n_trees=args.n_trees,
+                       n_jobs=args.n_jobs,
+                       batch_size=args.batch_size,
+                       vec_src=vec_src,
+                       tune_kwargs=tune_kwargs)
+    print(json.dumps({k: meta_d.get(k) for k in ('build', 'search_k')},
+                     indent=2))
+
+
+if __name__ == '__main__':
+    main()
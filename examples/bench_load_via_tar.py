@@ -0,0 +1,114 @@
+# Benchmarks index download + extraction against a local S3 stand-in (moto)
+# python examples/bench_load_via_tar.py --size-mb 256
+import argparse
+import os
+import shutil
+import sys
+import tarfile
+import tempfile
+from io import BytesIO
+from pathlib import Path
+from time import time
+
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+os.environ.setdefault('AWS_ACCESS_KEY_ID', 'testing')
+os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'testing')
+
+try:
+    from moto import mock_aws
+except ImportError:  # moto<5
+    from moto import mock_s3 as mock_aws
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+BUCKET = 'bench-bucket'
+
+
+def make_tar(path: Path, size_mb: int, mode: str):
+    index_bytes = os.urandom(size_mb * 2 ** 20)
+    ids_bytes = '\n'.join(map(str, range(100000))).encode('utf-8')
+    meta_bytes = b'{"metric": "angular", "n_dim": 64}'
+
+    def add(tar, name, data):
+        info = tarfile.TarInfo(name=name)
+        info.size = len(data)
+        tar.addfile(info, BytesIO(data))
+
+    if mode == 'zst':
+        import zstandard
+        with open(path, 'wb') as fo, \
+                zstandard.ZstdCompressor().stream_writer(fo) as zfo, \
+                tarfile.open(fileobj=zfo, mode='w|') as tar:
+            add(tar, 'index.ann', index_bytes)
+            add(tar, 'ids.txt', ids_bytes)
+            add(tar, 'metadata.json', meta_bytes)
+    else:
+        with tarfile.open(path, mode=f'w:{mode}') as tar:
+            add(tar, 'index.ann', index_bytes)
+            add(tar, 'ids.txt', ids_bytes)
+            add(tar, 'metadata.json', meta_bytes)
+
+
+def extract_baseline(path_tar: str, path_extract: Path):
+    """What `load_via_tar` used to do"""
+    import s3fs
+    s3 = s3fs.S3FileSystem()
+    s3.invalidate_cache()
+    ann_tar = tarfile.open(fileobj=s3.open(path_tar, 'rb'))
+    ann_tar.extractall(path_extract)
+
+
+def bench(fn, *args, repeat=3):
+    times = []
+    for _ in range(repeat):
+        tic = time()
+        fn(*args)
+        times.append(time() - tic)
+    return min(times)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size-mb', type=int, default=64)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    modes = ['', 'gz']
+    try:
+        import zstandard  # noqa: F401
+        modes.append('zst')
+    except ImportError:
+        pass
+
+    with mock_aws(), tempfile.TemporaryDirectory() as tmp:
+        import boto3
+        from app import transfer
+        transfer.s3_client = boto3.client('s3')
+        transfer.s3_client.create_bucket(Bucket=BUCKET)
+
+        for mode in modes:
+            suffix = '.tar' + (f'.{mode}' if mode else '')
+            path_local = Path(tmp) / f'index{suffix}'
+            make_tar(path_local, args.size_mb, mode)
+            key = f'ann/index{suffix}'
+            transfer.s3_client.upload_file(str(path_local), BUCKET, key)
+            path_tar = f's3://{BUCKET}/{key}'
+            path_extract = Path(tmp) / 'extract'
+
+            results = {}
+            if mode != 'zst':  # `tarfile` alone can not read zstd
+                results['baseline'] = bench(
+                    extract_baseline, path_tar, path_extract,
+                    repeat=args.repeat)
+                shutil.rmtree(path_extract)
+            results['extract_tar'] = bench(
+                transfer.extract_tar, path_tar, path_extract,
+                repeat=args.repeat)
+            shutil.rmtree(path_extract)
+
+            print(f'{suffix:8s} {path_local.stat().st_size / 2 ** 20:8.1f} MiB'
+                  + ''.join(f'  {k}: {v:6.2f} s' for k, v in results.items()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+# Micro-benchmarks the response encodings of query and vector endpoints
+# python examples/bench_serialization.py --k 500 --n-dim 256
+import argparse
+import json
+import random
+import sys
+from pathlib import Path
+from timeit import timeit
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from app import encoding  # noqa: E402
+from app.neighbors import Neighbors  # noqa: E402
+
+
+class _Resp(object):
+    """Stand-in for a falcon response"""
+    content_type = body = data = None
+
+
+def bench(name, fn, n_iter):
+    resp = _Resp()
+    fn(resp)
+    n_bytes = len(resp.data if resp.data is not None
+                  else resp.body.encode('utf-8'))
+    sec = timeit(lambda: fn(_Resp()), number=n_iter) / n_iter
+    print(f'{name:<24}{sec * 1e6:>10.1f} us{n_bytes:>10d} bytes')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--k', type=int, default=500)
+    parser.add_argument('--n-dim', type=int, default=256)
+    parser.add_argument('--n-iter', type=int, default=200)
+    args = parser.parse_args()
+
+    neighbors = Neighbors(
+        ids=[str(random.randrange(10 ** 9)) for _ in range(args.k)],
+        dists=[random.random() * 2 for _ in range(args.k)])
+    emb = [random.gauss(0, 1) for _ in range(args.n_dim)]
+
+    print(f'Query: k={args.k} (ids, dists, scores)')
+
+    def stdlib_json(resp):
+        # Encoding before content negotiation
+        resp.body = json.dumps({
+            'recs': [n.to_dict(True, True) for n in list(neighbors)],
+            'id_type': '-'})
+    bench('stdlib json', stdlib_json, args.n_iter)
+
+    for fmt in encoding.FORMATS:
+        if fmt == 'msgpack' and encoding.msgpack is None:
+            continue
+
+        def encode(resp, fmt=fmt):
+            encoding.set_body(resp, encoding.recs_body(
+                neighbors, True, True, fmt, id_type='-'), fmt)
+        bench(fmt, encode, args.n_iter)
+
+    print(f'Vector: n_dim={args.n_dim}')
+
+    def stdlib_json_vector(resp):
+        resp.body = json.dumps(emb)
+    bench('stdlib json', stdlib_json_vector, args.n_iter)
+
+    for fmt in encoding.VECTOR_FORMATS:
+        if fmt == 'msgpack' and encoding.msgpack is None:
+            continue
+
+        def encode_vector(resp, fmt=fmt):
+            encoding.set_vector_body(resp, emb, fmt)
+        bench(fmt, encode_vector, args.n_iter)
+
+
+if __name__ == '__main__':
+    main()
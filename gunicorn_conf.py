@@ -0,0 +1,32 @@
+# gunicorn -c gunicorn_conf.py ...
+import os
+import shutil
+
+# Preloading builds the app (and loads every index) in the master
+# before forking. Gevent must then be patched in the master as well,
+# otherwise locks created while loading are not cooperative in the workers
+preload_app = os.environ.get('ANN_PRELOAD') == 'True'
+if preload_app and os.environ.get('ANN_WORKER_CLASS', 'gevent') == 'gevent':
+    from gevent import monkey
+    monkey.patch_all()
+
+
+def on_starting(server):
+    # Samples of a previous run would otherwise be aggregated in
+    multiproc_dir = os.environ.get('PROMETHEUS_MULTIPROC_DIR') \
+        or os.environ.get('prometheus_multiproc_dir')
+    if multiproc_dir:
+        shutil.rmtree(multiproc_dir, ignore_errors=True)
+        os.makedirs(multiproc_dir)
+
+
+def child_exit(server, worker):
+    from app.metrics import mark_process_dead
+    mark_process_dead(worker.pid)
+
+
+def post_fork(server, worker):
+    if preload_app:
+        # Already imported by the master
+        from app_builder import post_fork as app_post_fork
+        app_post_fork()
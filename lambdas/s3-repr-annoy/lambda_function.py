@@ -1,4 +1,8 @@
+# Builds an index from a single Avro part, in memory.
+# Catalogs with many parts (or too large for a lambda) are built with
+# `build_index.py` instead (batched reads, parallel build, streamed tar)
 import json
+from array import array
 import fastavro as avro
 import s3fs
 from annoy import AnnoyIndex
@@ -17,6 +21,10 @@ PATH_DISK_SAVE = '/tmp/index.ann'
 IDS_NAME = 'ids.txt'
 INDEX_NAME = 'index.ann'
 META_NAME = 'metadata.json'
+VECTORS_NAME = 'vectors.npy'
+# Ship the raw float32 vectors, so the service can mmap them
+# (instead of exporting them from the index on every load)
+EXPORT_VECTORS = True
 
 fs = s3fs.S3FileSystem()
 open_fn = fs.open
@@ -24,6 +32,7 @@ open_fn = fs.open
 
 def load_data(path_data):
     ids = []
+    vecs = array('f')  # packed float32, row-major
     with open_fn(path_data, 'rb') as f:
         for i, record in enumerate(avro.reader(f)):
             v = record[FACTORS_KEY]
@@ -34,10 +43,23 @@ def load_data(path_data):
 
             ann.add_item(i, v)
             ids.append(record[ID_KEY])
-    return ann, ids
+            if EXPORT_VECTORS:
+                vecs.extend(v)
+    return ann, ids, vecs
 
 
-def create_tarball(ids, meta_d):
+def npy_bytes(vecs: array, n_dim: int) -> bytes:
+    """(n, n_dim) float32 `.npy` file (v1.0 format), without numpy"""
+    header = (f"{{'descr': '<f4', 'fortran_order': False, "
+              f"'shape': ({len(vecs) // n_dim}, {n_dim}), }}")
+    # Magic + version + header length, data aligned to 64 bytes
+    n_pad = 64 - (10 + len(header) + 1) % 64
+    header = (header + ' ' * n_pad + '\n').encode('latin1')
+    return (b'\x93NUMPY\x01\x00' + len(header).to_bytes(2, 'little')
+            + header + vecs.tobytes())
+
+
+def create_tarball(ids, meta_d, vectors_bytes=None):
     # Create tarball buffer
     buf = BytesIO()
     with tarfile.open(fileobj=buf, mode='w:gz') as tar_buf:
@@ -57,6 +79,12 @@ def create_tarball(ids, meta_d):
         meta_buf = BytesIO(meta_bytes)
         info.size = len(meta_bytes)
         tar_buf.addfile(tarinfo=info, fileobj=meta_buf)
+
+        # Add vectors
+        if vectors_bytes is not None:
+            info = tarfile.TarInfo(name=VECTORS_NAME)
+            info.size = len(vectors_bytes)
+            tar_buf.addfile(tarinfo=info, fileobj=BytesIO(vectors_bytes))
     return buf
 
 
@@ -75,7 +103,7 @@ def lambda_handler(event, context):
 
     print(f'[{datetime.now()-tic}] Streaming in vectors...')
     ts_read = datetime.utcnow().isoformat()
-    ann, ids = load_data(path_data)
+    ann, ids, vecs = load_data(path_data)
     n_dim = ann.f
 
     print(f'[{datetime.now()-tic}] Building ANN...')
@@ -92,7 +120,9 @@ def lambda_handler(event, context):
     print(f'[{datetime.now()-tic}] Exporting files...')
 
     # Create tarball buffer
-    buf = create_tarball(ids, meta_d)
+    buf = create_tarball(
+        ids, meta_d,
+        vectors_bytes=npy_bytes(vecs, n_dim) if EXPORT_VECTORS else None)
 
     print(f'[{datetime.now()-tic}] Uploading tar to s3...')
     buf.seek(0)
@@ -7,6 +7,20 @@ OOI_TABLE=${2:-""}
 PATH_FALLBACK=${3:-""}
 CHECK_INTERVAL=${4:-3600}
 TIMEOUT=${5:-90}
+BATCH_THREADS=${6:-0}
+LOAD_PARALLELISM=${7:-8}
+SERVE_BEFORE_READY=${8:-False}
+# Load indexes once in the gunicorn master, shared by all workers
+export ANN_PRELOAD=${9:-False}
+RESULT_CACHE_SIZE=${10:-0}
+# Metrics of all workers are aggregated through files in this directory
+export PROMETHEUS_MULTIPROC_DIR=${11:-/tmp/ann-metrics}
+export prometheus_multiproc_dir=${PROMETHEUS_MULTIPROC_DIR}
+DISK_BUDGET_MB=${12:-None}
+# Load indexes on their first query, except the pinned (comma-separated)
+LAZY=${13:-False}
+PINNED=${14:-""}
+IDLE_EVICT_S=${15:-None}
 
 
 APP_FN="app_builder:build_many_app("\
@@ -14,10 +28,20 @@ APP_FN="app_builder:build_many_app("\
 "'$OOI_TABLE',"\
 "'$PATH_FALLBACK',"\
 "$CHECK_INTERVAL,"\
+"batch_threads=$BATCH_THREADS,"\
+"load_parallelism=$LOAD_PARALLELISM,"\
+"serve_before_ready=$SERVE_BEFORE_READY,"\
+"preload=$ANN_PRELOAD,"\
+"result_cache_size=$RESULT_CACHE_SIZE,"\
+"disk_budget_mb=$DISK_BUDGET_MB,"\
+"lazy=$LAZY,"\
+"pinned='$PINNED',"\
+"idle_evict_s=$IDLE_EVICT_S,"\
 ")"
 
 
 gunicorn \
+    -c gunicorn_conf.py \
     --timeout ${TIMEOUT} \
     -k gevent \
     -b 0.0.0.0:8000 \
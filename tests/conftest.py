@@ -0,0 +1,28 @@
+from pathlib import Path
+import pytest
+import app.resources.ann
+
+PATH_FIXTURES = Path(__file__).parent / 'fixtures'
+
+
+class _Store(object):
+    """Stand-in for an `IdStore` of ids `'0'`..`'9'`"""
+
+    def find(self, id_):
+        return int(id_) if id_.isdigit() and int(id_) < 10 else -1
+
+    def take(self, inds):
+        return [str(i) for i in inds]
+
+
+@pytest.fixture
+def id_store():
+    return _Store()
+
+
+@pytest.fixture
+def path_ann(tmp_path, monkeypatch):
+    """Indexes are extracted under a temporary directory"""
+    path_ann = tmp_path / 'ann'
+    monkeypatch.setattr(app.resources.ann, 'PATH_TMP', path_ann)
+    return path_ann
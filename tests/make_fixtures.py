@@ -6,6 +6,11 @@ from datetime import datetime
 from io import BytesIO
 import json
 from shutil import copyfileobj
+import numpy as np
+import sys
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+from app.delta import save_delta, delta_path  # noqa: E402
 
 
 CUR_DIR = Path(__file__).parent
@@ -17,10 +22,13 @@ PATH_DISK_SAVE = '/tmp/index.ann'
 IDS_NAME = 'ids.txt'
 INDEX_NAME = 'index.ann'
 META_NAME = 'metadata.json'
+VECTORS_NAME = 'vectors.npy'
+ATTRS_NAME = 'attributes.jsonl'
+COLORS = ['red', 'green', 'blue', 'black']
 N_DIM = 40
 
 
-def create_tarball(ids, meta_d):
+def create_tarball(ids, meta_d, vecs=None):
     # Create tarball buffer
     buf = BytesIO()
     with tarfile.open(fileobj=buf, mode='w:gz') as tar_buf:
@@ -40,11 +48,21 @@ def create_tarball(ids, meta_d):
         meta_buf = BytesIO(meta_bytes)
         info.size = len(meta_bytes)
         tar_buf.addfile(tarinfo=info, fileobj=meta_buf)
+
+        # Add vectors
+        if vecs is not None:
+            vecs_buf = BytesIO()
+            np.save(vecs_buf, np.asarray(vecs, dtype=np.float32))
+            info = tarfile.TarInfo(name=VECTORS_NAME)
+            info.size = vecs_buf.tell()
+            vecs_buf.seek(0)
+            tar_buf.addfile(tarinfo=info, fileobj=vecs_buf)
     return buf
 
 
 def make_ann(n_dim=N_DIM, n_items=100):
     ids = []
+    vecs = []
     ann = AnnoyIndex(n_dim, METRIC)
     ann.on_disk_build(PATH_DISK_SAVE)
 
@@ -52,6 +70,7 @@ def make_ann(n_dim=N_DIM, n_items=100):
         v = [random.gauss(0, 1) for _ in range(n_dim)]
         ann.add_item(ind, v)
         ids.append(str(ind))
+        vecs.append(v)
 
     ann.build(N_TREES)
 
@@ -62,19 +81,64 @@ def make_ann(n_dim=N_DIM, n_items=100):
         'timestamp_utc': datetime.utcnow().isoformat(),
     }
 
-    return ids, meta_d
+    return ids, meta_d, vecs
 
 
-def make_ann_tar(name):
+def make_ann_tar(name, export_vectors=True):
 
-    ids, meta_d = make_ann()
-    buf = create_tarball(ids, meta_d)
+    ids, meta_d, vecs = make_ann()
+    buf = create_tarball(ids, meta_d, vecs if export_vectors else None)
     buf.seek(0)
     with open(CUR_DIR / 'fixtures' / f'{name}.tar.gz', 'wb') as fo:
         copyfileobj(buf, fo)
 
 
+def make_delta(name):
+    """Adds `new0` (next to item `5`), changes `7` and removes `9`"""
+    path_tar = CUR_DIR / 'fixtures' / f'{name}.tar.gz'
+    with tarfile.open(path_tar) as tar:
+        meta_d = json.load(tar.extractfile(META_NAME))
+        ann = AnnoyIndex(meta_d['n_dim'], meta_d['metric'])
+        tar.extract(INDEX_NAME, '/tmp')
+    ann.load(f'/tmp/{INDEX_NAME}')
+    vecs = [[x + 0.01 for x in ann.get_item_vector(5)],
+            [random.gauss(0, 1) for _ in range(meta_d['n_dim'])]]
+    save_delta(delta_path(path_tar), ['new0', '7'], vecs, ['9'],
+               meta_d['timestamp_utc'])
+
+
+def item_attributes(ind):
+    """`color` cycles through `COLORS`; `rare` only for a few items"""
+    attrs = {'color': COLORS[ind % len(COLORS)], 'in_stock': ind % 3 != 0}
+    if ind in (11, 42, 77):
+        attrs['rare'] = True
+    return attrs
+
+
+def add_attributes(name):
+    """Adds item attributes to an existing tarball (same index)"""
+    path_tar = CUR_DIR / 'fixtures' / f'{name}.tar.gz'
+    buf = BytesIO()
+    with tarfile.open(path_tar) as tar, \
+            tarfile.open(fileobj=buf, mode='w:gz') as tar_buf:
+        for info in tar.getmembers():
+            if info.name != ATTRS_NAME:
+                tar_buf.addfile(info, tar.extractfile(info))
+        ids = tar.extractfile(IDS_NAME).read().decode('utf-8').splitlines()
+        attrs_bytes = ''.join(
+            json.dumps(item_attributes(int(id_))) + '\n'
+            for id_ in ids).encode('utf-8')
+        info = tarfile.TarInfo(name=ATTRS_NAME)
+        info.size = len(attrs_bytes)
+        tar_buf.addfile(tarinfo=info, fileobj=BytesIO(attrs_bytes))
+    with open(path_tar, 'wb') as fo:
+        fo.write(buf.getvalue())
+
+
 if __name__ == '__main__':
     make_ann_tar('test_ann1')
-    make_ann_tar('test_ann2')
+    add_attributes('test_ann1')
+    # Without vectors: read from the index, queries are not reranked
+    make_ann_tar('test_ann2', export_vectors=False)
+    make_delta('test_ann2')
 
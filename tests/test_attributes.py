@@ -0,0 +1,67 @@
+import json
+import numpy as np
+from app.attributes import Attributes, build_attributes
+from app.neighbors import Neighbors
+from app.resources.ann import fetch_until
+
+
+def make_attributes(tmp_path, n=200):
+    path_jsonl = tmp_path / 'attributes.jsonl'
+    path_jsonl.write_text(''.join(
+        json.dumps({'color': ['red', 'blue'][i % 2], 'size': i % 10,
+                    'tags': ['a'] + (['b'] if i % 50 == 0 else [])}) + '\n'
+        for i in range(n)))
+    build_attributes(path_jsonl, tmp_path / 'attributes.npz')
+    return Attributes(tmp_path / 'attributes.npz')
+
+
+def test_filters(tmp_path):
+    attrs = make_attributes(tmp_path)
+    # Frequent values as bitmaps, rare ones as sorted indices
+    assert attrs.postings[('color', '"red"')].kind == 'bits'
+    assert attrs.postings[('tags', '"b"')].kind == 'inds'
+
+    inds = np.arange(-1, 201)
+    cases = [
+        ({'color': 'red'}, lambda i: i % 2 == 0),
+        ({'color': 'red', 'size': 4}, lambda i: i % 10 == 4),
+        ({'size': {'$in': [1, 3]}}, lambda i: i % 10 in (1, 3)),
+        ({'size': {'$ne': 0}, 'tags': 'b'}, lambda i: False),
+        ({'$or': [{'tags': 'b'}, {'size': 9}]},
+         lambda i: i % 50 == 0 or i % 10 == 9),
+        ({'$not': {'color': 'blue'}, 'size': {'$ne': 2}},
+         lambda i: i % 2 == 0 and i % 10 != 2),
+        ({'color': 'green'}, lambda i: False),
+        ({'size': '4'}, lambda i: False),  # values are typed
+    ]
+    for expr, fn in cases:
+        flt = attrs.compile(expr)
+        expected = np.array([0 <= i < 200 and fn(i) for i in inds])
+        assert np.array_equal(flt.mask(inds), expected), expr
+        assert np.array_equal(flt.matching(), np.flatnonzero(expected) - 1)
+        assert flt.estimate() >= expected.sum()
+
+
+def test_fetch_until_widens():
+    calls = []
+
+    def search_fn(n, search_k):
+        calls.append((n, search_k))
+        return Neighbors(ids=[str(i) for i in range(min(n, 1000))])
+
+    def keep_fn(found):
+        return found.select(np.array([int(id_) % 7 == 0
+                                      for id_ in found.ids], dtype=bool))
+
+    kept = fetch_until(search_fn, keep_fn, 10, 10, 10000, search_k=100)
+    assert kept.ids == [str(i * 7) for i in range(10)]
+    assert calls == [(10, 100), (40, 400), (160, 1600)]
+
+    calls.clear()
+    fetch_until(search_fn, keep_fn, 10, 10, 10000, search_k=100,
+                max_search_k=200)
+    assert calls == [(10, 100), (40, 200), (160, 200)]
+
+    # Stops once the index has no more
+    kept = fetch_until(search_fn, keep_fn, 500, 500, 10000)
+    assert len(kept) == 143
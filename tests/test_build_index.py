@@ -0,0 +1,98 @@
+import json
+import tarfile
+import numpy as np
+from annoy import AnnoyIndex
+from app.delta import save_delta
+from build_index import build, compact_parts, list_parts
+
+
+def test_build_from_npy_parts(tmp_path):
+    path_parts = tmp_path / 'parts'
+    path_parts.mkdir()
+    vecs = np.random.RandomState(0).randn(30, 8).astype(np.float32)
+    np.save(path_parts / 'part-0.npy', vecs[:20])
+    (path_parts / 'part-0.ids.txt').write_text(
+        '\n'.join(f'a{i}' for i in range(20)))
+    (path_parts / 'part-0.attributes.jsonl').write_text(
+        ''.join(json.dumps({'i': i}) + '\n' for i in range(20)))
+    # Without ids: row numbers over all parts
+    np.save(path_parts / 'part-1.npy', vecs[20:])
+    path_work = tmp_path / 'work'
+    path_work.mkdir()
+    path_out = str(tmp_path / 'idx.tar.gz')
+
+    meta_d = build(list_parts([str(path_parts)]), path_out, path_work,
+                   n_trees=4, n_jobs=2, batch_size=7)
+    assert meta_d['build']['n_items'] == 30
+    assert meta_d['build']['n_parts'] == 2
+
+    path_out_dir = tmp_path / 'out'
+    with tarfile.open(path_out) as tar:
+        tar.extractall(str(path_out_dir))
+    ids = (path_out_dir / 'ids.txt').read_text().splitlines()
+    assert ids[:2] == ['a0', 'a1'] and ids[20:22] == ['20', '21']
+    assert json.loads((path_out_dir / 'metadata.json').read_text()) == meta_d
+    assert np.array_equal(np.load(str(path_out_dir / 'vectors.npy')), vecs)
+    attrs = (path_out_dir / 'attributes.jsonl').read_text().splitlines()
+    assert attrs[19] == '{"i": 19}' and attrs[20:] == ['{}'] * 10
+
+    ann = AnnoyIndex(8, 'angular')
+    ann.load(str(path_out_dir / 'index.ann'))
+    assert ann.get_n_items() == 30
+    assert ann.get_n_trees() == 4
+
+
+def test_build_tuned(tmp_path):
+    path_part = tmp_path / 'part.npy'
+    np.save(path_part, np.random.RandomState(0).randn(500, 8)
+            .astype(np.float32))
+    path_work = tmp_path / 'work'
+    path_work.mkdir()
+
+    meta_d = build([str(path_part)], str(tmp_path / 'idx.tar'), path_work,
+                   tune_kwargs={'target_recall': 0.9, 'k': 5,
+                                'n_queries': 50, 'n_trees_grid': [2, 4],
+                                'search_k_mults': [1, 100]})
+    tuning = meta_d['tuning']
+    assert tuning['met'] and tuning['recall'] >= 0.9
+    assert meta_d['search_k'] == tuning['curve'][-1]['search_k']
+    assert meta_d['build']['n_trees'] == tuning['curve'][-1]['n_trees']
+    assert sorted(p.name for p in path_work.iterdir()) == [
+        'ids.txt', 'index.ann', 'metadata.json', 'vectors.npy']
+
+
+def test_compact_delta(tmp_path):
+    path_part = tmp_path / 'part.npy'
+    np.save(path_part, np.random.RandomState(0).randn(10, 4)
+            .astype(np.float32))
+    (tmp_path / 'part.attributes.jsonl').write_text(
+        ''.join(json.dumps({'i': i}) + '\n' for i in range(10)))
+    path_work = tmp_path / 'work'
+    path_work.mkdir()
+    path_base = str(tmp_path / 'idx.tar.gz')
+    meta_d = build([str(path_part)], path_base, path_work, n_trees=2)
+
+    path_delta = str(tmp_path / 'idx.delta.npz')
+    save_delta(path_delta, ['new', '3'], np.ones((2, 4)), ['5'],
+               meta_d['timestamp_utc'])
+    path_work = tmp_path / 'work2'
+    path_work.mkdir()
+    parts, _ = compact_parts(path_base, path_delta, path_work)
+    build(parts, str(tmp_path / 'idx2.tar'), path_work, n_trees=2)
+
+    ids = (path_work / 'ids.txt').read_text().splitlines()
+    assert ids == ['0', '1', '2', '4', '6', '7', '8', '9', 'new', '3']
+    vectors = np.load(str(path_work / 'vectors.npy'))
+    assert np.array_equal(vectors[-2:], np.ones((2, 4)))
+    # Changed items keep their attributes
+    attrs = (path_work / 'attributes.jsonl').read_text().splitlines()
+    assert attrs[-3:] == ['{"i": 9}', '{}', '{"i": 3}']
+
+    # A delta that only removes items
+    save_delta(path_delta, [], [], ['0'], meta_d['timestamp_utc'])
+    path_work = tmp_path / 'work3'
+    path_work.mkdir()
+    parts, _ = compact_parts(path_base, path_delta, path_work)
+    build(parts, str(tmp_path / 'idx3.tar'), path_work, n_trees=2)
+    ids = (path_work / 'ids.txt').read_text().splitlines()
+    assert ids == [str(i) for i in range(1, 10)]
@@ -0,0 +1,63 @@
+import app.cache
+from app.cache import ResultCache
+from app.resources.ann import ANNResource
+from conftest import PATH_FIXTURES
+
+
+def test_lru():
+    cache = ResultCache(max_entries=2)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    assert cache.get('a') == 1
+    cache.put('c', 3)  # evicts `b`, the least recently used
+    assert cache.get('b') is None
+    assert cache.get('a') == 1 and cache.get('c') == 3
+    assert cache.tojson() == {'entries': 2, 'mb': 0., 'hits': 3,
+                              'misses': 1, 'evictions': 1}
+
+
+def test_ttl(monkeypatch):
+    now = [1000.]
+    monkeypatch.setattr(app.cache, 'time', lambda: now[0])
+    cache = ResultCache(ttl_s=10)
+    cache.put('a', 1)
+    now[0] += 5
+    assert cache.get('a') == 1
+    now[0] += 10
+    assert cache.get('a') is None
+    assert len(cache) == 0
+    assert (cache.hits, cache.misses, cache.evictions) == (1, 1, 1)
+
+
+def test_memory_cap():
+    cache = ResultCache(max_mb=100 / 1e6)  # 100 bytes
+    cache.put('a', 1, size=60)
+    cache.put('b', 2, size=30)
+    cache.put('c', 3, size=30)
+    assert cache.get('a') is None and cache.n_bytes == 60
+    cache.put('b', 4, size=90)  # replaced, not counted twice
+    assert len(cache) == 1 and cache.n_bytes == 90
+    cache.clear()
+    assert len(cache) == 0 and cache.n_bytes == 0
+
+
+def test_cleared_on_swap(path_ann):
+    cache = ResultCache()
+    ann_r = ANNResource(str(PATH_FIXTURES / 'test_ann1.tar.gz'),
+                        name='test_ann1', result_cache=cache)
+    version_a = ann_r.version
+    neighbors = ann_r.nn_from_id('1', 3)
+    assert ann_r.nn_from_id('1', 3) is neighbors
+    assert ann_r.nn_from_id('1', 4) is not neighbors
+    assert [key[0] for key in cache._d] == [version_a.name] * 2
+    assert (cache.hits, cache.misses) == (1, 2)
+
+    ann_r.load(reload=True)
+    assert ann_r.version.name != version_a.name
+    assert len(cache) == 0
+    neighbors_b = ann_r.nn_from_id('1', 3)
+    assert neighbors_b is not neighbors and neighbors_b.ids == neighbors.ids
+    # Queries still holding the previous version do not share its entries
+    ann_r.nn_from_id('1', 3, version=version_a)
+    assert sorted(key[0] for key in cache._d) \
+        == sorted([version_a.name, ann_r.version.name])
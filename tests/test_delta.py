@@ -0,0 +1,34 @@
+from io import BytesIO
+import numpy as np
+from app.delta import Delta, delta_path, save_delta
+from app.neighbors import Neighbors
+
+
+def test_merge_skips_tombstones(id_store):
+    delta = Delta(['a', '3'], [[1., 0.], [0., 1.]], ['1'], id_store)
+    assert delta.tombstoned.tolist() == [1, 3]
+
+    base = Neighbors.from_ann_out(
+        ([1, 2, 3, 4], [0.1, 0.2, 0.3, 0.4]), True, id_store)
+    merged = delta.merge(base, np.array([1., 0.]), 3, 'euclidean')
+    assert merged.ids == ['a', '2', '4']
+    assert np.allclose(merged.dists, [0., 0.2, 0.4])
+
+
+def test_delta_path():
+    assert delta_path('s3://x/my.tarballs/idx.tar.gz') \
+        == 's3://x/my.tarballs/idx.delta.npz'
+    assert delta_path('/tmp/idx.tar') == '/tmp/idx.delta.npz'
+
+
+def test_removal_only_delta(id_store):
+    f = BytesIO()
+    save_delta(f, [], [], ['9'], 'ts')
+    delta = Delta.from_bytes(f.getvalue(), id_store,
+                             {'timestamp_utc': 'ts', 'n_dim': 2})
+    assert len(delta) == 0 and delta.vectors.shape == (0, 2)
+    assert delta.tombstoned.tolist() == [9]
+
+    base = Neighbors.from_ann_out(([8, 9], [0.1, 0.2]), True, id_store)
+    merged = delta.merge(base, np.array([1., 0.]), 2, 'euclidean')
+    assert merged.ids == ['8']
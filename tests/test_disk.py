@@ -0,0 +1,99 @@
+from app.disk import DiskManager
+from app.io import set_current_version, current_version
+
+
+def make_version(path_root, name, n_bytes):
+    path_version = path_root / name
+    path_version.mkdir(parents=True)
+    (path_version / 'index.ann').write_bytes(b'0' * n_bytes)
+    return path_version
+
+
+class _Resource(object):
+    """Stand-in for an `ANNResource` serving nothing"""
+    name = 'idx'
+    ready = False
+    version = None
+    pinned = False
+
+
+def test_scan_removes_stale(tmp_path):
+    path_root = tmp_path / 'idx'
+    make_version(path_root, 'v1', 100)
+    path_current = make_version(path_root, 'v2', 200)
+    make_version(path_root, '.v3.partial', 300)
+    set_current_version(path_root, path_current)
+
+    disk = DiskManager(tmp_path)
+    disk.scan()
+
+    assert disk.total_bytes == 200
+    assert sorted(p.name for p in path_root.iterdir()
+                  if not p.name.startswith('.')) == ['current', 'v2']
+
+
+def test_enforce_budget(tmp_path):
+    path_root = tmp_path / 'idx'
+    path_version = make_version(path_root, 'v1', 2000000)
+    set_current_version(path_root, path_version)
+
+    disk = DiskManager(tmp_path, budget_mb=1)
+    disk.register(_Resource())
+    disk.add(path_version)
+    assert disk.tojson()['versions'] == {'idx/v1': 2.}
+
+    disk.enforce()
+    assert disk.total_bytes == 0
+    assert not path_version.exists()
+    assert current_version(path_root) is None
+
+
+def test_evict_idle_skips_pinned(tmp_path):
+    class _Lazy(_Resource):
+        ready = lazy = True
+        last_query_at = 0.
+        n_evicted = 0
+
+        def evict(self, free_disk=False):
+            self.n_evicted += 1
+
+    idle, pinned = _Lazy(), _Lazy()
+    pinned.pinned = True
+    disk = DiskManager(tmp_path)
+    disk.register(idle)
+    disk.register(pinned)
+
+    disk.evict_idle(60)
+    assert (idle.n_evicted, pinned.n_evicted) == (1, 0)
+
+
+def test_memory_budget_keeps_files(tmp_path):
+    path_root = tmp_path / 'idx'
+    path_version = make_version(path_root, 'v1', 2000000)
+    set_current_version(path_root, path_version)
+
+    class _Served(_Resource):
+        ready = True
+        last_query_at = 0.
+        freed = None
+
+        @property
+        def version(self):
+            return None if self.freed is not None else _Version()
+
+        def evict(self, free_disk=False):
+            self.freed = free_disk
+
+    class _Version(object):
+        path = path_version
+
+    served = _Served()
+    disk = DiskManager(tmp_path, memory_budget_mb=1)
+    disk.register(served)
+    disk.add(path_version)
+
+    disk.enforce()
+    # Other workers may still serve it: only this worker's version goes
+    assert served.freed is False
+    assert path_version.exists()
+    assert current_version(path_root) == path_version
@@ -0,0 +1,43 @@
+from concurrent.futures import ThreadPoolExecutor
+from time import sleep, time
+from app.neighbors import Neighbors
+from app.resources.fanout import FanoutANNResource
+
+
+class _Resource(object):
+    """Stand-in for an `ANNResource` answering after `delay_s`"""
+    ann_meta_d = {'metric': 'angular'}
+
+    def __init__(self, name, delay_s=0., ready=True):
+        self.name = self.label = name
+        self.delay_s = delay_s
+        self.ready = ready
+        self.state = 'ready' if ready else 'evicted'
+        self.loads = 0
+
+    def ensure_loading(self):
+        if not self.ready:
+            self.loads += 1
+        return self.ready
+
+    def nn_from_payload(self, payload, timings=None, q_emb=None):
+        sleep(self.delay_s)
+        return Neighbors(ids=[f'{self.name}{i}' for i in range(2)],
+                         dists=[0.1, 0.2])
+
+
+def test_fanout_deadline():
+    fanout_r = FanoutANNResource(
+        [_Resource('fast'), _Resource('slow', delay_s=2.),
+         _Resource('lazy', ready=False)],
+        executor=ThreadPoolExecutor(max_workers=3))
+    tic = time()
+    neighbors, catalogs, missing = fanout_r.query(
+        {'indexes': ['fast', 'slow', 'lazy'], 'emb': [0., 1.], 'k': 3,
+         'deadline_ms': 200})
+    # The slow index is cut off, the lazy one is loading meanwhile
+    assert time() - tic < 1.
+    assert neighbors.ids == ['fast0', 'fast1']
+    assert catalogs == ['fast', 'fast']
+    assert missing == {'slow': 'deadline', 'lazy': 'loading'}
+    assert fanout_r.ann_resources_d['lazy'].loads == 1
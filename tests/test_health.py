@@ -1,5 +1,7 @@
 import requests
 import json
+import struct
+import pytest
 
 ENDPOINT = 'http://localhost:8000'
 
@@ -124,3 +126,223 @@ def test_cross_query4():
 
     assert r.status_code == 200
 
+
+def test_cross_query_delta():
+    # `new0` is only in test_ann2.delta.npz (next to `5`), `9` is removed
+    r = requests.get(ENDPOINT + '/crossq', params={
+        'q_id': 'new0', 'q_name': 'test_ann2',
+        'catalog_name': 'test_ann2', 'k': 99})
+
+    ids = [rec['id'] for rec in r.json()['recs']]
+    assert ids[:2] == ['new0', '5']
+    assert '9' not in ids
+
+
+def test_batch_query():
+
+    payload = {
+        'k': 10,
+        'queries': [
+            {'id': '0'},
+            {'id': 'not-an-id'},
+            {'id': '1', 'k': 5, 'incl_dist': True},
+        ],
+    }
+
+    r = requests.post(ENDPOINT + '/ann/test_ann1/query/batch', json=payload)
+    assert r.status_code == 200
+
+    results = json.loads(r.content)['results']
+    assert len(results) == 3
+    assert len(results[0]['recs']) == 10
+    assert 'error' in results[1]
+    assert len(results[2]['recs']) == 5
+    assert 'dist' in results[2]['recs'][0]
+
+
+def test_query_search_k():
+
+    payload = {'id': '0', 'k': 10, 'search_k': 1000}
+
+    r = requests.post(ENDPOINT + '/ann/test_ann1/query', json=payload)
+    assert r.status_code == 200
+    assert len(json.loads(r.content)['recs']) == 10
+
+
+def test_score():
+
+    payload = {
+        'ids_1': ['0', '1', 'not-an-id'], 'catalog_1': 'test_ann1',
+        'ids_2': ['0', '1', '2'], 'catalog_2': 'test_ann1',
+    }
+
+    r = requests.post(ENDPOINT + '/score', json=payload)
+    assert r.status_code == 200
+    scores = json.loads(r.content)
+    assert set(scores) == {'0', '1'}
+    assert abs(scores['0']['0'] - 1.) < 1e-5
+
+
+def test_score_top_k():
+
+    payload = {
+        'ids_1': ['0', '1'], 'catalog_1': 'test_ann1',
+        'ids_2': ['0', '1', '2', '3'], 'catalog_2': 'test_ann1',
+        'dist': 'euclidean', 'top_k': 2,
+    }
+
+    r = requests.post(ENDPOINT + '/score', json=payload)
+    assert r.status_code == 200
+    scores = json.loads(r.content)
+    assert len(scores['1']) == 2
+    assert scores['1'][0]['id'] == '1'
+
+
+def test_query_rerank():
+
+    payload = {'id': '0', 'k': 10, 'rerank': True, 'incl_dist': True}
+
+    r = requests.post(ENDPOINT + '/ann/test_ann1/query', json=payload)
+    assert r.status_code == 200
+    recs = json.loads(r.content)['recs']
+    assert len(recs) == 10
+    assert '0' not in [rec['id'] for rec in recs]
+    dists = [rec['dist'] for rec in recs]
+    assert dists == sorted(dists)
+
+
+def test_get_vector():
+
+    r = requests.get(ENDPOINT + '/ann/test_ann1/query?id=1')
+    assert r.status_code == 200
+    emb = json.loads(r.content)
+
+    r = requests.get(ENDPOINT + '/ann/test_ann1/query?id=1&format=f32')
+    assert r.status_code == 200
+    assert r.headers['content-type'] == 'application/octet-stream'
+    emb_f32 = struct.unpack(f'<{len(emb)}f', r.content)
+    assert list(emb_f32) == emb
+
+
+def test_query_columnar():
+
+    payload = {'id': '0', 'k': 10, 'incl_dist': True, 'format': 'columnar'}
+
+    r = requests.post(ENDPOINT + '/ann/test_ann1/query', json=payload)
+    assert r.status_code == 200
+    res = json.loads(r.content)
+    assert len(res['ids']) == len(res['dists']) == 10
+
+
+def test_query_msgpack():
+    msgpack = pytest.importorskip('msgpack')
+
+    payload = {'id': '0', 'k': 10, 'incl_score': True}
+
+    r = requests.post(ENDPOINT + '/ann/test_ann1/query', json=payload,
+                      headers={'Accept': 'application/msgpack'})
+    assert r.status_code == 200
+    assert r.headers['content-type'] == 'application/msgpack'
+    res = msgpack.unpackb(r.content, raw=False)
+    assert len(res['ids']) == len(res['scores']) == 10
+
+
+def test_query_debug():
+
+    payload = {'id': '0', 'k': 10, 'debug': True}
+
+    r = requests.post(ENDPOINT + '/ann/test_ann1/query', json=payload)
+    assert r.status_code == 200
+    timings = json.loads(r.content)['debug']['timings']
+    assert timings[0]['index'] == 'test_ann1'
+    assert timings[0]['n'] == 10
+
+
+def test_fanout_query():
+
+    payload = {'id': '0', 'k': 10, 'incl_dist': True,
+               'indexes': ['test_ann1', 'test_ann2'], 'deadline_ms': 1000}
+
+    r = requests.post(ENDPOINT + '/fanout', json=payload)
+    assert r.status_code == 200
+    res = json.loads(r.content)
+    assert not res['partial']
+    assert len(res['recs']) == 10
+    dists = [rec['dist'] for rec in res['recs']]
+    assert dists == sorted(dists)
+    assert {rec['index'] for rec in res['recs']} <= {'test_ann1', 'test_ann2'}
+
+
+def test_fanout_query_quota():
+
+    payload = {'emb': [0.1] * 40, 'k': 10, 'merge': 'quota',
+               'indexes': ['test_ann1', 'test_ann2'],
+               'quotas': {'test_ann1': 3}}
+
+    r = requests.post(ENDPOINT + '/fanout', json=payload)
+    assert r.status_code == 200
+    res = json.loads(r.content)
+    assert [rec['index'] for rec in res['recs']].count('test_ann1') <= 3
+
+
+def test_metrics():
+    requests.post(ENDPOINT + '/ann/test_ann1/query', json={'id': '0', 'k': 10})
+    r = requests.get(ENDPOINT + '/metrics')
+
+    assert r.status_code == 200
+    assert 'ann_query_stage_seconds' in r.text
+    assert 'index="test_ann1"' in r.text
+
+
+def test_query_delta():
+    # test_ann2.delta.npz: adds `new0` next to `5`, changes `7`, removes `9`
+    payload = {'id': '5', 'k': 99, 'incl_dist': True}
+
+    r = requests.post(ENDPOINT + '/ann/test_ann2/query', json=payload)
+    ids = [rec['id'] for rec in r.json()['recs']]
+    assert ids[0] == 'new0'
+    assert '9' not in ids and '5' not in ids
+    assert ids.count('7') == 1
+
+    r = requests.get(ENDPOINT + '/ann/test_ann2/query',
+                     params={'id': 'new0'})
+    assert len(r.json()) == 40
+
+
+def test_query_filter():
+    # test_ann1 items: `color` is red/green/blue/black by `id % 4`,
+    # `rare` is only set for items 11, 42 and 77
+    payload = {'id': '0', 'k': 10, 'filter': {'color': 'red'},
+               'debug': True}
+
+    r = requests.post(ENDPOINT + '/ann/test_ann1/query', json=payload)
+    ids = [rec['id'] for rec in r.json()['recs']]
+    assert len(ids) == 10 and '0' not in ids
+    assert all(int(id_) % 4 == 0 for id_ in ids)
+    # Few enough items match to be searched exactly
+    assert [t.get('filter') for t in r.json()['debug']['timings']
+            if 'index' in t] == ['exact']
+
+    payload = {'id': '42', 'k': 10, 'filter': {'rare': True}}
+    r = requests.post(ENDPOINT + '/ann/test_ann1/query', json=payload)
+    assert sorted(rec['id'] for rec in r.json()['recs']) == ['11', '77']
+
+
+def test_query_exclude_ids():
+    def query(name, payload):
+        r = requests.post(ENDPOINT + f'/ann/{name}/query', json=payload)
+        return [rec['id'] for rec in r.json()['recs']]
+
+    ids = query('test_ann1', {'id': '0', 'k': 10, 'search_k': 10000})
+    exclude_ids = ids[:5] + ['not-an-id']
+    ids_ex = query('test_ann1', {'id': '0', 'k': 10, 'search_k': 10000,
+                                 'exclude_ids': exclude_ids})
+    assert len(ids_ex) == 10 and ids_ex[:5] == ids[5:]
+
+    # With a filter, and items of a delta
+    ids_ex = query('test_ann1', {'id': '0', 'k': 5, 'filter': {'rare': True},
+                                 'exclude_ids': ['42']})
+    assert sorted(ids_ex) == ['11', '77']
+    ids_ex = query('test_ann2', {'id': '5', 'k': 10,
+                                 'exclude_ids': ['new0', '7']})
+    assert len(ids_ex) == 10 and not {'new0', '7'} & set(ids_ex)
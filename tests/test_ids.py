@@ -0,0 +1,50 @@
+import numpy as np
+import app.ids
+from app.ids import IdStore, build_id_store
+
+
+def make_store(tmp_path, content: bytes, name='ids.txt') -> IdStore:
+    path_ids = tmp_path / name
+    path_ids.write_bytes(content)
+    build_id_store(path_ids)
+    return IdStore(path_ids)
+
+
+def test_lookups(tmp_path):
+    ids = [f'id{i}' for i in range(1000)]
+    store = make_store(tmp_path, ''.join(f'{id_}\n' for id_ in ids).encode())
+    assert len(store) == 1000
+    assert store[3] == 'id3' and store[-1] == 'id999'
+    assert store.find('id500') == 500
+    assert store.find('nope') == -1 and store.find(5) == -1
+    assert 'id7' in store.lookup and 'nope' not in store.lookup
+
+    queries = ['id999', 'nope', 'id0', None, 'id42']
+    inds = store.find_many(queries)
+    assert inds.tolist() == [999, -1, 0, -1, 42]
+    found = inds[inds >= 0]
+    assert store.take(found) == ['id999', 'id0', 'id42']
+    assert store.take(store.find_many(ids)) == ids
+
+
+def test_line_endings(tmp_path):
+    # Windows line endings, no final newline
+    store = make_store(tmp_path, b'a\r\nb\r\nc')
+    assert list(store) == ['a', 'b', 'c']
+    assert store.find('c') == 2 and store.find('a\r') == -1
+    assert store.find_many(['b', 'c']).tolist() == [1, 2]
+
+    store = make_store(tmp_path, b'', name='empty.txt')
+    assert len(store) == 0 and store.find_many(['a']).tolist() == [-1]
+
+
+def test_hash_collisions(tmp_path, monkeypatch):
+    # Every id of the same length collides
+    monkeypatch.setattr(app.ids, 'hash_id', len)
+    ids = ['aa', 'b', 'cc', 'dd', 'eee']
+    store = make_store(tmp_path, ''.join(f'{id_}\n' for id_ in ids).encode())
+    assert [store.find(id_) for id_ in ids] == [0, 1, 2, 3, 4]
+    assert store.find('zz') == -1
+    assert store.find_many(['dd', 'zz', 'cc', 'aa']).tolist() \
+        == [3, -1, 2, 0]
+    assert np.array_equal(store.find_many(ids), np.arange(5))
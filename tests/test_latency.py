@@ -0,0 +1,46 @@
+from concurrent.futures import ThreadPoolExecutor
+from app.latency import SearchKBudget
+
+
+def run(budget, ms, n=10):
+    for _ in range(n):
+        budget.record(ms / 1000.)
+
+
+def test_search_k_budget():
+    budget = SearchKBudget(target_p99_ms=10, min_search_k=50,
+                           window=10, check_every=10)
+    assert budget.apply(-1, 10, 100) == 1000  # n_trees * k
+    run(budget, 5)
+    assert budget.cap is None  # under target, nothing to lift
+
+    # Halved while over target, down to the floor
+    run(budget, 20)
+    assert budget.cap == 500 and budget.apply(1000, 10, 100) == 500
+    run(budget, 20)
+    assert budget.cap == 250
+    for _ in range(5):
+        run(budget, 20)
+    assert budget.cap == 50
+    # Never below `k` either
+    assert budget.apply(1000, 80, 100) == 80
+
+    # Doubled while well under target, lifted past the last search_k
+    run(budget, 4)
+    assert budget.cap == 100
+    run(budget, 7)  # under target, not by much: kept
+    assert budget.cap == 100
+    for cap in (200, 400, 800, None):
+        run(budget, 4)
+        assert budget.cap == cap
+    assert budget.apply(1000, 10, 100) == 1000
+
+
+def test_search_k_budget_threads():
+    budget = SearchKBudget(target_p99_ms=10, check_every=100, window=10000)
+    budget.apply(1000, 10, 100)
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(lambda _: budget.record(0.02), range(1000)))
+    # No increment is lost: the window is checked every 100 queries
+    assert budget._n_since_check == 0
+    assert budget.cap is not None
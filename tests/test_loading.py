@@ -0,0 +1,40 @@
+import threading
+from time import sleep
+import falcon.testing
+import app.resources.ann
+import app_builder
+from app.disk import DiskManager
+from conftest import PATH_FIXTURES
+
+
+def test_serve_before_ready(path_ann, monkeypatch):
+    loaded = threading.Event()
+    load_via_tar = app.resources.ann.load_via_tar
+
+    def blocking_load(path_tar, *args, progress=None, **kwargs):
+        progress(1, 4)
+        loaded.wait(10)
+        return load_via_tar(path_tar, *args, progress=progress, **kwargs)
+
+    monkeypatch.setattr(app.resources.ann, 'load_via_tar', blocking_load)
+    monkeypatch.setattr(app_builder, 'DiskManager',
+                        lambda **kwargs: DiskManager(path_ann, **kwargs))
+    client = falcon.testing.TestClient(app_builder.build_many_app(
+        f'{PATH_FIXTURES}/', '', '', 0, serve_before_ready=True))
+
+    r = client.simulate_post('/ann/test_ann1/query', json={'id': '1', 'k': 3})
+    assert r.status_code == 503
+    assert r.headers['Retry-After'] == str(app.resources.ann.NOT_READY_RETRY_S)
+    assert r.json['state'] == 'loading' and r.json['progress'] == 0.25
+    assert client.simulate_get('/').json['test_ann1'] == {
+        'state': 'loading', 'progress': 0.25, 'error': None}
+
+    loaded.set()
+    for _ in range(100):
+        if all(s['state'] == 'ready'
+               for s in client.simulate_get('/').json.values()):
+            break
+        sleep(0.1)
+    r = client.simulate_post('/ann/test_ann1/query', json={'id': '1', 'k': 3})
+    assert r.status_code == 200 and len(r.json['recs']) == 3
+    assert client.simulate_get('/').json['test_ann1']['progress'] == 1.
@@ -0,0 +1,26 @@
+import numpy as np
+from app.neighbors import Neighbors
+
+
+def test_lazy_ids(id_store):
+    n = Neighbors.from_ann_out(([3, 1, 2], [0.1, 0.2, 0.3]), True, id_store)
+    n = n.without_ind(1)[:1]
+    assert n._ids is None
+    assert n.ids == ['3']
+    assert n.dists.tolist() == [0.1]
+
+
+def test_threshold_dedup_concat():
+    a = Neighbors(ids=['a', 'b'], dists=[0.2, 1.8])
+    b = Neighbors(ids=['b', 'c'], dists=[0.4, 0.6])
+    n = a.concat(b).dedup()
+    assert n.ids == ['a', 'b', 'c']
+    assert n.above_score(0.5).ids == ['a', 'c']
+    assert np.allclose(n.scores, [0.9, 0.1, 0.7])
+
+
+def test_to_dicts():
+    n = Neighbors(ids=['a'], dists=[1.])
+    assert n.to_dicts(True, True) == [{'id': 'a', 'dist': 1., 'score': .5}]
+    assert n.to_dicts(False, False) == [{'id': 'a'}]
+    assert [r.to_dict(True, False) for r in n] == [{'id': 'a', 'dist': 1.}]
@@ -0,0 +1,104 @@
+import os
+import struct
+import threading
+import pytest
+
+moto = pytest.importorskip('moto')
+boto3 = pytest.importorskip('boto3')
+
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+os.environ.setdefault('AWS_ACCESS_KEY_ID', 'testing')
+os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'testing')
+
+from app.ooi import DynamoVectorStore  # noqa: E402
+
+mock_dynamodb = getattr(moto, 'mock_aws', None) or moto.mock_dynamodb2
+
+TABLE = 'ooi-test'
+N_ITEMS = 250
+
+
+@pytest.fixture
+def table():
+    with mock_dynamodb():
+        dynamodb = boto3.resource('dynamodb')
+        t = dynamodb.create_table(
+            TableName=TABLE,
+            KeySchema=[{'AttributeName': 'variant_id', 'KeyType': 'HASH'}],
+            AttributeDefinitions=[
+                {'AttributeName': 'variant_id', 'AttributeType': 'S'}],
+            BillingMode='PAY_PER_REQUEST')
+        with t.batch_writer() as w:
+            for i in range(N_ITEMS):
+                w.put_item(Item={
+                    'variant_id': str(i),
+                    'repr': struct.pack('fff', i, i + 1, i + 2)})
+        yield t
+
+
+def test_get(table):
+    store = DynamoVectorStore(table, coalesce_ms=0)
+    assert store.get('3') == (3., 4., 5.)
+    assert store.get('missing') is None
+
+
+def test_get_many_batches(table):
+    store = DynamoVectorStore(table, coalesce_ms=0)
+    ids = [str(i) for i in range(N_ITEMS)] + ['missing']
+    res = store.get_many(ids)
+    assert res['7'] == (7., 8., 9.)
+    assert res['missing'] is None
+    # 251 keys -> 3 requests of at most 100 keys
+    assert store.n_batches == 3
+
+
+def test_cache(table):
+    store = DynamoVectorStore(table, coalesce_ms=0)
+    store.get('1')
+    store.get('missing')
+    n_batches = store.n_batches
+    assert store.get('1') == (1., 2., 3.)
+    assert store.get('missing') is None
+    assert store.n_batches == n_batches
+
+
+def test_coalesce(table):
+    store = DynamoVectorStore(table, coalesce_ms=50)
+    res = {}
+
+    def get(id_):
+        res[id_] = store.get(id_)
+
+    threads = [threading.Thread(target=get, args=(str(i),))
+               for i in range(20)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert res == {str(i): (i, i + 1., i + 2.) for i in range(20)}
+    assert store.n_batches < 20
+
+
+def test_flush_failure_releases_waiters(table):
+    store = DynamoVectorStore(table, coalesce_ms=50)
+
+    def fail(id_, emb):
+        raise ValueError('cache is broken')
+    store.cache.put = fail
+    errors = []
+
+    def get(id_):
+        try:
+            store.get(id_)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=get, args=(str(i),))
+               for i in range(5)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join(timeout=5)
+    assert not any(t.is_alive() for t in threads)
+    assert len(errors) == 5
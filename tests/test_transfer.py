@@ -0,0 +1,85 @@
+import io
+import tarfile
+import pytest
+import app.transfer
+from app.io import current_version, load_via_tar
+from app.transfer import ChecksumError, extract_tar, local_fetcher
+
+FILES = {'ids.txt': b'a\nb\n', 'index.ann': bytes(range(256)) * 40}
+
+
+def make_tar(path, mode='w', members=None):
+    with tarfile.open(str(path), mode) as tar:
+        for name, data in (members or FILES).items():
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+    return path
+
+
+@pytest.mark.parametrize('name, mode', [
+    ('idx.tar', 'w'), ('idx.tar.gz', 'w:gz'), ('idx.tar.zst', None)])
+def test_extract(tmp_path, name, mode):
+    path_tar = tmp_path / name
+    if mode is None:
+        zstandard = pytest.importorskip('zstandard')
+        make_tar(tmp_path / 'idx.tar')
+        path_tar.write_bytes(zstandard.ZstdCompressor().compress(
+            (tmp_path / 'idx.tar').read_bytes()))
+    else:
+        make_tar(path_tar, mode)
+    progress = []
+    # Small chunks: many ranges in flight at once
+    size = extract_tar(path_tar, tmp_path / 'out', n_threads=3,
+                       chunk_sz=1000,
+                       progress=lambda *args: progress.append(args))
+    assert size == path_tar.stat().st_size
+    assert progress[-1] == (size, size)
+    for name_file, data in FILES.items():
+        assert (tmp_path / 'out' / name_file).read_bytes() == data
+
+
+def test_truncated(tmp_path):
+    path_tar = make_tar(tmp_path / 'idx.tar.gz', 'w:gz')
+    path_tar.write_bytes(path_tar.read_bytes()[:200])
+    with pytest.raises(tarfile.TarError):
+        load_via_tar(path_tar, tmp_path / 'idx')
+    assert current_version(tmp_path / 'idx') is None
+
+
+def test_corrupted(tmp_path, monkeypatch):
+    def fetcher(path):
+        fetch, size, _ = local_fetcher(path)
+        return fetch, size, '0' * 64
+
+    monkeypatch.setattr(app.transfer, 'local_fetcher', fetcher)
+    path_tar = make_tar(tmp_path / 'idx.tar')
+    with pytest.raises(ChecksumError):
+        load_via_tar(path_tar, tmp_path / 'idx')
+    assert current_version(tmp_path / 'idx') is None
+
+    def short_fetcher(path):
+        fetch, size, _ = local_fetcher(path)
+        return (lambda start, length: fetch(start, length)[:-1]), size, None
+
+    monkeypatch.setattr(app.transfer, 'local_fetcher', short_fetcher)
+    with pytest.raises(IOError):
+        load_via_tar(path_tar, tmp_path / 'idx')
+    assert current_version(tmp_path / 'idx') is None
+
+
+def test_unsafe_members(tmp_path):
+    path_tar = make_tar(tmp_path / 'idx.tar', members={'../x': b'x'})
+    with pytest.raises(tarfile.ExtractError):
+        extract_tar(path_tar, tmp_path / 'out')
+    assert not (tmp_path / 'x').exists()
+
+    path_tar = tmp_path / 'link.tar'
+    with tarfile.open(str(path_tar), 'w') as tar:
+        info = tarfile.TarInfo('ids.txt')
+        info.type = tarfile.SYMTYPE
+        info.linkname = '/etc/passwd'
+        tar.addfile(info)
+    with pytest.raises(tarfile.ExtractError):
+        extract_tar(path_tar, tmp_path / 'out')
+    assert not (tmp_path / 'out' / 'ids.txt').exists()
@@ -0,0 +1,32 @@
+import gc
+from time import sleep
+from app.io import current_version
+from app.resources.ann import ANNResource
+from conftest import PATH_FIXTURES
+
+
+def test_blue_green_swap(path_ann):
+    ann_r = ANNResource(str(PATH_FIXTURES / 'test_ann1.tar.gz'),
+                        name='test_ann1')
+    version_a = ann_r.version
+    path_a = version_a.path
+    ann_r.load(reload=True)
+    path_b = ann_r.version.path
+    assert path_b != path_a
+    assert current_version(path_ann / 'test_ann1') == path_b
+
+    # Still served to the queries holding it
+    neighbors = ann_r.nn_from_id('1', 3, version=version_a)
+    assert path_a.exists()
+    assert ann_r.nn_from_id('1', 3).ids == neighbors.ids
+
+    del version_a
+    gc.collect()
+    for _ in range(50):
+        if not path_a.exists():
+            break
+        sleep(0.1)
+    assert not path_a.exists()
+    assert path_b.exists()
+    assert current_version(path_ann / 'test_ann1') == path_b
+    assert ann_r.nn_from_id('1', 3).ids == neighbors.ids